@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     name = 'Chat'
+
+    def ready(self):
+        # connects the signal handlers that keep the partner index, caches, counters, user stats, search,
+        # the language catalog and the stored partner lists up to date
+        from . import matching, cache, counters, stats, search, profiling, catalog, recommendations
+        profiling.install_query_counter()
@@ -0,0 +1,116 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import ChatRoom, Message, ArchivedMessage
+
+
+# Archive tier
+# Moves old messages out of Message into ArchivedMessage so the hot table and its indexes only hold recent chat:
+# anything older than CHAT_ARCHIVE_AFTER_DAYS, and everything in rooms that aren't is_active. The newest
+# CHAT_ARCHIVE_KEEP messages of every room always stay, so the first history page and the inbox previews never
+# need the archive. Everything goes by (timestamp, id), the order history pages in, so what's archived is always
+# older than what's left and get_message_page can carry on into the archive where the hot rows run out
+
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_KEEP = 50
+
+
+def candidate_rooms(cutoff):
+    old = Message.objects.filter(timestamp__lt=cutoff).values('chatroom_id')
+    return ChatRoom.objects.filter(Q(id__in=old) | Q(is_active=False, messages__isnull=False)).distinct()
+
+
+def archivable(room, cutoff, keep):
+    # the newest `keep` messages stay whatever their age
+    kept = list(Message.objects.filter(chatroom=room).order_by('-timestamp', '-id')
+                .values_list('timestamp', 'id')[keep:keep + 1])
+    if not kept:
+        return Message.objects.none()
+    timestamp, message_id = kept[0]
+    messages = Message.objects.filter(chatroom=room).filter(
+        Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lte=message_id)
+    )
+    return messages.filter(timestamp__lt=cutoff) if room.is_active else messages
+
+
+def delete_moved(ids):
+    # A plain DELETE on purpose, Message.delete() would send post_delete for every row and the receivers would
+    # take them off the site counters, user stats, the partner index and search, all of which still count archived
+    # messages. Room buffers live in the processes serving sockets, and a buffered copy of a moved message is
+    # still the same message
+    table = connection.ops.quote_name(Message._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(ids))})', ids)
+
+
+def archive_room(room, cutoff, keep, batch_size):
+    messages = archivable(room, cutoff, keep)
+    moved = 0
+    while True:
+        with transaction.atomic():
+            # oldest first, so after every batch the archive is still all older than the hot rows
+            batch = list(
+                messages.order_by('timestamp', 'id')
+                .values('id', 'chatroom_id', 'sender_id', 'content', 'timestamp')[:batch_size]
+            )
+            if not batch:
+                break
+            ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in batch], ignore_conflicts=True)
+            delete_moved([row['id'] for row in batch])
+            ChatRoom.objects.filter(id=room.id).update(archived_count=F('archived_count') + len(batch))
+            moved += len(batch)
+    return moved
+
+
+def archive_messages(older_than_days=None, keep=None, batch_size=1000, dry_run=False):
+    if older_than_days is None:
+        older_than_days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)
+    if keep is None:
+        keep = getattr(settings, 'CHAT_ARCHIVE_KEEP', ARCHIVE_KEEP)
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+
+    report = {'rooms': 0, 'messages': 0, 'bytes_before': table_bytes(Message), 'bytes_after': None}
+    for room in candidate_rooms(cutoff).iterator():
+        if dry_run:
+            count = archivable(room, cutoff, keep).count()
+        else:
+            count = archive_room(room, cutoff, keep, batch_size)
+        if count:
+            report['rooms'] += 1
+            report['messages'] += count
+
+    report['bytes_after'] = table_bytes(Message)
+    return report
+
+
+# Space used by a model's table + indexes, None if the database can't tell us
+
+def table_bytes(model):
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        try:
+            if connection.vendor == 'sqlite':
+                # needs SQLITE_ENABLE_DBSTAT_VTAB, most builds have it
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = %s)',
+                    [table],
+                )
+            elif connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+            else:
+                return None
+            return cursor.fetchone()[0]
+        except Exception:
+            return None
+
+
+def reclaim_space():
+    # deleted rows leave free pages behind, SQLite only gives them back to the disk on VACUUM
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'VACUUM ANALYZE {Message._meta.db_table}')
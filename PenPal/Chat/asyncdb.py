@@ -0,0 +1,95 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from .profiling import current_sample
+
+
+# Database access for ChatConsumer
+# The consumer's queries use Django's async ORM (afirst, acreate, aupdate, ...) instead of a database_sync_to_async
+# wrapper per operation. Django still runs async queries on its one thread sensitive DB thread, what goes away is
+# the close_old_connections pair database_sync_to_async runs around every call, so the connection stays open
+# between events. db_slot() recycles it every CHAT_DB_RECYCLE seconds instead, that's what still drops broken and
+# too old connections.
+#
+# At most CHAT_DB_CONCURRENCY events per process are inside db_slot() at once, the rest wait their turn in order
+# instead of piling up in the executor queue. With Django's single DB thread more slots only move the wait from
+# here into that queue and make the hold times meaningless, so keep it small. How long each one waited and held
+# its slot is kept here for manage.py bench_consumer_db, and the hold time goes into the current profiling sample
+# (db_hold_ms_avg)
+
+DB_CONCURRENCY = 4
+DB_RECYCLE = 60
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+class DatabaseLimiter:
+    def __init__(self, limit=None, recycle=None):
+        self.limit = limit or getattr(settings, 'CHAT_DB_CONCURRENCY', DB_CONCURRENCY)
+        self.recycle = recycle if recycle is not None else getattr(settings, 'CHAT_DB_RECYCLE', DB_RECYCLE)
+        self.semaphore = asyncio.Semaphore(self.limit)
+        self.recycled = time.monotonic()
+        self.in_use = 0
+        self.peak = 0
+        self.waits = deque(maxlen=5000)
+        self.holds = deque(maxlen=5000)
+
+    @asynccontextmanager
+    async def slot(self):
+        queued = time.perf_counter()
+        async with self.semaphore:
+            started = time.perf_counter()
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            try:
+                if time.monotonic() - self.recycled > self.recycle:
+                    self.recycled = time.monotonic()
+                    # runs on the same thread as the async ORM, so it's that connection that gets checked
+                    await sync_to_async(close_old_connections)()
+                yield
+            finally:
+                held = time.perf_counter() - started
+                self.in_use -= 1
+                self.waits.append(started - queued)
+                self.holds.append(held)
+                sample = current_sample.get()
+                if sample is not None:
+                    sample.db_hold += held
+
+    def stats(self):
+        waits = [wait * 1000 for wait in self.waits]
+        holds = [hold * 1000 for hold in self.holds]
+        return {
+            'limit': self.limit,
+            'peak': self.peak,
+            'wait_ms_p50': percentile(waits, 50),
+            'wait_ms_p99': percentile(waits, 99),
+            'hold_ms_p50': percentile(holds, 50),
+            'hold_ms_p99': percentile(holds, 99),
+        }
+
+
+# one per event loop, like the message writer
+limiters = weakref.WeakKeyDictionary()
+
+
+def get_limiter():
+    loop = asyncio.get_running_loop()
+    limiter = limiters.get(loop)
+    if limiter is None:
+        limiter = limiters[loop] = DatabaseLimiter()
+    return limiter
+
+
+def db_slot():
+    return get_limiter().slot()
@@ -0,0 +1,350 @@
+import bisect
+import time
+from collections import OrderedDict
+from threading import Lock
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+from .models import ChatRoom, Message
+from .profiling import cache_hit, cache_miss
+from .asyncdb import db_slot
+
+
+# In process caches for the chat hot paths
+
+
+MISSING = object()
+
+
+class LRUCache:
+    # size bounded LRU where every entry also expires after ttl seconds
+    # locked because database_sync_to_async threads and signal handlers use it too
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            item = self.data.get(key, MISSING)
+            if item is MISSING or item[1] < time.monotonic():
+                if item is not MISSING:
+                    del self.data[key]
+                self.misses += 1
+                cache_miss()
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            cache_hit()
+            return item[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_where(self, test):
+        with self.lock:
+            for key in [key for key in self.data if test(key)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+# Room membership
+# Keyed by (room_id, user_id), True for members and False for everyone else so reconnect storms don't hit the DB.
+# Only the answer is kept, never the room, rooms change (archived_count, updated_at) and a cached instance would be
+# shared by every socket. people changes in this process invalidate straight away, other workers wait out the TTL
+
+membership_cache = LRUCache(
+    maxsize=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_TTL', 60),
+)
+
+
+def is_room_member(room_id, user_id):
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return False
+
+    key = (room_id, user_id)
+    member = membership_cache.get(key)
+    if member is not MISSING:
+        return member
+
+    member = ChatRoom.objects.filter(id=room_id, people=user_id).exists()
+    membership_cache.set(key, member)
+    return member
+
+
+async def ais_room_member(room_id, user_id):
+    # is_room_member for ChatConsumer, a miss goes through the async ORM under a db_slot
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return False
+
+    key = (room_id, user_id)
+    member = membership_cache.get(key)
+    if member is not MISSING:
+        return member
+
+    async with db_slot():
+        member = await ChatRoom.objects.filter(id=room_id, people=user_id).aexists()
+    membership_cache.set(key, member)
+    return member
+
+
+def room_ref(room_id):
+    # a ChatRoom with only its id loaded, no query. Any other field is read from the DB when something uses it
+    return ChatRoom.from_db(ChatRoom.objects.db, ['id'], [int(room_id)])
+
+
+@receiver(m2m_changed, sender=ChatRoom.people.through)
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        # pk_set is None on clear, drop everything for that room (or user if cleared from the user side)
+        index = 1 if reverse else 0
+        membership_cache.delete_where(lambda key: key[index] == instance.pk)
+        return
+
+    for pk in pk_set or []:
+        if reverse:
+            membership_cache.delete((pk, instance.pk))
+        else:
+            membership_cache.delete((instance.pk, pk))
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_deleted(sender, instance, **kwargs):
+    membership_cache.delete_where(lambda key: key[0] == instance.pk)
+
+
+# Recent messages per room
+# The newest CHAT_ROOM_BUFFER_SIZE messages of a room, already serialized the way the socket and chat_history send them
+# (serialize_message + sender_id), so the first history page and the inbox previews don't need the DB.
+# ChatConsumer writes each message through when it saves it, and again when it comes in from the group, which is how
+# messages saved by other workers get here. For history a buffer is only trusted while this process has a socket in
+# the room (subscribe / unsubscribe), that's what makes sure it saw every message. The inbox doesn't need that, it
+# checks the entry against the room's latest message id. Least recently used rooms go first once all the buffers
+# together pass CHAT_ROOM_BUFFER_BYTES
+
+ENTRY_OVERHEAD = 200  # dict + strings, roughly
+
+
+class RoomBuffer:
+    __slots__ = ('keys', 'entries', 'ids', 'complete', 'has_older', 'bytes')
+
+    def __init__(self):
+        self.keys = []
+        self.entries = []
+        self.ids = set()
+        self.complete = False  # has everything since it was filled from the DB
+        self.has_older = False
+        self.bytes = 0
+
+
+def entry_size(entry):
+    return len(entry['message']) + len(entry['username']) + len(entry['timestamp']) + ENTRY_OVERHEAD
+
+
+def entry_key(entry):
+    return (parse_datetime(entry['timestamp']), entry['message_id'])
+
+
+class RoomBuffers:
+    def __init__(self, capacity=None, max_bytes=None):
+        self.capacity = capacity or getattr(settings, 'CHAT_ROOM_BUFFER_SIZE', 50)
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_ROOM_BUFFER_BYTES', 32 * 1024 * 1024)
+        self.rooms = OrderedDict()
+        self.live = {}
+        self.lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # sockets in the room, in this process
+
+    def subscribe(self, room_id):
+        with self.lock:
+            count = self.live.get(room_id, 0)
+            self.live[room_id] = count + 1
+            if count == 0:
+                # nobody was listening, it may have missed messages
+                self.discard(room_id)
+
+    def unsubscribe(self, room_id):
+        with self.lock:
+            count = self.live.pop(room_id, 0) - 1
+            if count > 0:
+                self.live[room_id] = count
+
+    # writes
+
+    def append(self, room_id, entry):
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is None:
+                if room_id not in self.live:
+                    return
+                buffer = self.rooms[room_id] = RoomBuffer()
+            if entry['message_id'] in buffer.ids:
+                return
+            self.insert(buffer, entry)
+            self.rooms.move_to_end(room_id)
+            self.evict()
+
+    def fill(self, room_id, entries, has_older):
+        # newest page from the DB, merged with whatever got appended while it was being read
+        with self.lock:
+            if room_id not in self.live:
+                return
+            buffer = self.rooms.get(room_id)
+            if buffer is None:
+                buffer = self.rooms[room_id] = RoomBuffer()
+            buffer.has_older = buffer.has_older or has_older
+            for entry in entries:
+                if entry['message_id'] not in buffer.ids:
+                    self.insert(buffer, entry)
+            buffer.complete = True
+            self.rooms.move_to_end(room_id)
+            self.evict()
+
+    def insert(self, buffer, entry):
+        key = entry_key(entry)
+        if len(buffer.keys) >= self.capacity:
+            if key < buffer.keys[0]:
+                # older than anything kept
+                buffer.has_older = True
+                return
+            self.remove_oldest(buffer)
+        position = bisect.bisect(buffer.keys, key)
+        buffer.keys.insert(position, key)
+        buffer.entries.insert(position, entry)
+        buffer.ids.add(entry['message_id'])
+        size = entry_size(entry)
+        buffer.bytes += size
+        self.bytes += size
+
+    def remove_oldest(self, buffer):
+        buffer.keys.pop(0)
+        entry = buffer.entries.pop(0)
+        buffer.ids.discard(entry['message_id'])
+        size = entry_size(entry)
+        buffer.bytes -= size
+        self.bytes -= size
+        buffer.has_older = True
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.rooms:
+            room_id, buffer = self.rooms.popitem(last=False)
+            self.bytes -= buffer.bytes
+            self.evictions += 1
+
+    def discard(self, room_id):
+        buffer = self.rooms.pop(room_id, None)
+        if buffer is not None:
+            self.bytes -= buffer.bytes
+
+    def drop(self, room_id):
+        with self.lock:
+            self.discard(room_id)
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+            self.live.clear()
+            self.bytes = 0
+
+    # reads
+
+    def page(self, room_id, limit):
+        # (entries oldest first, has_older) or None when the DB has to answer
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is None or not buffer.complete or room_id not in self.live or limit > self.capacity:
+                self.misses += 1
+                cache_miss()
+                return None
+            if len(buffer.entries) < limit and buffer.has_older:
+                # filled from a shorter page than this one
+                self.misses += 1
+                cache_miss()
+                return None
+            self.rooms.move_to_end(room_id)
+            self.hits += 1
+            cache_hit()
+            return buffer.entries[-limit:], buffer.has_older or len(buffer.entries) > limit
+
+    def tracks(self, room_id):
+        return room_id in self.live or room_id in self.rooms
+
+    def wants_fill(self, room_id):
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            return room_id in self.live and (buffer is None or not buffer.complete)
+
+    def find(self, room_id, message_id):
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is None or message_id not in buffer.ids:
+                return None
+            for entry in reversed(buffer.entries):
+                if entry['message_id'] == message_id:
+                    return entry
+
+    def __len__(self):
+        return len(self.rooms)
+
+
+room_buffers = RoomBuffers()
+
+
+def message_entry(message):
+    return {
+        'message_id': message.id,
+        'username': message.sender.username,
+        'message': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'sender_id': message.sender_id,
+    }
+
+
+@receiver(post_save, sender=Message)
+def room_buffer_message_saved(sender, instance, created, **kwargs):
+    # the consumer already wrote its own messages through, this catches everything else saved in this process.
+    # An edit means the copy is wrong
+    if not created:
+        room_buffers.drop(instance.chatroom_id)
+    elif room_buffers.tracks(instance.chatroom_id):
+        room_buffers.append(instance.chatroom_id, message_entry(instance))
+
+
+@receiver(post_delete, sender=Message)
+def room_buffer_message_deleted(sender, instance, **kwargs):
+    room_buffers.drop(instance.chatroom_id)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_buffer_room_deleted(sender, instance, **kwargs):
+    room_buffers.drop(instance.pk)
@@ -0,0 +1,75 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Language, UserProfile
+
+
+# Language catalog
+# The language list with learner counts, memoized in the process for CHAT_CATALOG_LOCAL_TTL seconds and in the
+# Django cache for CHAT_CATALOG_TTL. Any change to a language or to someone's learn_lang bumps the catalog version,
+# language_select.html keys its fragment cache on that version so the grid goes with it.
+# Both copies are kept under the version they were built for and every read checks the current one (a cache get,
+# no query), so a bump in any process drops every other process's memo straight away
+
+CACHE_KEY = 'chat:catalog:languages'
+VERSION_KEY = 'chat:catalog:version'
+
+local = {'languages': None, 'version': None, 'expires': 0}
+
+
+def get_languages():
+    version = get_catalog_version()
+    languages = local['languages']
+    if languages is not None and local['version'] == version and local['expires'] > time.monotonic():
+        return languages
+
+    key = f'{CACHE_KEY}:{version}'
+    languages = cache.get(key)
+    if languages is None:
+        languages = list(Language.objects.annotate(learner_count=Count('learners')).order_by('name'))
+        cache.set(key, languages, getattr(settings, 'CHAT_CATALOG_TTL', 3600))
+
+    local['languages'] = languages
+    local['version'] = version
+    local['expires'] = time.monotonic() + getattr(settings, 'CHAT_CATALOG_LOCAL_TTL', 30)
+    return languages
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def invalidate_catalog():
+    local['languages'] = None
+    cache.delete(f'{CACHE_KEY}:{get_catalog_version()}')
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, None)
+
+
+# Signals
+
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def catalog_language_changed(sender, **kwargs):
+    invalidate_catalog()
+
+
+@receiver(m2m_changed, sender=UserProfile.learn_lang.through)
+def catalog_learners_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_catalog()
+
+
+@receiver(post_delete, sender=UserProfile)
+def catalog_learner_deleted(sender, **kwargs):
+    # the learn_lang rows go with the profile without m2m_changed
+    invalidate_catalog()
@@ -1,24 +1,55 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from .models import ChatRoom, Message
+from .utils import get_message_page, aget_messages_after, serialize_message, amark_read_up_to, RESUME_LIMIT
+from .persistence import write_behind_enabled, get_writer, WriteFailed
+from .cache import ais_room_member, room_ref, room_buffers, message_entry
+from .asyncdb import db_slot
+from .presence import typing_tracker, presence
+from .ratelimit import rate_limiter
+from .profiling import ProfiledConsumerMixin
+from .wire import COMPACT_PROTOCOL, frame, compact, batch
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+# what room_buffers keeps of a chat_message group event
+BUFFER_FIELDS = ('message_id', 'username', 'message', 'timestamp', 'sender_id')
+
+# client frames that get something back, so a dropped one gets rate_limited instead
+ANSWERED_FRAMES = ('chat_message', 'history')
+
+
+class ChatConsumer(ProfiledConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self): #Called when connection is established
 
         self.room_id = self.scope['url_route']['kwargs']['room_id'] # get room id from url from Routing.py
 
-        self.room_group_name = f' chat_{self.room_id}' # will create froup name for chat room and all users join same group
+        self.room_group_name = f'chat_{self.room_id}' # will create froup name for chat room and all users join same group
 
         self.user = self.scope['user'] # get user from scope from AuthMiddlewareStack
 
+        self.joined = False
+
+        self.pending_read = 0 # highest message id the client said it read that isn't saved yet
+        self.read_flush = None
+
+        self.compact = COMPACT_PROTOCOL in self.scope.get('subprotocols', []) # client asked for batched short frames
+        self.batch = []
+        self.batch_flush = None
+
+        self.rate_buckets = {} # this connection's token buckets, see ratelimit.py
+
         if not self.user.is_authenticated: # will reject if user not logged in.
-            await self.accept()
+            await self.close()
             return
 
-        is_participant = await self.check_room_people()
-        if not is_participant:
+        # only the id is loaded, enough for saving messages and read marks without looking the room up again
+        self.room = await self.check_room_participant()
+        if self.room is None:
 
             await self.close()
             return
@@ -28,8 +59,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        self.joined = True
+        # in the group we see every message, so this process can keep the room's recent messages
+        room_buffers.subscribe(self.room.id)
+
+        await self.accept(subprotocol=COMPACT_PROTOCOL if self.compact else None)
 
-        await self.accept()
+        # reconnecting clients tell us the last message they have, send only what they missed.
+        # We're already in the group so nothing falls in between, the client drops duplicates by id
+        last_message_id = self.get_last_message_id()
+        if last_message_id is not None:
+            await self.replay_missed(last_message_id)
+
+        # other tabs / reconnects of someone already here don't get announced again
+        if not await presence.connect(self.room.id, self.user.id):
+            return
 
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -40,17 +84,54 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
 
-        await self.channel_layer.group_send(
-            self.room_group_name,{
-                'type': 'user_left',
-                'username': self.user.username,
-            })
+        if not self.joined:
+            return
+
+        if self.batch_flush is not None:
+            self.batch_flush.cancel()
+
+        await typing_tracker.stop(self.room.id, self.user.id)
+
+        if self.read_flush is not None:
+            self.read_flush.cancel()
+            await self.save_read_receipt()
+
+        # nothing of ours is left in the write-behind queue, handle_chat_message waits on submit() until its batch is
+        # committed and frames are handled one at a time. Flushing here would wait on every socket's messages
+
+        if await presence.disconnect(self.room.id, self.user.id):
+            await self.channel_layer.group_send(
+                self.room_group_name,{
+                    'type': 'user_left',
+                    'username': self.user.username,
+                })
 
 
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        room_buffers.unsubscribe(self.room.id)
+
+    def get_last_message_id(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_message_id'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def replay_missed(self, last_message_id):
+        # messages still in the write-behind queue haven't been broadcast yet either, they come through the group
+        missed = await self.load_missed(last_message_id)
+        if missed is None:
+            # too far behind, the client reloads the page instead
+            await self.send(text_data=json.dumps({'type': 'resync'}))
+            return
+
+        for message in missed:
+            await self.send_event({'type': 'chat_message', **message})
+        if self.compact:
+            await self.send_batch()
 
     async def receive(self, text_data):
 
@@ -59,7 +140,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except json.decoder.JSONDecodeError:
             return
 
+        # anything but an object with a string type is dropped before it gets near a dict lookup
+        if not isinstance(data, dict):
+            return
         message_type = data.get('type', 'chat_message')
+        if not isinstance(message_type, str):
+            return
+
+        # over the connection's or the room's budget the frame goes no further. Frames the client waits on an answer
+        # for get told, typing and read receipts are just dropped
+        if not await rate_limiter.allow(message_type, self.rate_buckets, self.room.id):
+            if message_type in ANSWERED_FRAMES:
+                await self.send(text_data=json.dumps({'type': 'rate_limited', 'frame': message_type}))
+            return
 
         if message_type == 'chat_message':
             await self.handle_chat_message(data)
@@ -67,8 +160,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         elif message_type == 'typing':
             await self.handle_typing(data)
 
-        elif message_type == 'read receipt':
-            await self.handel_read_receipt(data)
+        elif message_type == 'read_receipt':
+            await self.handle_read_receipt(data)
+
+        elif message_type == 'history':
+            await self.handle_history(data)
 
 
 
@@ -78,112 +174,194 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not message_content or len(message_content) > 2500:
             return
 
-        message = await self.save_message(message_content)
+        if write_behind_enabled():
+            try:
+                message = await get_writer().submit(self.room.id, self.user, message_content)
+            except WriteFailed:
+                message = None
+        else:
+            message = await self.save_message(message_content)
 
         if message is None:
+            # nobody saw it, the sender gets told it didn't go out
+            await self.send(text_data=json.dumps({'type': 'error', 'frame': 'chat_message'}))
             return
 
+        # write through, the first page of history has it before the broadcast goes out
+        room_buffers.append(self.room.id, message_entry(message))
+
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
                 'username': self.user.username,
                 'message': message_content,
-                'timestamp': message.timestamp,
+                'timestamp': message.timestamp.isoformat(),
                 'message_id': message.id,
+                'sender_id': self.user.id,
             }
         )
 
-        async def handle_typing(self, data):
+    # typing frames come in on every keystroke, the tracker decides when the room actually hears about it
+    async def handle_typing(self, data):
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'username': self.user.username,
-                    'is_typing': data.get('is_typing', True),
+        await typing_tracker.update(self.room.id, self.user.id, data.get('is_typing', True), self.broadcast_typing)
 
-                }
-            )
+    async def broadcast_typing(self, is_typing):
+
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'typing_indicator',
+                'username': self.user.username,
+                'is_typing': is_typing,
 
+            }
+        )
 
 
-        async def handle_read_receipt(self, data):
-            message_ids = data.get('message_ids', [])
 
-            await self.mark_messages_in_read(message_ids)
+    # receipts only move a high-water mark, so we keep the highest id and write it once per CHAT_READ_RECEIPT_DELAY
+    async def handle_read_receipt(self, data):
+        message_ids = data.get('message_ids') or [data.get('message_id')]
 
+        try:
+            newest = max(int(message_id) for message_id in message_ids if message_id is not None)
+        except (TypeError, ValueError):
+            return
 
+        if newest <= self.pending_read:
+            return
+        self.pending_read = newest
 
-        async def chat_message(self, event):
-            await self.send(text_data=json.dumps({
-                'type': 'chat_message',
-                'username': event['username'],
-                'message': event['message'],
-                'timestamp': event['timestamp'],
-                'message_id': event['message_id'],
-            }))
+        if self.read_flush is None:
+            self.read_flush = asyncio.ensure_future(self.save_read_receipt_later())
 
+    async def save_read_receipt_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_READ_RECEIPT_DELAY', 1.0))
+        self.read_flush = None
+        await self.save_read_receipt()
 
-        async def typing_indicator(self, event):
+    async def save_read_receipt(self):
+        if self.pending_read:
+            await self.mark_messages_in_read(self.pending_read)
 
-            if event['username'] != self.user.username:
-                await self.send(text_data=json.dumps({
-                    'type': 'typing',
-                    'username' : event['username'],
-                    'is_typing' : event.get ('is_typing', True)
-                }))
 
+    # Scroll back, client sends the cursor it got with the last page and only gets the answer back itself
+    async def handle_history(self, data):
+        page = await self.load_history(data.get('before'))
 
-        async def user_join(self, event):
-            await self.send(text_data=json.dumps({
-                'type': 'user_join',
-                'username' : event['username'],
-            }))
+        if page is None:
+            # bad cursor, the client stops waiting for the page
+            await self.send(text_data=json.dumps({'type': 'error', 'frame': 'history'}))
+            return
 
-        async def user_leave(self, event):
-            if event['username'] != self.user.username: await self.send(text_data=json.dumps({
-                'type': 'user_leave',
-                'username' : event['username'],
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'history',
+            'messages': page[0],
+            'next_cursor': page[1],
+        }))
 
 
 
-# Database Operations
+    # Group events are encoded once per process per format, see wire.py
 
-def check_room_participant(self):
+    async def chat_message(self, event):
+        # messages from sockets on other workers reach this process's buffer here, repeats are ignored
+        if 'sender_id' in event:
+            room_buffers.append(self.room.id, {field: event[field] for field in BUFFER_FIELDS})
+        await self.send_event(event)
 
-    try:
-        room = ChatRoom.objects.get(id=self.room_id)
-        return room.people.filter(user=self.user.id).exists()
-    except ChatRoom.DoesNotExist:
-        return False
 
+    async def typing_indicator(self, event):
 
-def save_message(self, content):
+        if event['username'] != self.user.username:
+            await self.send_event(event)
 
-    try:
-        room = ChatRoom.objects.get(id=self.room_id)
-        message = Message.objects.create(
-            chatroom=room,
-            sender=self.user,
-            content=content,
-        )
-        return message
-    except ChatRoom.DoesNotExist:
-        return None
-    except Exception as e:
-        print(f'Error saving message: {e}')
-        return None
 
+    async def user_joined(self, event):
+        await self.send_event(event)
 
+    async def user_left(self, event):
+        if event['username'] != self.user.username: await self.send_event(event)
 
-@database_sync_to_async
-def mark_messages_in_read(self, message_ids):
 
-    try:
-        Message.objects.filter(id__in=message_ids, chatroom_id=self.room_id).exclude(sender=self.user).update(is_read=True)
-    except Exception as e:
-        print(f'Error making messages as read: {e}')
+    async def send_event(self, event):
+        if not self.compact:
+            await self.send(text_data=frame(event))
+            return
 
+        # compact clients get everything from the next CHAT_WIRE_BATCH_WINDOW seconds in one frame
+        self.batch.append(compact(event))
+        if len(self.batch) >= getattr(settings, 'CHAT_WIRE_BATCH_SIZE', 50):
+            await self.send_batch()
+        elif self.batch_flush is None:
+            self.batch_flush = asyncio.ensure_future(self.send_batch_later())
 
+    async def send_batch_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_WIRE_BATCH_WINDOW', 0.02))
+        self.batch_flush = None
+        await self.send_batch()
+
+    async def send_batch(self):
+        if self.batch_flush is not None:
+            self.batch_flush.cancel()
+            self.batch_flush = None
+        if self.batch:
+            fragments, self.batch = self.batch, []
+            await self.send(text_data=batch(fragments))
+
+
+
+    # Database Operations
+    # On the async ORM, each one holds a db_slot while it runs (see asyncdb.py)
+
+    async def check_room_participant(self):
+
+        if not await ais_room_member(self.room_id, self.user.id):
+            return None
+        return room_ref(self.room_id)
+
+
+    async def save_message(self, content):
+
+        try:
+            async with db_slot():
+                return await Message.objects.acreate(
+                    chatroom=self.room,
+                    sender=self.user,
+                    content=content,
+                )
+        except Exception as e:
+            print(f'Error saving message: {e}')
+            return None
+
+
+
+    async def mark_messages_in_read(self, message_id):
+
+        try:
+            async with db_slot():
+                await amark_read_up_to(self.room, self.user, message_id)
+        except Exception as e:
+            print(f'Error making messages as read: {e}')
+
+
+    async def load_missed(self, last_message_id):
+        limit = getattr(settings, 'CHAT_RESUME_LIMIT', RESUME_LIMIT)
+        async with db_slot():
+            missed = await aget_messages_after(self.room, last_message_id, limit)
+        if len(missed) > limit:
+            return None
+        return [serialize_message(message) for message in missed]
+
+
+    async def load_history(self, before):
+        # get_message_page can read the buffer, the messages and the archive, it stays one call on the DB thread.
+        # A fresh room_ref each time, so archived_count is read when the page gets that far, not kept from connect
+        async with db_slot():
+            try:
+                page, next_cursor = await sync_to_async(get_message_page)(room_ref(self.room.id), before=before)
+            except ValueError:
+                return None
+        return [serialize_message(message) for message in page], next_cursor
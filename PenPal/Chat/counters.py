@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Language, Message, ArchivedMessage, Counter
+from .signals import messages_bulk_created, room_messages_deleted, room_deleting
+from .profiling import cache_hit, cache_miss
+
+
+# Site wide totals for the landing page
+# Kept as rows in Counter, bumped by signals so the home page never runs COUNT(*) over the message table.
+# reconcile_counters recounts everything, run it from cron (manage.py reconcile_counters) to fix any drift.
+# Every message would be an UPDATE on the same row, so bumps add up in memory and each counter gets one UPDATE
+# every CHAT_COUNTERS_FLUSH_SECONDS per process. Bumps a process hadn't written when it stopped are drift too
+
+SITE_COUNTERS = {
+    'total_users': User,
+    'total_languages': Language,
+    'total_messages': Message,
+}
+
+# rows moved out of the counted table that still count, see archive.py
+ALSO_COUNTED = {
+    'total_messages': [ArchivedMessage],
+}
+
+CACHE_KEY = 'chat:site_counters'
+FLUSH_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def counter_name(key):
+    return f'site:{key}'
+
+
+class PendingBumps:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.amounts = {}
+        self.flushed = time.monotonic()
+
+    def add(self, key, amount):
+        with self.lock:
+            self.amounts[key] = self.amounts.get(key, 0) + amount
+            return time.monotonic() - self.flushed >= getattr(settings, 'CHAT_COUNTERS_FLUSH_SECONDS', FLUSH_SECONDS)
+
+    def take(self):
+        with self.lock:
+            amounts, self.amounts = self.amounts, {}
+            self.flushed = time.monotonic()
+        return amounts
+
+    def discard(self, key):
+        with self.lock:
+            self.amounts.pop(key, None)
+
+
+pending = PendingBumps()
+
+
+def bump(key, amount=1):
+    if pending.add(key, amount):
+        flush_counters()
+
+
+def flush_counters():
+    for key, amount in pending.take().items():
+        if not amount:
+            continue
+        try:
+            updated = Counter.objects.filter(name=counter_name(key)).update(value=F('value') + amount)
+            if not updated:
+                # first time, start from the real number
+                reconcile_counter(key)
+        except Exception:
+            # try again next flush
+            pending.add(key, amount)
+            logger.exception('Error writing site counter %s', key)
+
+
+def reconcile_counter(key):
+    # the recount already has whatever was waiting to be written
+    pending.discard(key)
+    total = SITE_COUNTERS[key].objects.count()
+    total += sum(model.objects.count() for model in ALSO_COUNTED.get(key, []))
+    Counter.objects.update_or_create(name=counter_name(key), defaults={'value': total})
+    return total
+
+
+def reconcile_counters():
+    totals = {key: reconcile_counter(key) for key in SITE_COUNTERS}
+    cache.delete(CACHE_KEY)
+    return totals
+
+
+def get_site_counters():
+    totals = cache.get(CACHE_KEY)
+    if totals is not None:
+        cache_hit()
+        return totals
+    cache_miss()
+
+    flush_counters()
+    names = {counter_name(key): key for key in SITE_COUNTERS}
+    totals = {names[name]: value for name, value in Counter.objects.filter(name__in=names).values_list('name', 'value')}
+    for key in SITE_COUNTERS:
+        if key not in totals:
+            totals[key] = reconcile_counter(key)
+
+    cache.set(CACHE_KEY, totals, getattr(settings, 'CHAT_COUNTERS_CACHE_TTL', 60))
+    return totals
+
+
+# Signals
+
+def counter_receivers(key, model):
+    @receiver(post_save, sender=model, weak=False, dispatch_uid=f'counter_created_{key}')
+    def created(sender, instance, created, **kwargs):
+        if created:
+            bump(key)
+
+    @receiver(post_delete, sender=model, weak=False, dispatch_uid=f'counter_deleted_{key}')
+    def deleted(sender, instance, **kwargs):
+        if model is Message and room_deleting(instance.chatroom_id):
+            return
+        bump(key, -1)
+
+
+for key, model in SITE_COUNTERS.items():
+    counter_receivers(key, model)
+
+
+@receiver(messages_bulk_created)
+def messages_bulk_counted(sender, messages, **kwargs):
+    bump('total_messages', len(messages))
+
+
+@receiver(room_messages_deleted)
+def room_messages_uncounted(sender, message_ids, **kwargs):
+    bump('total_messages', -len(message_ids))
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import random
+import string
+import time
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+
+# Channel layer with local fan-out
+# group_send hands the event straight to the queues of channels connected to this process (no copy, no
+# serialization) and only goes over the transport to other workers that have members of the group. Each worker
+# joins the transport group once for all of its local members, so a remote event is encoded once and sent once
+# per worker, not per recipient. Handlers get the same dict, they must not change it, except for _ keys
+# (wire.py caches the encoded frames there), which stay in this process.
+#
+#   CHANNEL_LAYERS = {'default': {
+#       'BACKEND': 'Chat.layers.LocalFanoutChannelLayer',
+#       'CONFIG': {'transport': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {...}}},
+#   }}
+#
+# Without a transport it's a single process layer. Tests share one LocalTransport between several layers to
+# stand in for separate workers.
+
+
+def random_name(length=12):
+    return ''.join(random.choice(string.ascii_letters) for i in range(length))
+
+
+class LocalTransport:
+    # in process stand-in for the remote side, every layer sharing it is treated as a separate worker
+    def __init__(self):
+        self.groups = {}
+        self.inboxes = {}
+        self.sent = 0
+
+    def inbox(self, worker):
+        return self.inboxes.setdefault(worker, asyncio.Queue())
+
+    async def group_add(self, group, worker):
+        self.groups.setdefault(group, set()).add(worker)
+
+    async def group_discard(self, group, worker):
+        workers = self.groups.get(group)
+        if workers:
+            workers.discard(worker)
+            if not workers:
+                del self.groups[group]
+
+    async def members(self, group):
+        return self.groups.get(group, set())
+
+    async def group_send(self, group, envelope, exclude=None):
+        for worker in self.groups.get(group, ()):
+            if worker != exclude:
+                await self.send(worker, envelope)
+
+    async def send(self, worker, envelope):
+        self.sent += 1
+        self.inbox(worker).put_nowait(envelope)
+
+    async def receive(self, worker):
+        return await self.inbox(worker).get()
+
+    async def flush(self):
+        self.groups = {}
+        self.inboxes = {}
+
+
+class ChannelLayerTransport:
+    # puts any channel layer (channels_redis etc) underneath, one normal channel per worker as its inbox.
+    # members() reads who is in a group straight out of channels_redis (the group's sorted set) or the in memory
+    # layer, so a group with no other worker in it is never sent. Any other layer can't tell us, there group sends
+    # go to every member worker and we drop our own echo
+    def __init__(self, layer):
+        self.layer = layer
+
+    def inbox(self, worker):
+        return f'fanout.{worker}'
+
+    def group(self, group):
+        return f'fanout.{group}'
+
+    async def group_add(self, group, worker):
+        await self.layer.group_add(self.group(group), self.inbox(worker))
+
+    async def group_discard(self, group, worker):
+        await self.layer.group_discard(self.group(group), self.inbox(worker))
+
+    async def members(self, group):
+        channels = await self.group_channels(self.group(group))
+        if channels is None:
+            return None
+        prefix = self.inbox('')
+        return {channel[len(prefix):] for channel in channels if channel.startswith(prefix)}
+
+    async def group_channels(self, group):
+        layer = self.layer
+        if hasattr(layer, '_group_key') and hasattr(layer, 'consistent_hash'):
+            # channels_redis, the same zset its group_send reads, minus what has expired
+            connection = layer.connection(layer.consistent_hash(group))
+            channels = await connection.zrangebyscore(
+                layer._group_key(group), min=int(time.time()) - layer.group_expiry, max='+inf'
+            )
+            return {channel.decode() for channel in channels}
+        if isinstance(getattr(layer, 'groups', None), dict):
+            # InMemoryChannelLayer, {group: {channel: joined}}
+            return set(layer.groups.get(group, ()))
+        return None
+
+    async def group_send(self, group, envelope, exclude=None):
+        await self.layer.group_send(self.group(group), envelope)
+
+    async def send(self, worker, envelope):
+        await self.layer.send(self.inbox(worker), envelope)
+
+    async def receive(self, worker):
+        return await self.layer.receive(self.inbox(worker))
+
+    async def flush(self):
+        if hasattr(self.layer, 'flush'):
+            await self.layer.flush()
+
+
+def make_transport(transport):
+    if transport is None or hasattr(transport, 'group_send'):
+        return transport
+    if isinstance(transport, str):
+        return import_string(transport)()
+    layer_class = import_string(transport['BACKEND'])
+    return ChannelLayerTransport(layer_class(**transport.get('CONFIG', {})))
+
+
+class LocalFanoutChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, transport=None, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.transport = make_transport(transport)
+        self.worker_id = random_name()
+        self.channels = {}
+        self.groups = {}
+        self.reader = None
+        self.stats = {'delivered': 0, 'forwarded': 0, 'encoded': 0, 'received': 0, 'dropped': 0}
+
+    def queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def owner(self, channel):
+        # specific.<worker>!<name>, None for normal channel names
+        if not channel.startswith('specific.') or '!' not in channel:
+            return None
+        return channel[len('specific.'):channel.index('!')]
+
+    def deliver(self, channel, message):
+        try:
+            self.queue(channel).put_nowait(message)
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            return False
+        self.stats['delivered'] += 1
+        return True
+
+    def encode(self, message):
+        self.stats['encoded'] += 1
+        return json.dumps({key: value for key, value in message.items() if not key.startswith('_')})
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        self.start_reader()
+        return f'specific.{self.worker_id}!{random_name()}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+
+        worker = self.owner(channel)
+        if worker is None or worker == self.worker_id or self.transport is None:
+            if not self.deliver(channel, message):
+                raise ChannelFull(channel)
+            return
+
+        self.stats['forwarded'] += 1
+        await self.transport.send(worker, {
+            'type': 'fanout.direct',
+            'origin': self.worker_id,
+            'channel': channel,
+            'payload': self.encode(message),
+        })
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self.start_reader()
+        queue = self.queue(channel)
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # consumer went away, forget its queue
+            self.channels.pop(channel, None)
+            raise
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        if self.transport is not None:
+            await self.transport.flush()
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, set()).add(channel)
+        if self.transport is not None:
+            # every join, not just the first, so transports with group expiry keep us in
+            await self.transport.group_add(group, self.worker_id)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        channels = self.groups.get(group)
+        if not channels:
+            return
+        channels.discard(channel)
+        if not channels:
+            del self.groups[group]
+            if self.transport is not None:
+                await self.transport.group_discard(group, self.worker_id)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+
+        for channel in self.groups.get(group, ()):
+            self.deliver(channel, message)
+
+        if self.transport is None:
+            return
+        workers = await self.transport.members(group)
+        if workers is not None and not workers - {self.worker_id}:
+            return
+
+        self.stats['forwarded'] += 1
+        await self.transport.group_send(group, {
+            'type': 'fanout.group',
+            'origin': self.worker_id,
+            'group': group,
+            'payload': self.encode(message),
+        }, exclude=self.worker_id)
+
+    # Transport side
+
+    def start_reader(self):
+        if self.transport is None:
+            return
+        if self.reader is not None and not self.reader.done() and self.reader.get_loop() is asyncio.get_running_loop():
+            return
+        self.reader = asyncio.ensure_future(self.read_transport())
+
+    async def read_transport(self):
+        while True:
+            envelope = await self.transport.receive(self.worker_id)
+            if envelope.get('origin') == self.worker_id:
+                continue
+            self.stats['received'] += 1
+            try:
+                message = json.loads(envelope['payload'])
+            except (KeyError, TypeError, ValueError) as e:
+                print(f'Error reading channel layer envelope: {e}')
+                continue
+
+            if envelope['type'] == 'fanout.direct':
+                self.deliver(envelope['channel'], message)
+            else:
+                for channel in self.groups.get(envelope['group'], ()):
+                    self.deliver(channel, message)
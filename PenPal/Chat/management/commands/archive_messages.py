@@ -0,0 +1,48 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from Chat.archive import archive_messages, reclaim_space, table_bytes
+from Chat.models import Message
+
+
+# Moves old messages and the ones in inactive rooms to the archive table, see Chat/archive.py
+# Run it from cron, or leave it running with --loop SECONDS as the scheduled task
+class Command(BaseCommand):
+    help = 'Archive old messages and messages from inactive chat rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None, help='days, defaults to CHAT_ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--keep', type=int, default=None, help='newest messages kept per room, CHAT_ARCHIVE_KEEP')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='only count what would move')
+        parser.add_argument('--vacuum', action='store_true', help='give the freed pages back to the disk afterwards')
+        parser.add_argument('--loop', type=int, default=None, metavar='SECONDS', help='run again every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            self.run(options)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+            close_old_connections()
+
+    def run(self, options):
+        report = archive_messages(
+            older_than_days=options['older_than'],
+            keep=options['keep'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {report['messages']} messages from {report['rooms']} rooms"))
+
+        if options['vacuum'] and not options['dry_run']:
+            reclaim_space()
+            report['bytes_after'] = table_bytes(Message)
+
+        if report['bytes_before'] is not None and report['bytes_after'] is not None:
+            reclaimed = report['bytes_before'] - report['bytes_after']
+            self.stdout.write(
+                f"Message table + indexes: {report['bytes_before'] / 1024:.0f} KB -> "
+                f"{report['bytes_after'] / 1024:.0f} KB, {reclaimed / 1024:.0f} KB reclaimed"
+            )
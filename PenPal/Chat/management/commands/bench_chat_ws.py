@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import json
+import platform
+import time
+import channels
+import django
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.utils import timezone
+from Chat.models import Language, ChatRoom
+from Chat.ratelimit import RATE_LIMITS, rate_limiter
+from Chat.routing import websockets_urlpatterns
+
+
+# Load test for the WebSocket chat path
+# N rooms x M participants all connected through ChatConsumer on an in process channel layer (--layer), everyone sends
+# chat messages (plus typing + read receipt frames unless turned off). Reports fan-out latency, throughput and
+# DB queries per message, and writes the numbers as JSON so runs can be compared between releases.
+# The socket rate limits are off unless --rate-limits, every participant sends as fast as it can and a dropped
+# message would only show up as missing deliveries
+
+LAYERS = {
+    'memory': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}}},
+    'fanout': {'default': {'BACKEND': 'Chat.layers.LocalFanoutChannelLayer', 'CONFIG': {'capacity': 100000}}},
+}
+
+
+async def next_frame(communicator, timeout):
+    # receive_from cancels the consumer when it times out, this only stops waiting so disconnect still works
+    message = await asyncio.wait_for(communicator.output_queue.get(), timeout)
+    return message.get('text')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+class QueryCounter:
+    # counts queries on every connection opened while it is installed, database_sync_to_async uses worker threads
+    def __init__(self):
+        self.counter = itertools.count()
+        self.total = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.total = next(self.counter) + 1
+        return execute(sql, params, many, context)
+
+    def connection_created(self, sender, connection, **kwargs):
+        # fires again every time a thread's connection reopens, the wrapper list stays with the connection
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = 'Load test ChatConsumer with simulated rooms and participants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--participants', type=int, default=2, help='participants per room')
+        parser.add_argument('--messages', type=int, default=20, help='chat messages per participant')
+        parser.add_argument('--interval', type=float, default=0, help='seconds between messages per participant')
+        parser.add_argument('--no-typing', action='store_true', help="don't send typing frames")
+        parser.add_argument('--no-receipts', action='store_true', help="don't send read receipts")
+        parser.add_argument('--layer', choices=sorted(LAYERS), default='memory', help='channel layer to run on')
+        parser.add_argument('--write-behind', action='store_true', help='run with CHAT_WRITE_BEHIND on')
+        parser.add_argument('--rate-limits', action='store_true', help='keep the CHAT_RATE_LIMITS socket limits on')
+        parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for deliveries')
+        parser.add_argument('--output', default='chat_ws_bench.json')
+
+    def handle(self, *args, **options):
+        language, created = Language.objects.get_or_create(name='Benchmark', defaults={'code': 'bm'})
+        rooms = self.make_rooms(language, options)
+
+        overrides = {'CHANNEL_LAYERS': LAYERS[options['layer']]}
+        if options['write_behind']:
+            overrides['CHAT_WRITE_BEHIND'] = True
+        if not options['rate_limits']:
+            overrides['CHAT_RATE_LIMITS'] = {kind: {'connection': None, 'room': None} for kind in RATE_LIMITS}
+
+        queries = QueryCounter()
+        connections.close_all()
+        connection_created.connect(queries.connection_created)
+        try:
+            with override_settings(**overrides):
+                rate_limiter.reset()
+                results = asyncio.run(self.run(rooms, options))
+                results['rate_limits'] = rate_limiter.stats()
+        finally:
+            connection_created.disconnect(queries.connection_created)
+            connections.close_all()
+            for room, users in rooms:
+                room.delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+            if created:
+                language.delete()
+
+        results['db_queries'] = queries.total
+        results['db_queries_per_message'] = queries.total / results['messages_sent'] if results['messages_sent'] else None
+        results['config'] = {key: options[key] for key in
+                             ('rooms', 'participants', 'messages', 'interval', 'no_typing', 'no_receipts', 'layer', 'write_behind',
+                              'rate_limits')}
+        results['environment'] = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'channels': channels.__version__,
+            'database': connections['default'].vendor,
+            'run_at': timezone.now().isoformat(),
+        }
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self.stdout.write(f"messages sent:      {results['messages_sent']}")
+        self.stdout.write(f"deliveries:         {results['deliveries']} / {results['expected_deliveries']}")
+        self.stdout.write(f"messages/sec:       {results['messages_per_sec']:.1f}")
+        latency = results['latency_ms']
+        if latency['p50'] is not None:
+            self.stdout.write(f"fan-out p50 / p99:  {latency['p50']:.1f} / {latency['p99']:.1f} ms")
+        self.stdout.write(f"DB queries/message: {results['db_queries_per_message']}")
+        if results['rate_limited']:
+            self.stdout.write(f"rate limited:       {results['rate_limited']}")
+        self.stdout.write(self.style.SUCCESS(f"results written to {options['output']}"))
+
+    def make_rooms(self, language, options):
+        rooms = []
+        for r in range(options['rooms']):
+            users = [User.objects.create(username=f'bench_ws_{r}_{p}') for p in range(options['participants'])]
+            room = ChatRoom.objects.create(name=f'bench_chat_ws_{r}', language=language)
+            room.people.add(*users)
+            rooms.append((room, users))
+        return rooms
+
+    async def run(self, rooms, options):
+        application = URLRouter(websockets_urlpatterns)
+        sent_at = {}
+        latencies = []
+        counts = {'deliveries': 0, 'typing': 0, 'receipts': 0, 'rate_limited': 0}
+
+        clients = []
+        for room, users in rooms:
+            for user in users:
+                communicator = WebsocketCommunicator(application, f'/ws/chat/{room.id}/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError(f'{user.username} could not connect to room {room.id}')
+                clients.append((room, user, communicator))
+
+        # drain the join notices before timing anything
+        await asyncio.sleep(0.1)
+        for room, user, communicator in clients:
+            while not await communicator.receive_nothing(timeout=0.01):
+                await communicator.receive_from()
+
+        expected = options['messages'] * options['participants']
+
+        async def read(communicator):
+            received = 0
+            while received < expected:
+                try:
+                    frame = json.loads(await next_frame(communicator, options['timeout']))
+                except asyncio.TimeoutError:
+                    return
+                if frame.get('type') == 'typing':
+                    counts['typing'] += 1
+                if frame.get('type') == 'rate_limited':
+                    counts['rate_limited'] += 1
+                if frame.get('type') != 'chat_message':
+                    continue
+                received += 1
+                counts['deliveries'] += 1
+                started = sent_at.get(frame['message'])
+                if started is not None:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                if not options['no_receipts']:
+                    counts['receipts'] += 1
+                    await communicator.send_json_to({'type': 'read_receipt', 'message_id': frame['message_id']})
+
+        async def write(room, user, communicator):
+            for i in range(options['messages']):
+                if not options['no_typing']:
+                    await communicator.send_json_to({'type': 'typing', 'is_typing': True})
+                token = f'bench {room.id} {user.id} {i}'
+                sent_at[token] = time.perf_counter()
+                await communicator.send_json_to({'type': 'chat_message', 'message': token})
+                if not options['no_typing']:
+                    await communicator.send_json_to({'type': 'typing', 'is_typing': False})
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+
+        start = time.perf_counter()
+        readers = [asyncio.ensure_future(read(communicator)) for room, user, communicator in clients]
+        await asyncio.gather(*(write(room, user, communicator) for room, user, communicator in clients))
+        await asyncio.gather(*readers)
+        elapsed = time.perf_counter() - start
+
+        for room, user, communicator in clients:
+            await communicator.disconnect()
+
+        messages_sent = len(sent_at)
+        return {
+            'messages_sent': messages_sent,
+            'deliveries': counts['deliveries'],
+            'expected_deliveries': messages_sent * options['participants'],
+            'typing_events_received': counts['typing'],
+            'read_receipts_sent': counts['receipts'],
+            'rate_limited': counts['rate_limited'],
+            'elapsed_sec': elapsed,
+            'messages_per_sec': messages_sent / elapsed if elapsed else 0,
+            'deliveries_per_sec': counts['deliveries'] / elapsed if elapsed else 0,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+        }
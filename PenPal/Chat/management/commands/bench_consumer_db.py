@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from Chat.asyncdb import percentile, get_limiter
+from Chat.cache import is_room_member, membership_cache, room_buffers
+from Chat.consumers import ChatConsumer
+from Chat.models import Language, ChatRoom, Message
+from Chat.utils import mark_read_up_to
+
+
+# ChatConsumer's database work, the database_sync_to_async path it used to have vs the async ORM + db_slot it has now
+# --sockets consumers at once each do a participant check (membership cache empty) then --events events, every
+# other one a saved message, the rest read receipts. No channel layer or socket, just the DB calls, so the
+# difference is the way they get to the database.
+#   thread  each call wrapped in database_sync_to_async, held = inside the wrapped function
+#   async   the consumer's own methods, held = inside db_slot (CHAT_DB_CONCURRENCY at a time)
+# wait is the time between asking and starting, event is the whole call.
+# The two helds aren't the same thing. Django runs every async ORM call on its one DB thread, so a slot also waits
+# there behind the other slots' queries and async held grows with --concurrency (about the same as thread at 1).
+# db is the time spent executing SQL per event, timed the same way on both paths
+
+
+class QueryTimer:
+    # an execute wrapper on every connection opened while it is installed, whichever thread runs the query
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.total += time.perf_counter() - started
+            self.count += 1
+
+    def connection_created(self, sender, connection, **kwargs):
+        # fires again each time a thread's connection reopens, the wrapper list stays with the connection
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, self)
+            self.connections.append(connection)
+
+    def uninstall(self):
+        for connection in self.connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class ThreadPath:
+    # what ChatConsumer did before the async ORM
+    def __init__(self, room, user, timings):
+        self.room_id = room.id
+        self.room = room
+        self.user = user
+        self.timings = timings
+
+    def timed(self, func):
+        asked = time.perf_counter()
+
+        def run(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.timings['waits'].append(started - asked)
+                self.timings['holds'].append(time.perf_counter() - started)
+        return database_sync_to_async(run)
+
+    async def check_room_participant(self):
+        return await self.timed(is_room_member)(self.room_id, self.user.id)
+
+    async def save_message(self, content):
+        return await self.timed(lambda: Message.objects.create(chatroom=self.room, sender=self.user, content=content))()
+
+    async def mark_messages_in_read(self, message_id):
+        await self.timed(mark_read_up_to)(self.room, self.user, message_id)
+
+
+class Command(BaseCommand):
+    help = 'Compare the consumer database path on database_sync_to_async with the async ORM one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=200)
+        parser.add_argument('--events', type=int, default=10, help='events per socket')
+        parser.add_argument('--concurrency', type=int, default=None, help='db slots, defaults to CHAT_DB_CONCURRENCY')
+        parser.add_argument('--output', default=None, help='also write the results as JSON')
+
+    def handle(self, *args, **options):
+        language, created = Language.objects.get_or_create(name='Benchmark', defaults={'code': 'bm'})
+        rooms = []
+        for r in range(max(1, options['sockets'] // 2)):
+            users = [User.objects.create(username=f'bench_db_{r}_{p}') for p in range(2)]
+            room = ChatRoom.objects.create(name=f'bench_consumer_db_{r}', language=language)
+            room.people.add(*users)
+            rooms.append((room, users))
+        sockets = [(room, user) for room, users in rooms for user in users][:options['sockets']]
+
+        overrides = {}
+        if options['concurrency']:
+            overrides['CHAT_DB_CONCURRENCY'] = options['concurrency']
+
+        results = {}
+        try:
+            with override_settings(**overrides):
+                for name in ('thread', 'async'):
+                    membership_cache.clear()
+                    room_buffers.clear()
+                    connections.close_all()
+                    queries = QueryTimer()
+                    connection_created.connect(queries.connection_created)
+                    try:
+                        results[name] = asyncio.run(self.run(name, sockets, options))
+                    finally:
+                        connection_created.disconnect(queries.connection_created)
+                        queries.uninstall()
+                    results[name]['db_ms_per_event'] = queries.total * 1000 / results[name]['events']
+                    results[name]['queries_per_event'] = queries.count / results[name]['events']
+        finally:
+            connections.close_all()
+            for room, users in rooms:
+                room.delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+            if created:
+                language.delete()
+
+        for name, row in results.items():
+            self.stdout.write(
+                f"{name:6} {row['events_per_sec']:8.0f} events/s  event p50/p99 {row['event_ms_p50']:6.2f} / "
+                f"{row['event_ms_p99']:7.2f} ms  held p50/p99 {row['hold_ms_p50']:5.2f} / {row['hold_ms_p99']:5.2f} ms  "
+                f"db {row['db_ms_per_event']:5.2f} ms/event  wait p99 {row['wait_ms_p99']:7.2f} ms"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'config': {k: options[k] for k in ('sockets', 'events', 'concurrency')}, 'results': results},
+                          f, indent=2)
+
+    async def run(self, name, sockets, options):
+        timings = {'waits': [], 'holds': []}
+        events = []
+
+        def make(room, user):
+            if name == 'thread':
+                return ThreadPath(room, user, timings)
+            consumer = ChatConsumer()
+            consumer.room_id, consumer.room, consumer.user = room.id, room, user
+            return consumer
+
+        async def socket(consumer):
+            started = time.perf_counter()
+            await consumer.check_room_participant()
+            events.append(time.perf_counter() - started)
+            last_id = 0
+            for i in range(options['events']):
+                started = time.perf_counter()
+                if i % 2 == 0:
+                    message = await consumer.save_message(f'bench {i}')
+                    last_id = message.id
+                else:
+                    await consumer.mark_messages_in_read(last_id)
+                events.append(time.perf_counter() - started)
+
+        consumers = [make(room, user) for room, user in sockets]
+        started = time.perf_counter()
+        await asyncio.gather(*(socket(consumer) for consumer in consumers))
+        elapsed = time.perf_counter() - started
+
+        if name == 'async':
+            limiter = get_limiter()
+            timings = {'waits': list(limiter.waits), 'holds': list(limiter.holds)}
+
+        events = [event * 1000 for event in events]
+        waits = [wait * 1000 for wait in timings['waits']]
+        holds = [hold * 1000 for hold in timings['holds']]
+        return {
+            'events': len(events),
+            'events_per_sec': len(events) / elapsed,
+            'event_ms_p50': percentile(events, 50),
+            'event_ms_p99': percentile(events, 99),
+            'hold_ms_p50': percentile(holds, 50),
+            'hold_ms_p99': percentile(holds, 99),
+            'wait_ms_p50': percentile(waits, 50),
+            'wait_ms_p99': percentile(waits, 99),
+        }
@@ -0,0 +1,103 @@
+import json
+import os
+import random
+import time
+from django.core.management.base import BaseCommand
+from Chat.matching import IndexEntry, rank_entries
+from Chat.scoring import CandidateSet, rank_cohort
+
+
+# Per-pair scoring vs score_matches on synthetic profiles, no database
+# The cohort is everyone learning the first language, what a class onboarding together looks like to
+# refresh_recommendations. per_pair is rank_entries, match_score's weights looped over every candidate (match_score
+# itself adds 3 queries per pair on top), it's too slow to run for a whole cohort so it's timed on --sample users
+# and scaled up. bulk is scoring.CandidateSet on one process, pool is the same split over --workers processes.
+# Every sampled user's list is checked against per_pair
+
+
+def make_entries(count, languages, rng):
+    entries = []
+    for i in range(count):
+        native = rng.randrange(languages)
+        entry = IndexEntry(
+            profile_id=i + 1,
+            user_id=i + 1,
+            native=native,
+            pro_level=rng.choice(['beginner', 'intermediate', 'advanced']),
+            is_available=rng.random() < 0.9,
+            has_bio=rng.random() < 0.5,
+            has_messaged=rng.random() < 0.3,
+        )
+        entry.learning = set(rng.sample([lang for lang in range(languages) if lang != native], rng.randrange(0, 3)))
+        entries.append(entry)
+    return entries
+
+
+class Command(BaseCommand):
+    help = 'Benchmark bulk match scoring against per-pair scoring on synthetic profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--languages', type=int, default=8)
+        parser.add_argument('--limit', type=int, default=20, help='partners kept per user')
+        parser.add_argument('--sample', type=int, default=100, help='users timed with per-pair scoring')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--output', default=None, help='also write the results as JSON')
+
+    def handle(self, *args, **options):
+        results = {}
+        for count in options['profiles']:
+            results[count] = self.run(count, options)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'config': {k: options[k] for k in ('languages', 'limit', 'sample', 'workers')},
+                           'results': results}, f, indent=2)
+
+    def run(self, count, options):
+        rng = random.Random(count)
+        language_id = 0
+        limit = options['limit']
+        entries = make_entries(count, options['languages'], rng)
+        available = [e for e in entries if e.is_available and (e.native == language_id or language_id in e.learning)]
+        cohort_entries = [e for e in entries if language_id in e.learning]
+        cohort = [(e.user_id, e.profile_id, e.native, tuple(e.learning), e.pro_level, e.is_available)
+                  for e in cohort_entries]
+
+        started = time.perf_counter()
+        candidates = CandidateSet(available)
+        load = time.perf_counter() - started
+
+        sample = rng.sample(cohort_entries, min(options['sample'], len(cohort_entries)))
+        started = time.perf_counter()
+        expected = {}
+        for me in sample:
+            others = [e for e in available if e.profile_id != me.profile_id]
+            expected[me.user_id] = [(score, e.profile_id) for score, e in rank_entries(me, others, language_id, limit)]
+        per_pair = (time.perf_counter() - started) / len(sample) * len(cohort)
+
+        started = time.perf_counter()
+        bulk_ranked = rank_cohort(candidates, cohort, language_id, limit, workers=1)
+        bulk = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pool_ranked = rank_cohort(candidates, cohort, language_id, limit, workers=options['workers'], min_pool_size=0)
+        pool = time.perf_counter() - started
+
+        mismatches = sum(1 for user_id, ranked in expected.items()
+                         if bulk_ranked[user_id] != ranked or pool_ranked[user_id] != ranked)
+        row = {
+            'cohort': len(cohort),
+            'candidates': len(candidates),
+            'load_s': load,
+            'per_pair_s': per_pair,
+            'bulk_s': bulk,
+            'pool_s': pool,
+            'sample_mismatches': mismatches,
+        }
+        self.stdout.write(
+            f"{count:>7} profiles, {row['cohort']} in the cohort x {row['candidates']} candidates: "
+            f"per-pair {per_pair:8.2f}s (est.)  bulk {bulk:6.2f}s + {load:.2f}s load  "
+            f"pool({options['workers']}) {pool:6.2f}s  ({per_pair / bulk:.0f}x / {per_pair / pool:.0f}x)  "
+            f"{mismatches} mismatches in {len(sample)} checked"
+        )
+        return row
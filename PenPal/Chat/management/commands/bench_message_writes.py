@@ -0,0 +1,78 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from Chat.models import Language, ChatRoom, Message
+from Chat.persistence import MessageWriter
+
+
+# Messages/sec for the normal per-message save vs the batching writer (each sender waits for its batch to commit)
+# Makes its own throwaway users + room and deletes them afterwards
+class Command(BaseCommand):
+    help = 'Benchmark per-message saves against batched saves'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--senders', type=int, default=10, help='concurrent senders')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--flush-ms', type=int, default=50)
+
+    def handle(self, *args, **options):
+        language, created = Language.objects.get_or_create(name='Benchmark', defaults={'code': 'bm'})
+        users = [User.objects.create(username=f'bench_writer_{i}') for i in range(2)]
+        room = ChatRoom.objects.create(name='bench_message_writes', language=language)
+        room.people.add(*users)
+
+        try:
+            direct = asyncio.run(self.run_direct(room, users[0], options))
+            batched = asyncio.run(self.run_batched(room, users[0], options))
+        finally:
+            room.delete()
+            for user in users:
+                user.delete()
+            if created:
+                language.delete()
+
+        self.stdout.write(f"per-message saves: {direct:10.1f} msg/s")
+        self.stdout.write(f"batched:           {batched:10.1f} msg/s")
+        if direct:
+            self.stdout.write(self.style.SUCCESS(f'speedup: {batched / direct:.1f}x'))
+
+    async def send_all(self, options, send_one):
+        per_sender = options['messages'] // options['senders']
+
+        async def sender(n):
+            for i in range(per_sender):
+                await send_one(f'bench {n}-{i}')
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender(n) for n in range(options['senders'])))
+        return per_sender * options['senders'], start
+
+    async def run_direct(self, room, user, options):
+        # same thing ChatConsumer.save_message does
+        def save(content):
+            room_obj = ChatRoom.objects.get(id=room.id)
+            return Message.objects.create(chatroom=room_obj, sender=user, content=content)
+
+        save_async = database_sync_to_async(save)
+        total, start = await self.send_all(options, save_async)
+        return total / (time.perf_counter() - start)
+
+    async def run_batched(self, room, user, options):
+        writer = MessageWriter(batch_size=options['batch_size'], flush_ms=options['flush_ms'])
+        count = database_sync_to_async(Message.objects.filter(chatroom=room).count)
+        before = await count()
+
+        async def submit(content):
+            await writer.submit(room.id, user, content)
+
+        total, start = await self.send_all(options, submit)
+        await writer.close()
+        elapsed = time.perf_counter() - start
+
+        written = await count() - before
+        if written != total:
+            self.stderr.write(f'only {written} of {total} batched messages were written')
+        return total / elapsed
@@ -0,0 +1,106 @@
+import json
+import random
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from Chat.models import Language, ChatRoom, Message
+from Chat.search import SqliteFtsBackend, BasicSearchBackend, get_search_backend, member_rooms
+
+
+# Search latency on a synthetic corpus
+# Builds rooms and messages (default one million) with a Zipf-ish vocabulary inside a transaction, times searches
+# for common, middling and rare words with the FTS index and with the plain icontains backend, then rolls it all back
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark message search on a synthetic corpus'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--rooms', type=int, default=2000)
+        parser.add_argument('--words', type=int, default=20000, help='vocabulary size')
+        parser.add_argument('--queries', type=int, default=30, help='queries per word class')
+        parser.add_argument('--output', default=None, help='also write the results as JSON')
+
+    def handle(self, *args, **options):
+        results = {}
+        try:
+            with transaction.atomic():
+                self.run(options, results)
+                raise Rollback
+        except Rollback:
+            pass
+
+        for name, row in results['latency_ms'].items():
+            self.stdout.write(f"{name:22} p50 {row['p50']:8.2f} ms   p99 {row['p99']:8.2f} ms")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, options, results):
+        rng = random.Random(7)
+        vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for c in range(rng.randrange(3, 10)))
+                      for w in range(options['words'])]
+        weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+        language = Language.objects.create(name='Search benchmark', code='sb')
+        users = User.objects.bulk_create([User(username=f'bench_search_{i}') for i in range(options['users'])])
+        rooms = ChatRoom.objects.bulk_create(
+            [ChatRoom(name=f'bench_search_{i}', language=language) for i in range(options['rooms'])]
+        )
+        People = ChatRoom.people.through
+        pairs = [(room, rng.sample(users, 2)) for room in rooms]
+        People.objects.bulk_create([People(chatroom=room, user=user) for room, people in pairs for user in people])
+
+        self.stdout.write(f"Writing {options['messages']} messages...")
+        started = time.perf_counter()
+        batch = []
+        for i in range(options['messages']):
+            room, people = rng.choice(pairs)
+            words = rng.choices(vocabulary, weights, k=rng.randrange(3, 20))
+            batch.append(Message(chatroom=room, sender=rng.choice(people), content=' '.join(words)))
+            if len(batch) == 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+        results['corpus_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        indexed = get_search_backend().rebuild()
+        results['index_seconds'] = time.perf_counter() - started
+        results['indexed'] = indexed
+
+        user = users[0]
+        self.stdout.write(f"{member_rooms(user).count()} rooms for the searching user, {indexed} messages indexed")
+
+        classes = {
+            'common': vocabulary[:20],
+            'middling': vocabulary[500:1500],
+            'rare': vocabulary[-5000:],
+        }
+        backends = {'fts': SqliteFtsBackend(), 'icontains': BasicSearchBackend()}
+        results['latency_ms'] = {}
+        for backend_name, backend in backends.items():
+            for class_name, words in classes.items():
+                timings = []
+                for q in range(options['queries']):
+                    query = rng.choice(words)
+                    started = time.perf_counter()
+                    backend.search(user, query, limit=21)
+                    timings.append((time.perf_counter() - started) * 1000)
+                results['latency_ms'][f'{backend_name} {class_name}'] = {
+                    'p50': percentile(timings, 50),
+                    'p99': percentile(timings, 99),
+                }
+        results['config'] = {key: options[key] for key in ('messages', 'users', 'rooms', 'words', 'queries')}
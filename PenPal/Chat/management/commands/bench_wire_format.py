@@ -0,0 +1,104 @@
+import json
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from Chat.wire import verbose_frame, frame, compact, batch
+
+
+# Bytes and CPU per fan-out for the socket formats
+#   per_recipient   what the consumer used to do, json.dumps of the event dict in every recipient's handler
+#   verbose         same frames, encoded once by the first recipient (wire.frame) and reused
+#   compact         encoded once, short arrays batched CHAT_WIRE_BATCH_SIZE events to a frame
+# Only the encoding is timed, no sockets, so runs are comparable
+
+
+def make_events(count, typing_share, rng):
+    events = []
+    for i in range(count):
+        username = f'user{rng.randrange(50)}'
+        if rng.random() < typing_share:
+            events.append({'type': 'typing_indicator', 'username': username, 'is_typing': rng.random() < 0.5})
+        else:
+            events.append({
+                'type': 'chat_message',
+                'username': username,
+                'message': ' '.join(rng.choice(['hola', 'que tal', 'bien', 'gracias', 'hasta luego', 'vale'])
+                                    for w in range(rng.randrange(1, 12))),
+                'timestamp': timezone.now().isoformat(),
+                'message_id': 100000 + i,
+            })
+    return events
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes per message and CPU per fan-out of the WebSocket frame formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20000)
+        parser.add_argument('--recipients', type=int, default=10, help='sockets each event goes to')
+        parser.add_argument('--typing-share', type=float, default=0.3, help='share of events that are typing')
+        parser.add_argument('--batch-size', type=int, default=None, help='defaults to CHAT_WIRE_BATCH_SIZE')
+        parser.add_argument('--output', default=None, help='also write the results as JSON')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or getattr(settings, 'CHAT_WIRE_BATCH_SIZE', 50)
+        recipients = options['recipients']
+        count = options['events']
+
+        def per_recipient(events):
+            frames = []
+            for event in events:
+                for r in range(recipients):
+                    frames.append(verbose_frame(event))
+            return frames
+
+        def verbose(events):
+            frames = []
+            for event in events:
+                for r in range(recipients):
+                    frames.append(frame(event))
+            return frames
+
+        def compact_batched(events):
+            frames = []
+            pending = [[] for r in range(recipients)]
+            for event in events:
+                for queue in pending:
+                    queue.append(compact(event))
+                    if len(queue) >= batch_size:
+                        frames.append(batch(queue))
+                        queue.clear()
+            frames += [batch(queue) for queue in pending if queue]
+            return frames
+
+        results = {}
+        for name, run in (('per_recipient', per_recipient), ('verbose', verbose), ('compact', compact_batched)):
+            events = make_events(count, options['typing_share'], random.Random(1))
+            started = time.process_time()
+            frames = run(events)
+            cpu = time.process_time() - started
+            sent = sum(len(f.encode()) for f in frames)
+            results[name] = {
+                'frames_per_recipient': len(frames) / recipients,
+                'bytes_per_message': sent / (count * recipients),
+                'cpu_us_per_fanout': cpu / count * 1e6,
+            }
+
+        base = results['per_recipient']
+        for name, row in results.items():
+            self.stdout.write(
+                f"{name:14} {row['bytes_per_message']:7.1f} bytes/msg  {row['cpu_us_per_fanout']:8.2f} us/fan-out  "
+                f"{row['frames_per_recipient']:8.0f} frames/socket  "
+                f"({row['bytes_per_message'] / base['bytes_per_message']:.0%} bytes, "
+                f"{row['cpu_us_per_fanout'] / base['cpu_us_per_fanout']:.0%} cpu)"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'config': {'events': count, 'recipients': recipients, 'typing_share': options['typing_share'],
+                               'batch_size': batch_size},
+                    'results': results,
+                }, f, indent=2)
@@ -0,0 +1,44 @@
+import json
+from django.core.management.base import BaseCommand
+from Chat.profiling import all_workers_summary
+from Chat.ratelimit import all_workers_rate_limits
+
+
+# Prints what the workers last published (CHAT_PROFILING has to be on in them), slowest endpoints first, then the
+# frames each worker let through or dropped for going over a rate limit
+class Command(BaseCommand):
+    help = 'Show per endpoint timings, query counts, cache hit rates and rate limit drops from the running workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='print the raw numbers as JSON')
+
+    def handle(self, *args, **options):
+        workers = all_workers_summary()
+        rate_limits = all_workers_rate_limits()
+        if options['json']:
+            self.stdout.write(json.dumps({'workers': workers, 'rate_limits': rate_limits}, indent=2))
+            return
+
+        for worker, summary in workers.items():
+            if not summary:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(worker))
+            self.stdout.write(f"{'endpoint':32} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8} {'max':>4} "
+                              f"{'db ms':>7} {'held':>7} {'cache':>6}")
+            for endpoint, row in sorted(summary.items(), key=lambda item: -item[1]['wall_ms_p99']):
+                hit_rate = '-' if row['cache_hit_rate'] is None else f"{row['cache_hit_rate']:.0%}"
+                self.stdout.write(
+                    f"{endpoint:32} {row['count']:6} {row['wall_ms_p50']:8.1f} {row['wall_ms_p99']:8.1f} "
+                    f"{row['queries_avg']:8.1f} {row['queries_max']:4} {row['query_ms_avg']:7.1f} "
+                    f"{row.get('db_hold_ms_avg', 0):7.1f} {hit_rate:>6}"
+                )
+
+        for worker, counts in rate_limits.items():
+            if not counts:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{worker} rate limits'))
+            self.stdout.write(f"{'frame':32} {'allowed':>8} {'dropped (connection)':>21} {'dropped (room)':>15}")
+            for kind, row in sorted(counts.items()):
+                self.stdout.write(
+                    f"{kind:32} {row['allowed']:8} {row['dropped_connection']:21} {row['dropped_room']:15}"
+                )
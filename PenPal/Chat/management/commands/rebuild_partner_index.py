@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from Chat.matching import rebuild_index
+
+
+# Rebuilds the whole partner matching index, use after a bulk import or if it ever drifts
+class Command(BaseCommand):
+    help = 'Rebuild the partner matching index from UserProfile data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} profiles'))
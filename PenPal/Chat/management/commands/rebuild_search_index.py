@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from Chat.search import get_search_backend
+
+
+# Refills the message search index from the message table, for after restoring a backup or switching backends
+class Command(BaseCommand):
+    help = 'Rebuild the message search index'
+
+    def handle(self, *args, **options):
+        total = get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} messages'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from Chat.stats import rebuild_user_stats
+
+
+# Recomputes UserStats from messages and chat rooms, for all users or just the ones given
+class Command(BaseCommand):
+    help = 'Rebuild the per user activity stats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        total = rebuild_user_stats(options['user_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt stats for {total} users'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from Chat.counters import reconcile_counters
+
+
+# Recounts the landing page totals, meant to run from cron every so often
+class Command(BaseCommand):
+    help = 'Recount the site wide counters shown on the home page'
+
+    def handle(self, *args, **options):
+        for key, total in reconcile_counters().items():
+            self.stdout.write(f'{key}: {total}')
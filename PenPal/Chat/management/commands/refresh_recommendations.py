@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from Chat.recommendations import refresh_recommendations
+
+
+# Background worker for the stored partner lists, see Chat/recommendations.py
+# Run it from cron, or leave it running with --loop SECONDS
+class Command(BaseCommand):
+    help = 'Recompute the stored partner lists that are missing, marked stale or too old'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='recompute every list, not just the pending ones')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='scoring processes for big cohorts, defaults to CHAT_SCORING_WORKERS or the CPU count')
+        parser.add_argument('--loop', type=int, default=None, metavar='SECONDS', help='run again every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            report = refresh_recommendations(full=options['all'], batch_size=options['batch_size'],
+                                             workers=options['workers'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Refreshed {report['refreshed']} lists in {report['languages']} languages, "
+                f"pruned {report['pruned']} rows ({time.perf_counter() - started:.1f}s)"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+            close_old_connections()
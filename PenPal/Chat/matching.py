@@ -0,0 +1,282 @@
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_init, pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import UserProfile, Message, ArchivedMessage, PartnerIndex
+from .signals import messages_bulk_created, room_messages_deleted, room_deleting
+from .scoring import CandidateSet, rank_cohort
+
+
+# Match engine for partner_list
+# match_score in utils.py does 3 queries per candidate, this scores the whole candidate pool
+# from PartnerIndex with one query and does the rest in memory. Scores + ordering are the same as match_score
+
+
+# Index upkeep
+
+def build_index_rows(profile, learn_ids=None, has_messaged=None):
+    if learn_ids is None:
+        learn_ids = list(profile.learn_lang.values_list('id', flat=True))
+    if has_messaged is None:
+        has_messaged = (Message.objects.filter(sender_id=profile.user_id).exists()
+                        or ArchivedMessage.objects.filter(sender_id=profile.user_id).exists())
+
+    # profile not learning anything still needs a row so it shows up as a native speaker
+    return [
+        PartnerIndex(
+            profile=profile,
+            native_lang_id=profile.native_lang_id,
+            learn_lang_id=lang_id,
+            pro_level=profile.pro_level,
+            is_available=profile.is_available,
+            has_bio=bool(profile.bio),
+            has_messaged=has_messaged,
+        )
+        for lang_id in (learn_ids or [None])
+    ]
+
+
+def refresh_profile(profile):
+    PartnerIndex.objects.filter(profile=profile).delete()
+    PartnerIndex.objects.bulk_create(build_index_rows(profile))
+
+
+def rebuild_index(batch_size=500):
+    PartnerIndex.objects.all().delete()
+
+    messaged = set(Message.objects.values_list('sender_id', flat=True).distinct())
+    messaged |= set(ArchivedMessage.objects.values_list('sender_id', flat=True).distinct())
+    profiles = UserProfile.objects.prefetch_related('learn_lang').order_by('id')
+
+    rows = []
+    total = 0
+    for profile in profiles.iterator(chunk_size=batch_size):
+        learn_ids = [lang.id for lang in profile.learn_lang.all()]
+        rows.extend(build_index_rows(profile, learn_ids, profile.user_id in messaged))
+        total += 1
+        if len(rows) >= batch_size:
+            PartnerIndex.objects.bulk_create(rows)
+            rows = []
+    PartnerIndex.objects.bulk_create(rows)
+    return total
+
+
+# Signals to keep the index incremental
+
+SCORED_FIELDS = ('native_lang_id', 'pro_level', 'is_available', 'bio')
+
+
+def scored_fields(profile):
+    # read from __dict__, a deferred field isn't in it (that's how get_deferred_fields tells) and reading it would
+    # query and build another profile, which comes back through post_init. None when one isn't loaded
+    values = profile.__dict__
+    if any(field not in values for field in SCORED_FIELDS):
+        return None
+    return (values['native_lang_id'], values['pro_level'], values['is_available'], bool(values['bio']))
+
+
+@receiver(post_init, sender=UserProfile)
+def index_profile_loaded(sender, instance, **kwargs):
+    instance._scored_fields = scored_fields(instance)
+
+
+@receiver(pre_save, sender=UserProfile)
+def index_profile_saving(sender, instance, **kwargs):
+    # the profile gets saved with every User save (last_login too), post_save receivers only redo their work when
+    # something match scoring reads changed. Without both snapshots there's no telling, so it counts as changed
+    fields = scored_fields(instance)
+    previous = getattr(instance, '_scored_fields', None)
+    instance._scored_changed = fields is None or previous is None or fields != previous
+    instance._scored_fields = fields
+
+
+@receiver(post_save, sender=UserProfile)
+def index_profile_saved(sender, instance, created, **kwargs):
+    if created or instance._scored_changed:
+        refresh_profile(instance)
+
+
+@receiver(m2m_changed, sender=UserProfile.learn_lang.through)
+def index_learn_lang_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        refresh_profile(instance)
+        return
+
+    # language.learners.add/remove(...) , instance is the Language here
+    if action == 'post_clear':
+        profile_ids = PartnerIndex.objects.filter(learn_lang=instance).values_list('profile_id', flat=True)
+    else:
+        profile_ids = pk_set or []
+    for profile in UserProfile.objects.filter(id__in=list(profile_ids)):
+        refresh_profile(profile)
+
+
+@receiver(post_save, sender=Message)
+def index_message_sent(sender, instance, created, **kwargs):
+    if created:
+        PartnerIndex.objects.filter(profile__user_id=instance.sender_id, has_messaged=False).update(has_messaged=True)
+
+
+@receiver(messages_bulk_created)
+def index_messages_bulk_sent(sender, messages, **kwargs):
+    sender_ids = {message.sender_id for message in messages}
+    PartnerIndex.objects.filter(profile__user_id__in=sender_ids, has_messaged=False).update(has_messaged=True)
+
+
+@receiver(post_delete, sender=Message)
+def index_message_deleted(sender, instance, **kwargs):
+    if room_deleting(instance.chatroom_id):
+        return
+    if (not Message.objects.filter(sender_id=instance.sender_id).exists()
+            and not ArchivedMessage.objects.filter(sender_id=instance.sender_id).exists()):
+        PartnerIndex.objects.filter(profile__user_id=instance.sender_id).update(has_messaged=False)
+
+
+@receiver(room_messages_deleted)
+def index_room_messages_deleted(sender, senders, **kwargs):
+    gone = set(senders)
+    for model in (Message, ArchivedMessage):
+        gone -= set(model.objects.filter(sender_id__in=gone).order_by().values_list('sender_id', flat=True).distinct())
+    if gone:
+        PartnerIndex.objects.filter(profile__user_id__in=gone).update(has_messaged=False)
+
+
+# Ranking
+
+class IndexEntry:
+    __slots__ = ('profile_id', 'user_id', 'native', 'learning', 'pro_level', 'is_available', 'has_bio', 'has_messaged')
+
+    def __init__(self, profile_id, user_id, native, pro_level, is_available, has_bio, has_messaged):
+        self.profile_id = profile_id
+        self.user_id = user_id
+        self.native = native
+        self.learning = set()
+        self.pro_level = pro_level
+        self.is_available = is_available
+        self.has_bio = has_bio
+        self.has_messaged = has_messaged
+
+
+def load_entries(rows):
+    entries = {}
+    for profile_id, user_id, native, learn, pro_level, available, has_bio, has_messaged in rows:
+        entry = entries.get(profile_id)
+        if entry is None:
+            entry = entries[profile_id] = IndexEntry(profile_id, user_id, native, pro_level, available, has_bio, has_messaged)
+        if learn is not None:
+            entry.learning.add(learn)
+    return entries
+
+
+ENTRY_FIELDS = ('profile_id', 'profile__user_id', 'native_lang_id', 'learn_lang_id',
+                'pro_level', 'is_available', 'has_bio', 'has_messaged')
+
+
+def candidate_entries(user, language_id):
+    # every row for the user + every row of anyone available who speaks or learns the language, one query
+    candidates = PartnerIndex.objects.filter(
+        Q(native_lang_id=language_id) | Q(learn_lang_id=language_id),
+        is_available=True,
+    ).values('profile_id')
+    own_profile = UserProfile.objects.filter(user_id=user.id).values('id')
+    rows = PartnerIndex.objects.filter(
+        Q(profile_id__in=candidates) | Q(profile_id__in=own_profile)
+    ).values_list(*ENTRY_FIELDS)
+
+    entries = load_entries(rows)
+    me = None
+    for entry in entries.values():
+        if entry.user_id == user.id:
+            me = entry
+            break
+    if me is None:
+        return None, []
+    others = [e for e in entries.values() if e.profile_id != me.profile_id and e.is_available]
+    return me, others
+
+
+def filter_partners(me, others, language_id):
+    # same pools as find_lang_partners: ideal exchange partners first, broader matches only if there are none
+    if me.native is None:
+        ideal = [e for e in others if e.native == language_id and not e.learning]
+    else:
+        ideal = [e for e in others if e.native == language_id and me.native in e.learning]
+    if ideal:
+        return ideal
+    return [e for e in others if e.native == language_id or language_id in e.learning]
+
+
+def score_entries(me, entries):
+    # same weights as match_score
+    both_available = 15 if me.is_available else 0
+    scores = []
+    for e in entries:
+        score = both_available
+        if e.native in me.learning and me.native in e.learning:
+            score += 50
+        if e.pro_level == me.pro_level:
+            score += 20
+        if e.has_bio:
+            score += 10
+        if e.has_messaged:
+            score += 5
+        scores.append(min(score, 100))
+    return scores
+
+
+def rank_entries(me, others, language_id, limit=20):
+    pool = filter_partners(me, others, language_id)
+    ranked = sorted(zip(score_entries(me, pool), pool), key=lambda x: (-x[0], x[1].profile_id))
+    return ranked[:limit] if limit else ranked
+
+
+def rank_partners(user, language, limit=20):
+    language_id = getattr(language, 'id', language)
+    me, others = candidate_entries(user, language_id)
+    if me is None:
+        return []
+
+    ranked = rank_entries(me, others, language_id, limit)
+
+    profiles = UserProfile.objects.select_related('user', 'native_lang').in_bulk([e.profile_id for _, e in ranked])
+    return [{'profile': profiles[e.profile_id], 'score': score} for score, e in ranked if e.profile_id in profiles]
+
+
+# Bulk scoring for a cohort (a class signing up together, refresh_recommendations), see scoring.py
+
+def language_entries(language_id):
+    # everyone who could be a partner in this language, same pool as candidate_entries
+    candidates = PartnerIndex.objects.filter(
+        Q(native_lang_id=language_id) | Q(learn_lang_id=language_id),
+        is_available=True,
+    ).values('profile_id')
+    return load_entries(PartnerIndex.objects.filter(profile_id__in=candidates).values_list(*ENTRY_FIELDS))
+
+
+def user_entries(user_ids, chunk_size=2000):
+    # chunked so a big cohort stays under the database's parameter limit
+    found = {}
+    for start in range(0, len(user_ids), chunk_size):
+        rows = PartnerIndex.objects.filter(profile__user_id__in=user_ids[start:start + chunk_size])
+        for entry in load_entries(rows.values_list(*ENTRY_FIELDS)).values():
+            found[entry.user_id] = entry
+    return found
+
+
+def score_matches(users, language, limit=20, workers=None):
+    # {user_id: [(score, profile_id), ...]} best first, the same lists rank_partners gives one user at a time.
+    # Two queries for the whole cohort (one more per 2000 users), users without a profile are left out
+    language_id = getattr(language, 'id', language)
+    user_ids = [getattr(user, 'id', user) for user in users]
+    candidates = CandidateSet(entry for entry in language_entries(language_id).values() if entry.is_available)
+    cohort = [
+        (entry.user_id, entry.profile_id, entry.native, tuple(entry.learning), entry.pro_level, entry.is_available)
+        for entry in user_entries(user_ids).values()
+    ]
+    if workers is None:
+        workers = getattr(settings, 'CHAT_SCORING_WORKERS', None)
+    return rank_cohort(candidates, cohort, language_id, limit, workers,
+                       getattr(settings, 'CHAT_SCORING_POOL_MIN', 5000))
@@ -0,0 +1,58 @@
+# Generated by Django 5.2 on 2026-10-18 19:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_partner_index(apps, schema_editor):
+    UserProfile = apps.get_model('Chat', 'UserProfile')
+    Message = apps.get_model('Chat', 'Message')
+    PartnerIndex = apps.get_model('Chat', 'PartnerIndex')
+
+    messaged = set(Message.objects.values_list('sender_id', flat=True).distinct())
+    rows = []
+    for profile in UserProfile.objects.prefetch_related('learn_lang'):
+        learn_ids = [lang.id for lang in profile.learn_lang.all()] or [None]
+        for lang_id in learn_ids:
+            rows.append(PartnerIndex(
+                profile_id=profile.id,
+                native_lang_id=profile.native_lang_id,
+                learn_lang_id=lang_id,
+                pro_level=profile.pro_level,
+                is_available=profile.is_available,
+                has_bio=bool(profile.bio),
+                has_messaged=profile.user_id in messaged,
+            ))
+    PartnerIndex.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='is_available',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='PartnerIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pro_level', models.CharField(max_length=25)),
+                ('is_available', models.BooleanField(default=True)),
+                ('has_bio', models.BooleanField(default=False)),
+                ('has_messaged', models.BooleanField(default=False)),
+                ('learn_lang', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='Chat.language')),
+                ('native_lang', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Chat.language')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partner_index', to='Chat.userprofile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['native_lang', 'learn_lang', 'pro_level', 'is_available', 'has_bio', 'has_messaged'], name='partner_idx_native_learn'), models.Index(fields=['learn_lang', 'is_available'], name='partner_idx_learn')],
+            },
+        ),
+        migrations.RunPython(fill_partner_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 19:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0002_partner_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', '-timestamp', '-id'], name='message_room_history'),
+        ),
+    ]
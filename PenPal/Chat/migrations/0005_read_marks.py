@@ -0,0 +1,74 @@
+# Generated by Django 5.2 on 2026-10-18 19:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def is_read_to_marks(apps, schema_editor):
+    # each participant's mark is the newest message from someone else that was flagged is_read
+    ChatRoom = apps.get_model('Chat', 'ChatRoom')
+    Message = apps.get_model('Chat', 'Message')
+    ReadMark = apps.get_model('Chat', 'ReadMark')
+
+    marks = []
+    for room in ChatRoom.objects.prefetch_related('people'):
+        for person in room.people.all():
+            last_read = Message.objects.filter(
+                chatroom=room, is_read=True
+            ).exclude(sender=person).aggregate(top=models.Max('id'))['top']
+            if last_read:
+                marks.append(ReadMark(chatroom=room, user=person, last_read_id=last_read))
+    ReadMark.objects.bulk_create(marks, batch_size=500)
+
+
+def marks_to_is_read(apps, schema_editor):
+    Message = apps.get_model('Chat', 'Message')
+    ReadMark = apps.get_model('Chat', 'ReadMark')
+
+    for mark in ReadMark.objects.all():
+        Message.objects.filter(
+            chatroom_id=mark.chatroom_id, id__lte=mark.last_read_id
+        ).exclude(sender_id=mark.user_id).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0004_message_writer'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadMark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'id'], name='message_room_id'),
+        ),
+        migrations.AddField(
+            model_name='readmark',
+            name='chatroom',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_marks', to='Chat.chatroom'),
+        ),
+        migrations.AddField(
+            model_name='readmark',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_marks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readmark',
+            constraint=models.UniqueConstraint(fields=('chatroom', 'user'), name='unique_read_mark'),
+        ),
+        migrations.RunPython(is_read_to_marks, marks_to_is_read),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2 on 2026-10-18 19:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_user_stats(apps, schema_editor):
+    ChatRoom = apps.get_model('Chat', 'ChatRoom')
+    Message = apps.get_model('Chat', 'Message')
+    UserStats = apps.get_model('Chat', 'UserStats')
+
+    rows = {}
+    messages = Message.objects.order_by().values('sender').annotate(
+        total=models.Count('id'), first=models.Min('timestamp'), last=models.Max('timestamp'))
+    for row in messages:
+        rows[row['sender']] = UserStats(user_id=row['sender'], messages_sent=row['total'],
+                                        first_message_at=row['first'], last_active=row['last'])
+    for row in ChatRoom.people.through.objects.order_by().values('user').annotate(total=models.Count('id')):
+        rows.setdefault(row['user'], UserStats(user_id=row['user'])).chats_joined = row['total']
+    UserStats.objects.bulk_create(rows.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0005_read_marks'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('messages_sent', models.PositiveIntegerField(default=0)),
+                ('chats_joined', models.PositiveIntegerField(default=0)),
+                ('first_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_active', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_user_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 19:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0006_user_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['is_active', '-updated_at'], name='room_active_recent'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['language', 'is_active', '-updated_at'], name='room_language_active'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'timestamp'], name='message_sender_time'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.2 on 2026-10-18 19:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_duplicate_rooms(apps, schema_editor):
+    # set the pair key on every two person room, then fold duplicates of the same pair + language
+    # into the oldest room, moving their messages and read marks over
+    ChatRoom = apps.get_model('Chat', 'ChatRoom')
+    Message = apps.get_model('Chat', 'Message')
+    ReadMark = apps.get_model('Chat', 'ReadMark')
+    UserStats = apps.get_model('Chat', 'UserStats')
+
+    people = {}
+    for room_id, user_id in ChatRoom.people.through.objects.values_list('chatroom_id', 'user_id'):
+        people.setdefault(room_id, []).append(user_id)
+
+    keepers = {}
+    affected_users = set()
+    for room in ChatRoom.objects.order_by('id'):
+        members = people.get(room.id, [])
+        if len(members) != 2:
+            continue
+        key = (min(members), max(members), room.language_id)
+        keeper = keepers.get(key)
+        if keeper is None:
+            ChatRoom.objects.filter(id=room.id).update(pair_low=key[0], pair_high=key[1])
+            keepers[key] = room
+            continue
+
+        Message.objects.filter(chatroom=room).update(chatroom=keeper)
+        for mark in ReadMark.objects.filter(chatroom=room):
+            existing = ReadMark.objects.filter(chatroom=keeper, user_id=mark.user_id).first()
+            if existing is None:
+                ReadMark.objects.create(chatroom=keeper, user_id=mark.user_id, last_read_id=mark.last_read_id)
+            elif existing.last_read_id < mark.last_read_id:
+                existing.last_read_id = mark.last_read_id
+                existing.save(update_fields=['last_read_id'])
+        # update() so auto_now doesn't stamp the merge time over the real last activity
+        keeper.updated_at = max(room.updated_at, keeper.updated_at)
+        keeper.is_active = keeper.is_active or room.is_active
+        ChatRoom.objects.filter(id=keeper.id).update(updated_at=keeper.updated_at, is_active=keeper.is_active)
+        room.delete()
+        affected_users.update(members)
+
+    for user_id in affected_users:
+        UserStats.objects.filter(user_id=user_id).update(
+            chats_joined=ChatRoom.people.through.objects.filter(user_id=user_id).count()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0007_hot_path_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='pair_high',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='pair_low',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_rooms, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.UniqueConstraint(fields=('pair_low', 'pair_high', 'language'), name='unique_room_pair'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 19:52
+
+from django.db import migrations
+
+
+# FTS5 table for Chat.search, only on SQLite, other databases use BasicSearchBackend (or their own backend).
+# The room goes in as a token (r<id>) so the search can limit itself to the user's rooms inside MATCH
+
+def create_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Message = apps.get_model('Chat', 'Message')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+        "content, room, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    schema_editor.execute(
+        f"INSERT INTO chat_message_fts (rowid, content, room) "
+        f"SELECT id, content, 'r' || chatroom_id FROM {Message._meta.db_table}"
+    )
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0008_room_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 19:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0009_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='Chat.chatroom')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['chatroom', '-timestamp', '-id'], name='archive_room_history'), models.Index(fields=['sender', 'timestamp'], name='archive_sender_time')],
+            },
+        ),
+    ]
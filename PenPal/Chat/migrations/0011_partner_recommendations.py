@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 20:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0010_message_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartnerRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.PositiveSmallIntegerField(default=0)),
+                ('computed_at', models.DateTimeField()),
+                ('stale', models.BooleanField(default=False)),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='Chat.language')),
+                ('partner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='recommended_to', to='Chat.userprofile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partner_recommendations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stale'], name='recommendation_stale'), models.Index(fields=['computed_at'], name='recommendation_computed')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'language', 'rank'), name='recommendation_unique_rank')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-18 20:48
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chat', '0011_partner_recommendations'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatroom',
+            name='room_active_recent',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatroom',
+            name='room_language_active',
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
 # Create your models here.
 # Language selection
@@ -34,6 +35,7 @@ class UserProfile(models.Model):
                                  choices=PROFICIENCY_CHOICES,
                                  default='beginner')
     bio = models.TextField(blank=True)
+    is_available = models.BooleanField(default=True)
     def __str__(self):
         return self.user.username
 
@@ -57,6 +59,11 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # canonical key for two person rooms, lower + higher user id, see get_or_create_chatroom
+    pair_low = models.BigIntegerField(null=True, blank=True)
+    pair_high = models.BigIntegerField(null=True, blank=True)
+    # messages moved to ArchivedMessage, history only looks there when this isn't 0
+    archived_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -66,6 +73,10 @@ class ChatRoom(models.Model):
 
     class Meta:
         ordering = ['-updated_at']
+        constraints = [
+            # one room per pair of users per language
+            models.UniqueConstraint(fields=['pair_low', 'pair_high', 'language'], name='unique_room_pair'),
+        ]
 
 
 # Individual messages in a chat room
@@ -77,11 +88,147 @@ class Message(models.Model):
     content = models.TextField()
     def content_preview(self):
         return self.content[:50]
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # default instead of auto_now_add so the write-behind writer can stamp messages before they are saved
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
     class Meta:
-        ordering = ['-timestamp']
\ No newline at end of file
+        ordering = ['-timestamp']
+        indexes = [
+            # history pagination walks this newest first, see get_message_page in utils.py
+            models.Index(fields=['chatroom', '-timestamp', '-id'], name='message_room_history'),
+            # unread counts are id > last_read_id within a room
+            models.Index(fields=['chatroom', 'id'], name='message_room_id'),
+            # per sender counts and first/last message times for UserStats
+            models.Index(fields=['sender', 'timestamp'], name='message_sender_time'),
+        ]
+
+
+# Old messages moved out of Message by Chat/archive.py (manage.py archive_messages), same ids as before
+# so cursors and read marks keep working. get_message_page reads them back after the room's hot messages
+class ArchivedMessage(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    chatroom = models.ForeignKey(ChatRoom,
+                                  on_delete=models.CASCADE,
+                                  related_name='archived_messages')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_messages')
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sender.username}: {self.content[:50]}"
+
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['chatroom', '-timestamp', '-id'], name='archive_room_history'),
+            models.Index(fields=['sender', 'timestamp'], name='archive_sender_time'),
+        ]
+
+
+# Partner matching index, one row per (profile, learning language) so ranking never touches the M2M table
+# profiles not learning anything still get one row with learn_lang = None. Kept in sync by Chat/matching.py
+class PartnerIndex(models.Model):
+    profile = models.ForeignKey(UserProfile,
+                                on_delete=models.CASCADE,
+                                related_name='partner_index')
+    native_lang = models.ForeignKey(Language,
+                                    on_delete=models.SET_NULL,
+                                    null=True,
+                                    related_name='+')
+    learn_lang = models.ForeignKey(Language,
+                                   on_delete=models.CASCADE,
+                                   null=True,
+                                   related_name='+')
+    pro_level = models.CharField(max_length=25)
+    is_available = models.BooleanField(default=True)
+    has_bio = models.BooleanField(default=False)
+    has_messaged = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.profile_id}: {self.native_lang_id} -> {self.learn_lang_id}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['native_lang', 'learn_lang', 'pro_level', 'is_available', 'has_bio', 'has_messaged'],
+                         name='partner_idx_native_learn'),
+            models.Index(fields=['learn_lang', 'is_available'], name='partner_idx_learn'),
+        ]
+
+
+# Precomputed partner_list, the top partners for a user browsing a language, one row per place.
+# A user with no partners gets a single row with no partner so the list doesn't look missing
+class PartnerRecommendation(models.Model):
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='partner_recommendations')
+    language = models.ForeignKey(Language,
+                                 on_delete=models.CASCADE,
+                                 related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    partner = models.ForeignKey(UserProfile,
+                                on_delete=models.CASCADE,
+                                null=True,
+                                related_name='recommended_to')
+    score = models.PositiveSmallIntegerField(default=0)
+    computed_at = models.DateTimeField()
+    stale = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.user_id} / {self.language_id} #{self.rank}: {self.partner_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'language', 'rank'], name='recommendation_unique_rank'),
+        ]
+        indexes = [
+            models.Index(fields=['stale'], name='recommendation_stale'),
+            models.Index(fields=['computed_at'], name='recommendation_computed'),
+        ]
+
+
+# Small named counters, the site totals in counters.py
+class Counter(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+# Read receipts, the newest message a user has read in a room
+# everything after it that someone else sent is unread
+class ReadMark(models.Model):
+    chatroom = models.ForeignKey(ChatRoom,
+                                 on_delete=models.CASCADE,
+                                 related_name='read_marks')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_marks')
+    last_read_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id} read {self.chatroom_id} up to {self.last_read_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chatroom', 'user'], name='unique_read_mark'),
+        ]
+
+
+# Per user activity rollup for the dashboard, profile page and matching
+# Kept up to date by Chat/stats.py so none of them have to count messages/rooms
+class UserStats(models.Model):
+    user = models.OneToOneField(User,
+                                on_delete=models.CASCADE,
+                                primary_key=True,
+                                related_name='stats')
+    messages_sent = models.PositiveIntegerField(default=0)
+    chats_joined = models.PositiveIntegerField(default=0)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_active = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.messages_sent} messages, {self.chats_joined} chats"
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import ChatRoom, Message
+from .signals import messages_bulk_created
+from .asyncdb import db_slot
+
+
+# Batched message persistence (opt in with CHAT_WRITE_BEHIND = True in settings)
+# Messages from every socket in the process wait in a bounded queue and get written together with bulk_create
+# every CHAT_WRITE_BATCH_SIZE messages or CHAT_WRITE_FLUSH_MS, whichever first. submit() gives the message back
+# once its batch is committed, with the id the database gave it, so ids keep meaning "newer" across workers
+# (read marks, resume and the archive all go by id) and nothing gets broadcast that isn't saved.
+# When the queue is full submit() waits, that is the backpressure on the sockets.
+# A batch that fails is tried again CHAT_WRITE_RETRIES times, after that every sender in it gets WriteFailed
+
+logger = logging.getLogger(__name__)
+
+
+class WriteFailed(Exception):
+    pass
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def write_batch(messages):
+    # one timestamp per batch, so inside a batch time and id order agree
+    now = timezone.now()
+    for message in messages:
+        message.timestamp = now
+
+    bulk = connection.features.can_return_rows_from_bulk_insert
+    with transaction.atomic():
+        if bulk:
+            Message.objects.bulk_create(messages)
+        else:
+            # no RETURNING (MySQL), the ids only come back from one insert each. post_save runs for these
+            for message in messages:
+                message.save(force_insert=True)
+        # rooms get one updated_at bump per batch instead of one per message
+        room_ids = {message.chatroom_id for message in messages}
+        ChatRoom.objects.filter(id__in=room_ids).update(updated_at=now)
+
+    if bulk:
+        try:
+            messages_bulk_created.send(sender=Message, messages=messages)
+        except Exception:
+            # the messages are saved, writing them again would duplicate them. The derived tables catch up with
+            # their rebuild / reconcile commands
+            logger.exception('Error updating derived data for a message batch')
+
+
+class MessageWriter:
+    def __init__(self, batch_size=None, flush_ms=None, max_pending=None, retries=None):
+        self.batch_size = batch_size or getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+        self.flush_interval = (flush_ms or getattr(settings, 'CHAT_WRITE_FLUSH_MS', 50)) / 1000
+        self.retries = retries if retries is not None else getattr(settings, 'CHAT_WRITE_RETRIES', 2)
+
+        self.queue = asyncio.Queue(maxsize=max_pending or getattr(settings, 'CHAT_WRITE_MAX_PENDING', 5000))
+        self.task = None
+
+        self.written = 0
+        self.batches = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def submit(self, room_id, sender, content):
+        # the saved message, or WriteFailed
+        message = Message(chatroom_id=room_id, sender=sender, content=content)
+        saved = asyncio.get_running_loop().create_future()
+        self.start()
+        await self.queue.put((message, saved))
+        return await saved
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def write(self, batch):
+        messages = [message for message, saved in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                async with db_slot():
+                    await sync_to_async(write_batch)(messages)
+                break
+            except Exception as e:
+                if attempt < self.retries:
+                    self.retried += 1
+                    logger.warning('Error saving message batch, trying again: %s', e)
+                    await asyncio.sleep(0.05 * 2 ** attempt)
+                    continue
+                self.failed += len(batch)
+                logger.exception('Error saving message batch, %d messages not saved', len(batch))
+                for message, saved in batch:
+                    if not saved.done():
+                        saved.set_exception(WriteFailed(str(e)))
+                return
+
+        self.written += len(batch)
+        self.batches += 1
+        for message, saved in batch:
+            if not saved.done():
+                saved.set_result(message)
+
+    async def flush(self):
+        # waits until everything submitted so far is written
+        if self.task is not None:
+            await self.queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# one writer per event loop, asyncio queues can't be shared between loops
+writers = weakref.WeakKeyDictionary()
+
+
+def get_writer():
+    loop = asyncio.get_running_loop()
+    writer = writers.get(loop)
+    if writer is None:
+        writer = writers[loop] = MessageWriter()
+    return writer
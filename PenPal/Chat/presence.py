@@ -0,0 +1,231 @@
+import asyncio
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Typing indicators
+# The client sends a typing frame on keystrokes, we only fan out when someone actually starts or stops typing,
+# at most once per CHAT_TYPING_INTERVAL seconds per user (a change inside the window goes out at the end of it),
+# and send the stop ourselves if nothing comes in for CHAT_TYPING_TIMEOUT seconds
+
+class TypingState:
+    __slots__ = ('wanted', 'sent', 'last_sent', 'pending', 'expire', 'send')
+
+    def __init__(self, send):
+        self.wanted = False
+        self.sent = False
+        self.last_sent = None
+        self.pending = None
+        self.expire = None
+        self.send = send
+
+
+class TypingTracker:
+    def __init__(self, interval=None, timeout=None):
+        self.interval = interval if interval is not None else getattr(settings, 'CHAT_TYPING_INTERVAL', 1.0)
+        self.timeout = timeout if timeout is not None else getattr(settings, 'CHAT_TYPING_TIMEOUT', 5.0)
+        self.states = {}
+        self.frames_received = 0
+        self.events_sent = 0
+
+    # send is an async function taking is_typing that does the actual group_send
+    async def update(self, room_id, user_id, is_typing, send):
+        self.frames_received += 1
+        key = (room_id, user_id)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = TypingState(send)
+        state.send = send
+        state.wanted = bool(is_typing)
+
+        loop = asyncio.get_running_loop()
+        if state.expire is not None:
+            state.expire.cancel()
+            state.expire = None
+        if state.wanted:
+            state.expire = loop.call_later(self.timeout, self.expired, key)
+
+        if state.wanted == state.sent or state.pending is not None:
+            return
+
+        wait = 0 if state.last_sent is None else state.last_sent + self.interval - loop.time()
+        if wait > 0:
+            state.pending = loop.call_later(wait, self.deferred, key)
+        else:
+            await self.broadcast(key, state)
+
+    async def stop(self, room_id, user_id):
+        # on disconnect, makes sure the others don't see us typing forever
+        key = (room_id, user_id)
+        state = self.states.pop(key, None)
+        if state is None:
+            return
+        for handle in (state.pending, state.expire):
+            if handle is not None:
+                handle.cancel()
+        if state.sent:
+            self.events_sent += 1
+            await state.send(False)
+
+    async def broadcast(self, key, state):
+        state.sent = state.wanted
+        state.last_sent = asyncio.get_running_loop().time()
+        self.events_sent += 1
+        await state.send(state.sent)
+        self.cleanup(key, state)
+
+    def deferred(self, key):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.pending = None
+        if state.wanted != state.sent:
+            asyncio.ensure_future(self.broadcast(key, state))
+
+    def expired(self, key):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.expire = None
+        state.wanted = False
+        if state.sent and state.pending is None:
+            asyncio.ensure_future(self.broadcast(key, state))
+
+    def cleanup(self, key, state):
+        # idle users don't need to stay in memory once the interval has passed
+        if not state.sent and state.pending is None and state.expire is None:
+            loop = asyncio.get_running_loop()
+            state.pending = loop.call_later(self.interval, self.forget_idle, key)
+
+    def forget_idle(self, key):
+        state = self.states.get(key)
+        if state is not None and not state.sent and not state.wanted and state.expire is None:
+            del self.states[key]
+        elif state is not None:
+            state.pending = None
+            if state.wanted != state.sent:
+                asyncio.ensure_future(self.broadcast(key, state))
+
+    def stats(self):
+        return {
+            'frames_received': self.frames_received,
+            'events_sent': self.events_sent,
+            'tracked': len(self.states),
+        }
+
+
+typing_tracker = TypingTracker()
+
+
+# Presence
+# Connection counts live in the Django cache so every worker (and the plain views) see the same numbers:
+# chat:presence:<room>:<user> per room and chat:online:<user> across all rooms. Only the 0 -> 1 and 1 -> 0 moves
+# of the room count get broadcast, so extra tabs and reconnects are silent. Each process touches the keys for
+# its own connections every CHAT_PRESENCE_HEARTBEAT seconds, if a worker dies they run out after CHAT_PRESENCE_TTL
+
+def room_key(room_id, user_id):
+    return f'chat:presence:{room_id}:{user_id}'
+
+
+def user_key(user_id):
+    return f'chat:online:{user_id}'
+
+
+class PresenceRegistry:
+    def __init__(self, ttl=None, heartbeat=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+        self.heartbeat = heartbeat if heartbeat is not None else getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 20)
+        self.local = {}
+        self.pulse = None
+        self.transitions = 0
+
+    async def increment(self, key):
+        if await cache.aadd(key, 1, self.ttl):
+            return 1
+        try:
+            count = await cache.aincr(key)
+        except ValueError:
+            # ran out between the add and the incr
+            await cache.aadd(key, 1, self.ttl)
+            return 1
+        await cache.atouch(key, self.ttl)
+        return count
+
+    async def decrement(self, key):
+        try:
+            count = await cache.adecr(key)
+        except ValueError:
+            return 0
+        if count <= 0:
+            await cache.adelete(key)
+        return count
+
+    # both return True when it's a real online/offline change for the room
+    async def connect(self, room_id, user_id):
+        key = (room_id, user_id)
+        self.local[key] = self.local.get(key, 0) + 1
+        self.start_pulse()
+        await self.increment(user_key(user_id))
+        online = await self.increment(room_key(room_id, user_id)) == 1
+        self.transitions += online
+        return online
+
+    async def disconnect(self, room_id, user_id):
+        key = (room_id, user_id)
+        count = self.local.get(key, 0) - 1
+        if count > 0:
+            self.local[key] = count
+        else:
+            self.local.pop(key, None)
+        await self.decrement(user_key(user_id))
+        offline = await self.decrement(room_key(room_id, user_id)) <= 0
+        self.transitions += offline
+        return offline
+
+    def start_pulse(self):
+        if self.pulse is not None and not self.pulse.done() and self.pulse.get_loop() is asyncio.get_running_loop():
+            return
+        self.pulse = asyncio.ensure_future(self.beat())
+
+    async def beat(self):
+        while self.local:
+            await asyncio.sleep(self.heartbeat)
+            await self.touch()
+
+    async def touch(self):
+        users = {}
+        for (room_id, user_id), count in list(self.local.items()):
+            users[user_id] = users.get(user_id, 0) + count
+            if not await cache.atouch(room_key(room_id, user_id), self.ttl):
+                # ran out while we still had the connection, put it back
+                await cache.aadd(room_key(room_id, user_id), count, self.ttl)
+        for user_id, count in users.items():
+            if not await cache.atouch(user_key(user_id), self.ttl):
+                await cache.aadd(user_key(user_id), count, self.ttl)
+
+    def stats(self):
+        return {
+            'connections': sum(self.local.values()),
+            'tracked': len(self.local),
+            'transitions': self.transitions,
+        }
+
+
+def online_user_ids(user_ids):
+    # one get_many for the whole list
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    found = cache.get_many([user_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if found.get(user_key(user_id), 0) > 0}
+
+
+def room_online_user_ids(room_id, user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    found = cache.get_many([room_key(room_id, user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if found.get(room_key(room_id, user_id), 0) > 0}
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import setting_changed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# Profiling for views and consumer events
+# With CHAT_PROFILING on, every request (ProfilingMiddleware) and every consumer event (ProfiledConsumerMixin)
+# records wall time, DB queries + time and cache hits/misses into a ring buffer per endpoint, the last
+# CHAT_PROFILE_SAMPLES of each. Endpoints are the url name for views and ws:... for consumer events.
+#
+# Queries get counted by a wrapper on the DB connections that adds to whatever sample is current in the
+# context, asgiref copies the context into database_sync_to_async threads so consumer queries land in the right place.
+# The wrapper is only there while CHAT_PROFILING is on, with it off queries don't go through anything extra.
+#
+# CHAT_QUERY_BUDGETS = {'dashboard': 6, 'ws:chat_message': 2} logs a warning when an endpoint goes over, with
+# CHAT_QUERY_BUDGET_RAISE on (for tests) it raises QueryBudgetExceeded instead.
+#
+# Each process puts its summary in the Django cache every CHAT_PROFILE_PUBLISH seconds, that's what the staff
+# stats view and manage.py profile_stats read
+
+logger = logging.getLogger(__name__)
+
+current_sample = ContextVar('chat_profile_sample', default=None)
+
+WORKERS_KEY = 'chat:profile:workers'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def profiling_enabled():
+    return getattr(settings, 'CHAT_PROFILING', False)
+
+
+class Sample:
+    __slots__ = ('queries', 'query_time', 'cache_hits', 'cache_misses', 'wall', 'db_hold')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.wall = 0.0
+        self.db_hold = 0.0  # time holding a consumer DB slot, see asyncdb.py
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+class ProfileStats:
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'CHAT_PROFILE_SAMPLES', 500)
+        self.samples = {}
+        self.lock = Lock()
+        self.published = 0
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def record(self, endpoint, sample):
+        with self.lock:
+            samples = self.samples.get(endpoint)
+            if samples is None:
+                samples = self.samples[endpoint] = deque(maxlen=self.size)
+            samples.append((sample.wall, sample.queries, sample.query_time, sample.cache_hits, sample.cache_misses,
+                            sample.db_hold))
+        self.publish_soon()
+
+    def summary(self):
+        with self.lock:
+            samples = {endpoint: list(rows) for endpoint, rows in self.samples.items()}
+
+        summary = {}
+        for endpoint, rows in samples.items():
+            walls = [row[0] * 1000 for row in rows]
+            queries = [row[1] for row in rows]
+            hits = sum(row[3] for row in rows)
+            lookups = hits + sum(row[4] for row in rows)
+            summary[endpoint] = {
+                'count': len(rows),
+                'wall_ms_p50': percentile(walls, 50),
+                'wall_ms_p99': percentile(walls, 99),
+                'queries_avg': sum(queries) / len(rows),
+                'queries_max': max(queries),
+                'query_ms_avg': sum(row[2] for row in rows) * 1000 / len(rows),
+                'cache_hit_rate': hits / lookups if lookups else None,
+                'db_hold_ms_avg': sum(row[5] for row in rows) * 1000 / len(rows),
+            }
+        return summary
+
+    def publish_soon(self):
+        # the cache calls block, consumer events get recorded on the event loop so there they run in a thread
+        if time.time() - self.published < getattr(settings, 'CHAT_PROFILE_PUBLISH', 10):
+            return
+        self.published = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.publish(force=True)
+            return
+        loop.run_in_executor(None, self.publish, True)
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self.published < getattr(settings, 'CHAT_PROFILE_PUBLISH', 10):
+            return
+        self.published = now
+        try:
+            timeout = getattr(settings, 'CHAT_PROFILE_PUBLISH', 10) * 30
+            cache.set(f'chat:profile:{self.worker}', self.summary(), timeout)
+            workers = cache.get(WORKERS_KEY) or {}
+            workers[self.worker] = now
+            cache.set(WORKERS_KEY, {name: seen for name, seen in workers.items() if now - seen < timeout}, timeout)
+        except Exception:
+            logger.exception('Error publishing profile stats')
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+
+
+profile_stats = ProfileStats()
+
+
+def all_workers_summary():
+    # this process right now, the others as of their last publish
+    workers = cache.get(WORKERS_KEY) or {}
+    summaries = cache.get_many([f'chat:profile:{worker}' for worker in workers])
+    result = {worker: summaries.get(f'chat:profile:{worker}', {}) for worker in workers}
+    result[profile_stats.worker] = profile_stats.summary()
+    return result
+
+
+def check_budget(endpoint, sample):
+    budget = getattr(settings, 'CHAT_QUERY_BUDGETS', {}).get(endpoint)
+    if budget is None or sample.queries <= budget:
+        return
+    message = f'{endpoint} ran {sample.queries} queries, budget is {budget}'
+    if getattr(settings, 'CHAT_QUERY_BUDGET_RAISE', False):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+@contextmanager
+def profile(endpoint):
+    if not profiling_enabled():
+        yield None
+        return
+
+    sample = Sample()
+    token = current_sample.set(sample)
+    started = time.perf_counter()
+    try:
+        yield sample
+    finally:
+        sample.wall = time.perf_counter() - started
+        current_sample.reset(token)
+        # views only know their name once they've been resolved, they pass a function
+        endpoint = endpoint() if callable(endpoint) else endpoint
+        profile_stats.record(endpoint, sample)
+    check_budget(endpoint, sample)
+
+
+def profiled(endpoint):
+    # decorator version for a single async handler
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with profile(endpoint):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# counted by the caches themselves (cache.LRUCache, the site counters)
+
+def cache_hit():
+    sample = current_sample.get()
+    if sample is not None:
+        sample.cache_hits += 1
+
+
+def cache_miss():
+    sample = current_sample.get()
+    if sample is not None:
+        sample.cache_misses += 1
+
+
+# Query counting
+
+def count_queries(execute, sql, params, many, context):
+    sample = current_sample.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.query_time += time.perf_counter() - started
+
+
+def add_query_counter(connection):
+    # at the bottom, a connection can open inside a `with connection.execute_wrapper(...)` block and that pops
+    # whatever is on top when it ends
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_queries)
+
+
+@receiver(connection_created)
+def profile_connection(sender, connection, **kwargs):
+    if profiling_enabled():
+        add_query_counter(connection)
+
+
+def install_query_counter():
+    # this thread's open connections, the others get it (or not) when they next connect
+    for connection in connections.all(initialized_only=True):
+        if profiling_enabled():
+            add_query_counter(connection)
+        elif count_queries in connection.execute_wrappers:
+            connection.execute_wrappers.remove(count_queries)
+
+
+@receiver(setting_changed)
+def profiling_setting_changed(setting, **kwargs):
+    if setting == 'CHAT_PROFILING':
+        install_query_counter()
+
+
+# Views
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        def endpoint():
+            match = request.resolver_match
+            return match.view_name if match else request.path
+        with profile(endpoint):
+            return self.get_response(request)
+
+
+# Consumers, put it before the consumer class: class ChatConsumer(ProfiledConsumerMixin, AsyncWebsocketConsumer)
+
+class ProfiledConsumerMixin:
+    async def dispatch(self, message):
+        if not profiling_enabled():
+            return await super().dispatch(message)
+
+        # ws:<frame type> for what the client sends, ws:websocket.connect / disconnect, ws:group.<type> for group events
+        event = message['type']
+        if event == 'websocket.receive':
+            try:
+                event = json.loads(message.get('text') or '{}').get('type', 'chat_message')
+            except (ValueError, AttributeError):
+                event = 'invalid'
+        elif not event.startswith('websocket.'):
+            event = f'group.{event}'
+        with profile(f'ws:{event}'):
+            await super().dispatch(message)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+# Rate limits for what clients send over the socket
+# Each chat_message, typing, read_receipt and history frame takes a token from the connection's bucket for that
+# kind, and the first three one from the room's bucket too (everyone in the room shares it). A bucket holds up to
+# `burst` tokens and gets `rate` back a second. Over either one the frame is dropped before it reaches the
+# handler. A dropped chat_message or history frame gets a rate_limited frame back so the client isn't left waiting,
+# typing and read receipts are dropped quietly.
+#
+# CHAT_RATE_LIMITS overrides the defaults per kind and scope as (rate, burst), None turns one off:
+#   CHAT_RATE_LIMITS = {'chat_message': {'room': (10, 60)}, 'typing': {'connection': None}}
+# rate_limiter picks it up again when the setting changes (override_settings in tests and bench_chat_ws)
+#
+# Connection buckets live on the consumer, a socket only ever is on one worker. Room buckets go through
+# CHAT_RATE_LIMIT_BACKEND: LocalBackend (the default) keeps them in this process, so with N workers a room gets up
+# to N times its budget, CacheBackend shares them through the Django cache like presence does.
+#
+# What got through and what got dropped (per kind and scope) goes to the cache every CHAT_RATE_LIMIT_PUBLISH
+# seconds, from a thread since allow() runs on the event loop. The staff stats view and manage.py profile_stats
+# show it for every worker
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITS = {
+    'chat_message': {'connection': (2, 10), 'room': (5, 30)},
+    'typing': {'connection': (10, 30), 'room': (30, 90)},
+    'read_receipt': {'connection': (10, 50), 'room': (30, 150)},
+    'history': {'connection': (2, 10)},
+}
+
+WORKERS_KEY = 'chat:ratelimit:workers'
+
+
+def rate_limits():
+    limits = {kind: dict(scopes) for kind, scopes in RATE_LIMITS.items()}
+    for kind, scopes in getattr(settings, 'CHAT_RATE_LIMITS', {}).items():
+        limits.setdefault(kind, {}).update(scopes)
+    return limits
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Backends, for the room buckets. take() gives True when the frame can go through
+
+class LocalBackend:
+    def __init__(self, sweep=60):
+        self.buckets = {}
+        self.sweep = sweep
+        self.swept = time.monotonic()
+
+    async def take(self, key, rate, burst):
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+        allowed = bucket.take(rate, burst, now)
+        if now - self.swept > self.sweep:
+            self.forget_idle(now)
+        return allowed
+
+    def forget_idle(self, now):
+        # a bucket nobody used for a whole sweep is full again, it's the same as a new one.
+        # Once per sweep, so still O(1) per frame on average
+        self.swept = now
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket.updated < self.sweep}
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class CacheBackend:
+    # The cache has no compare-and-set, so this counts frames in windows of burst / rate seconds (the time an
+    # empty bucket takes to fill) with add + incr, both atomic on redis / memcached. Same average rate as the
+    # bucket, but a burst at the end of one window and another at the start of the next both get through
+    async def take(self, key, rate, burst):
+        window = burst / rate
+        key = f'chat:ratelimit:{key}:{int(time.time() // window)}'
+        timeout = math.ceil(window) + 1
+        if await cache.aadd(key, 1, timeout):
+            return True
+        try:
+            count = await cache.aincr(key)
+        except ValueError:
+            # ran out between the add and the incr
+            await cache.aadd(key, 1, timeout)
+            return True
+        return count <= burst
+
+
+def get_backend():
+    return import_string(getattr(settings, 'CHAT_RATE_LIMIT_BACKEND', 'Chat.ratelimit.LocalBackend'))()
+
+
+class RateLimiter:
+    def __init__(self, limits=None, backend=None):
+        self.limits = limits if limits is not None else rate_limits()
+        self.backend = backend or get_backend()
+        self.counts = {}
+        self.publish_every = getattr(settings, 'CHAT_RATE_LIMIT_PUBLISH', 10)
+        self.published = 0
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    # buckets is the connection's own dict, the consumer keeps it
+    async def allow(self, kind, buckets, room_id):
+        limits = self.limits.get(kind)
+        if limits is None:
+            return True
+
+        limit = limits.get('connection')
+        if limit is not None:
+            now = time.monotonic()
+            bucket = buckets.get(kind)
+            if bucket is None:
+                bucket = buckets[kind] = TokenBucket(limit[1], now)
+            if not bucket.take(limit[0], limit[1], now):
+                return self.count(kind, 'dropped_connection')
+
+        limit = limits.get('room')
+        if limit is not None and not await self.backend.take(f'{kind}:{room_id}', limit[0], limit[1]):
+            return self.count(kind, 'dropped_room')
+        return self.count(kind, 'allowed')
+
+    def count(self, kind, outcome):
+        counts = self.counts.get(kind)
+        if counts is None:
+            counts = self.counts[kind] = {'allowed': 0, 'dropped_connection': 0, 'dropped_room': 0}
+        counts[outcome] += 1
+        self.publish_soon()
+        return outcome == 'allowed'
+
+    def stats(self):
+        return {kind: dict(counts) for kind, counts in self.counts.items()}
+
+    def publish_soon(self):
+        # the cache calls block, so on the event loop they go to a thread with a copy of the counts
+        now = time.time()
+        if now - self.published < self.publish_every:
+            return
+        self.published = now
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.store(self.stats(), now)
+            return
+        loop.run_in_executor(None, self.store, self.stats(), now)
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self.published < self.publish_every:
+            return
+        self.published = now
+        self.store(self.stats(), now)
+
+    def store(self, stats, now):
+        try:
+            timeout = self.publish_every * 30
+            cache.set(f'chat:ratelimit:{self.worker}', stats, timeout)
+            workers = cache.get(WORKERS_KEY) or {}
+            workers[self.worker] = now
+            cache.set(WORKERS_KEY, {name: seen for name, seen in workers.items() if now - seen < timeout}, timeout)
+        except Exception:
+            logger.exception('Error publishing rate limit stats')
+
+    def reset(self):
+        self.counts = {}
+
+
+rate_limiter = RateLimiter()
+
+
+@receiver(setting_changed)
+def rate_limits_changed(setting, **kwargs):
+    if setting == 'CHAT_RATE_LIMITS':
+        rate_limiter.limits = rate_limits()
+
+
+def all_workers_rate_limits():
+    # this process right now, the others as of their last publish
+    workers = cache.get(WORKERS_KEY) or {}
+    stats = cache.get_many([f'chat:ratelimit:{worker}' for worker in workers])
+    result = {worker: stats.get(f'chat:ratelimit:{worker}', {}) for worker in workers}
+    result[rate_limiter.worker] = rate_limiter.stats()
+    return result
@@ -0,0 +1,139 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import UserProfile, PartnerIndex, PartnerRecommendation
+from .matching import rank_partners, score_matches
+
+
+# Stored partner lists
+# partner_list reads the top CHAT_RECOMMENDATION_SIZE partners for (user, language) from PartnerRecommendation in
+# one query and only scores live (rank_partners) when the list is missing, marked stale or older than
+# CHAT_RECOMMENDATION_TTL seconds. manage.py refresh_recommendations does the work in the background:
+#   - lists marked stale, profile changes mark the user's own lists and every list the profile is in
+#   - (user, language they learn) pairs that have no list yet
+#   - lists past the TTL, that's what picks up new people who'd now make someone's list and has_messaged changes
+# Scoring is matching.score_matches, the same order as rank_partners, two queries per language and the rest in memory
+
+RECOMMENDATION_SIZE = 20
+RECOMMENDATION_TTL = 6 * 3600
+
+
+def recommendation_size():
+    return getattr(settings, 'CHAT_RECOMMENDATION_SIZE', RECOMMENDATION_SIZE)
+
+
+def expired_before():
+    return timezone.now() - timedelta(seconds=getattr(settings, 'CHAT_RECOMMENDATION_TTL', RECOMMENDATION_TTL))
+
+
+def get_recommendations(user, language):
+    language_id = getattr(language, 'id', language)
+    rows = list(
+        PartnerRecommendation.objects.filter(user_id=user.id, language_id=language_id)
+        .select_related('partner__user', 'partner__native_lang')
+        .order_by('rank')
+    )
+    cutoff = expired_before()
+    if not rows or any(row.stale or row.computed_at < cutoff for row in rows):
+        return rank_partners(user, language_id, limit=recommendation_size())
+    return [{'profile': row.partner, 'score': row.score} for row in rows if row.partner_id is not None]
+
+
+# Refresh
+
+def refresh_language(language_id, user_ids, batch_size=500, workers=1):
+    ranked = score_matches(user_ids, language_id, limit=recommendation_size(), workers=workers)
+    now = timezone.now()
+    refreshed = 0
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        rows = []
+        for user_id in batch:
+            if user_id not in ranked:
+                # no profile any more, the delete below is enough
+                continue
+            rows += [
+                PartnerRecommendation(user_id=user_id, language_id=language_id, rank=rank, partner_id=profile_id,
+                                      score=score, computed_at=now)
+                for rank, (score, profile_id) in enumerate(ranked[user_id])
+            ] or [PartnerRecommendation(user_id=user_id, language_id=language_id, rank=0, computed_at=now)]
+            refreshed += 1
+
+        with transaction.atomic():
+            PartnerRecommendation.objects.filter(language_id=language_id, user_id__in=batch).delete()
+            PartnerRecommendation.objects.bulk_create(rows, batch_size=1000)
+    return refreshed
+
+
+def pending_pairs(full=False):
+    learning = PartnerIndex.objects.filter(learn_lang__isnull=False).values_list('profile__user_id', 'learn_lang_id')
+    if full:
+        return set(learning)
+
+    stored = PartnerRecommendation.objects.filter(user_id=OuterRef('profile__user_id'), language_id=OuterRef('learn_lang_id'))
+    pairs = set(learning.filter(~Exists(stored)))
+    pairs |= set(
+        PartnerRecommendation.objects.filter(Q(stale=True) | Q(computed_at__lt=expired_before()))
+        .values_list('user_id', 'language_id').distinct()
+    )
+    return pairs
+
+
+def prune_recommendations():
+    # lists for a language the user doesn't learn (any more) aren't kept up, partner_list scores those live
+    learning = PartnerIndex.objects.filter(profile__user_id=OuterRef('user_id'), learn_lang_id=OuterRef('language_id'))
+    deleted, per_model = PartnerRecommendation.objects.filter(~Exists(learning)).delete()
+    return deleted
+
+
+def refresh_recommendations(full=False, batch_size=500, workers=1):
+    pruned = prune_recommendations()
+    pairs = pending_pairs(full)
+    by_language = {}
+    for user_id, language_id in pairs:
+        by_language.setdefault(language_id, []).append(user_id)
+
+    refreshed = 0
+    for language_id, user_ids in by_language.items():
+        refreshed += refresh_language(language_id, sorted(user_ids), batch_size, workers)
+    return {'pairs': len(pairs), 'languages': len(by_language), 'refreshed': refreshed, 'pruned': pruned}
+
+
+def mark_stale(profile_ids):
+    PartnerRecommendation.objects.filter(
+        Q(user_id__in=UserProfile.objects.filter(id__in=profile_ids).values('user_id')) | Q(partner_id__in=profile_ids),
+        stale=False,
+    ).update(stale=True)
+
+
+# Signals, only mark, the worker does the scoring
+
+@receiver(post_save, sender=UserProfile)
+def recommendations_profile_saved(sender, instance, created, **kwargs):
+    # _scored_changed comes from matching's pre_save, logins re-saving the profile don't count
+    if not created and instance._scored_changed:
+        mark_stale([instance.id])
+
+
+@receiver(m2m_changed, sender=UserProfile.learn_lang.through)
+def recommendations_learn_lang_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        mark_stale([instance.id])
+    elif action == 'post_clear':
+        # the learners are gone from the index by now, every list in the language goes
+        PartnerRecommendation.objects.filter(language=instance).update(stale=True)
+    else:
+        mark_stale(list(pk_set or []))
+
+
+@receiver(pre_delete, sender=UserProfile)
+def recommendations_profile_deleted(sender, instance, **kwargs):
+    # before the rows that point at it cascade, the lists they were in would be short
+    mark_stale([instance.id])
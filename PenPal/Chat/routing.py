@@ -3,5 +3,5 @@ from . import consumers
 
 
 websockets_urlpatterns = [
-    re_path(r'ws/chat/(?<room_id>\w+)$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/(?P<room_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Bulk match scoring, what matching.score_matches runs for a whole cohort at once
+# The candidates for a language are loaded once into columns, a position per candidate (in profile id order) and
+# a bitset per attribute held in a Python int: native speakers of each language, learners of each language, each
+# pro_level, has_bio, has_messaged. A user's row of the score matrix is then a handful of ANDs over those ints
+# instead of a loop over every candidate.
+#
+# The weights are match_score's: exchange 50 > pro_level 20 > bio 10 > messaged 5, each bigger than all the ones
+# after it together, so walking the bits "has it" before "doesn't" in that order comes out highest score first,
+# and inside one score by position, which is profile id. Same order as matching.rank_entries, and it can stop
+# as soon as it has `limit` partners.
+#
+# Nothing in here touches Django so the process pool workers only need this module
+
+WEIGHTS = (50, 20, 10, 5)
+BOTH_AVAILABLE = 15
+
+
+def bitset(positions, size):
+    buf = bytearray((size + 7) // 8)
+    for i in positions:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, 'little')
+
+
+def column(groups, size):
+    return {key: bitset(positions, size) for key, positions in groups.items()}
+
+
+class CandidateSet:
+    def __init__(self, entries):
+        # entries are matching.IndexEntry, the available candidates for one language
+        entries = sorted(entries, key=lambda e: e.profile_id)
+        size = len(entries)
+        self.profile_ids = array('q', (e.profile_id for e in entries))
+        self.positions = {profile_id: i for i, profile_id in enumerate(self.profile_ids)}
+
+        native, learns, pro = {}, {}, {}
+        learns_nothing, bio, messaged = [], [], []
+        for i, e in enumerate(entries):
+            native.setdefault(e.native, []).append(i)
+            for lang in e.learning:
+                learns.setdefault(lang, []).append(i)
+            if not e.learning:
+                learns_nothing.append(i)
+            pro.setdefault(e.pro_level, []).append(i)
+            if e.has_bio:
+                bio.append(i)
+            if e.has_messaged:
+                messaged.append(i)
+
+        self.everyone = (1 << size) - 1
+        self.native = column(native, size)
+        self.learns = column(learns, size)
+        self.pro = column(pro, size)
+        self.learns_nothing = bitset(learns_nothing, size)
+        self.bio = bitset(bio, size)
+        self.messaged = bitset(messaged, size)
+
+    def __len__(self):
+        return len(self.profile_ids)
+
+    def rank(self, me, language_id, limit=20):
+        # me is (user_id, profile_id, native, learning, pro_level, is_available), gives [(score, profile_id)]
+        user_id, profile_id, native, learning, pro_level, available = me
+        everyone = self.everyone
+        own = self.positions.get(profile_id)
+        if own is not None:
+            everyone &= ~(1 << own)
+
+        # same pools as matching.filter_partners
+        speakers = self.native.get(language_id, 0)
+        if native is None:
+            pool = speakers & self.learns_nothing & everyone
+        else:
+            pool = speakers & self.learns.get(native, 0) & everyone
+        if not pool:
+            pool = (speakers | self.learns.get(language_id, 0)) & everyone
+
+        exchange = 0
+        if native is not None:
+            for lang in learning:
+                exchange |= self.native.get(lang, 0)
+            exchange &= self.learns.get(native, 0)
+
+        columns = (exchange, self.pro.get(pro_level, 0), self.bio, self.messaged)
+        ranked = []
+        self.walk(pool, columns, 0, BOTH_AVAILABLE if available else 0, ranked, limit)
+        return ranked
+
+    def walk(self, bits, columns, depth, score, ranked, limit):
+        if not bits:
+            return
+        if depth == len(columns):
+            profile_ids = self.profile_ids
+            while bits:
+                low = bits & -bits
+                ranked.append((score, profile_ids[low.bit_length() - 1]))
+                if limit and len(ranked) >= limit:
+                    return
+                bits ^= low
+            return
+        having = bits & columns[depth]
+        self.walk(having, columns, depth + 1, score + WEIGHTS[depth], ranked, limit)
+        if limit and len(ranked) >= limit:
+            return
+        self.walk(bits ^ having, columns, depth + 1, score, ranked, limit)
+
+
+# Cohorts, split over a process pool when they're big enough to be worth starting one
+
+worker_candidates = None
+
+
+def set_worker_candidates(candidates):
+    global worker_candidates
+    worker_candidates = candidates
+
+
+def rank_chunk(cohort, language_id, limit, candidates=None):
+    if candidates is None:
+        # in a pool worker, set up by set_worker_candidates. An empty CandidateSet is falsy, hence the is None
+        candidates = worker_candidates
+    return {me[0]: candidates.rank(me, language_id, limit) for me in cohort}
+
+
+def rank_cohort(candidates, cohort, language_id, limit=20, workers=None, min_pool_size=5000):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(cohort) < min_pool_size:
+        return rank_chunk(cohort, language_id, limit, candidates)
+
+    # the candidate columns go to each worker once, the cohort in a few chunks per worker
+    chunk_size = -(-len(cohort) // (workers * 4))
+    chunks = [cohort[start:start + chunk_size] for start in range(0, len(cohort), chunk_size)]
+    ranked = {}
+    with ProcessPoolExecutor(workers, initializer=set_worker_candidates, initargs=(candidates,)) as pool:
+        for result in pool.map(rank_chunk, chunks, [language_id] * len(chunks), [limit] * len(chunks)):
+            ranked.update(result)
+    return ranked
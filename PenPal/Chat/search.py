@@ -0,0 +1,203 @@
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+from .models import ChatRoom, Message, ArchivedMessage
+from .signals import messages_bulk_created, room_messages_deleted, room_deleting
+
+
+# Message search
+# On SQLite the messages are copied into an FTS5 table (chat_message_fts, rowid = message id, made by migration
+# 0009) and kept in step by the signals below. Anything else falls back to BasicSearchBackend, or point
+# CHAT_SEARCH_BACKEND at another class with the same methods. Results are newest first, only from the user's rooms,
+# paged with the id of the last hit as the cursor
+
+SEARCH_PAGE_SIZE = 20
+FTS_TABLE = 'chat_message_fts'
+
+# snippet markers, they can't come from a user so we can escape the text and then turn them into <mark>
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+WORD = re.compile(r'\w+')
+
+
+def highlight(text):
+    return mark_safe(escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def member_rooms(user):
+    return ChatRoom.people.through.objects.filter(user=user).values('chatroom_id')
+
+
+class SqliteFtsBackend:
+    snippet_words = 12
+
+    def match_query(self, query):
+        # every word has to be there, the last one can be the start of a word (search as you type)
+        words = WORD.findall(query.lower())
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += '*'
+        return f"content : ({' '.join(terms)})"
+
+    def index(self, messages):
+        # REPLACE covers edits and ids left behind by deletes that skipped the signals (flush, raw deletes)
+        rows = [(message.id, message.content, f'r{message.chatroom_id}') for message in messages]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f'INSERT OR REPLACE INTO {FTS_TABLE} (rowid, content, room) VALUES (%s, %s, %s)', rows)
+
+    def remove(self, message_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(message_id,) for message_id in message_ids])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            # archived messages keep their index rows, search_messages reads them back from the archive
+            for model in (Message, ArchivedMessage):
+                cursor.execute(
+                    f"INSERT INTO {FTS_TABLE} (rowid, content, room) "
+                    f"SELECT id, content, 'r' || chatroom_id FROM {model._meta.db_table}"
+                )
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+            cursor.execute(f'SELECT count(*) FROM {FTS_TABLE}')
+            return cursor.fetchone()[0]
+
+    def search(self, user, query, before=None, limit=SEARCH_PAGE_SIZE):
+        match = self.match_query(query)
+        if match is None:
+            return []
+
+        # the user's rooms are a semi-join on the people table, FTS still walks the hits newest first
+        # and stops at the limit, however many rooms the user is in
+        people = ChatRoom.people.through._meta.db_table
+        sql = (
+            f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', %s) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND room IN (SELECT 'r' || chatroom_id FROM {people} WHERE user_id = %s)"
+        )
+        params = [MARK_START, MARK_END, self.snippet_words, match, user.id]
+        if before:
+            sql += ' AND rowid < %s'
+            params.append(before)
+        sql += ' ORDER BY rowid DESC LIMIT %s'
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+class BasicSearchBackend:
+    # no index, works anywhere. Still limited to the user's rooms so it only reads their messages
+    snippet_chars = 40
+
+    def index(self, messages):
+        pass
+
+    def remove(self, message_ids):
+        pass
+
+    def rebuild(self):
+        return 0
+
+    def snippet(self, content, words):
+        lowered = content.lower()
+        found = [lowered.find(word) for word in words if lowered.find(word) >= 0]
+        start = max(0, min(found) - self.snippet_chars) if found else 0
+        text = content[start:start + self.snippet_chars * 3]
+        for word in words:
+            text = re.sub(f'({re.escape(word)}\\w*)', f'{MARK_START}\\1{MARK_END}', text, flags=re.IGNORECASE)
+        return ('…' if start else '') + text
+
+    def search(self, user, query, before=None, limit=SEARCH_PAGE_SIZE):
+        words = WORD.findall(query.lower())
+        if not words:
+            return []
+        # ids carry on from the hot table into the archive, so newest first is the two merged by id
+        hits = []
+        for model in (Message, ArchivedMessage):
+            messages = model.objects.filter(chatroom_id__in=member_rooms(user)).order_by('-id')
+            for word in words:
+                messages = messages.filter(content__icontains=word)
+            if before:
+                messages = messages.filter(id__lt=before)
+            hits += messages.values_list('id', 'content')[:limit]
+        hits.sort(reverse=True)
+        return [(message_id, self.snippet(content, words)) for message_id, content in hits[:limit]]
+
+
+backends = {}
+
+
+def get_search_backend():
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if path is None:
+        path = 'Chat.search.SqliteFtsBackend' if connection.vendor == 'sqlite' else 'Chat.search.BasicSearchBackend'
+    if path not in backends:
+        backends[path] = import_string(path)()
+    return backends[path]
+
+
+def search_messages(user, query, before=None, limit=SEARCH_PAGE_SIZE):
+    # one extra hit tells us if there's another page
+    hits = get_search_backend().search(user, query, before=before, limit=limit + 1)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    ids = [message_id for message_id, snippet in hits]
+    messages = Message.objects.select_related('sender', 'chatroom').in_bulk(ids)
+    if len(messages) < len(ids):
+        # archived ones keep their index rows
+        messages.update(ArchivedMessage.objects.select_related('sender', 'chatroom').in_bulk(
+            [message_id for message_id in ids if message_id not in messages]
+        ))
+    results = [
+        {'message': messages[message_id], 'snippet': highlight(snippet)}
+        for message_id, snippet in hits if message_id in messages
+    ]
+    next_cursor = hits[-1][0] if has_more else None
+    return results, next_cursor
+
+
+# Signals
+
+@receiver(post_save, sender=Message)
+def search_message_saved(sender, instance, **kwargs):
+    try:
+        get_search_backend().index([instance])
+    except Exception as e:
+        print(f'Error indexing message for search: {e}')
+
+
+@receiver(messages_bulk_created)
+def search_messages_bulk_saved(sender, messages, **kwargs):
+    try:
+        get_search_backend().index(messages)
+    except Exception as e:
+        print(f'Error indexing messages for search: {e}')
+
+
+@receiver(post_delete, sender=Message)
+def search_message_deleted(sender, instance, **kwargs):
+    if room_deleting(instance.chatroom_id):
+        return
+    try:
+        get_search_backend().remove([instance.id])
+    except Exception as e:
+        print(f'Error removing message from search: {e}')
+
+
+@receiver(room_messages_deleted)
+def search_room_messages_deleted(sender, message_ids, **kwargs):
+    try:
+        get_search_backend().remove(message_ids)
+    except Exception as e:
+        print(f'Error removing messages from search: {e}')
@@ -0,0 +1,41 @@
+from django.db.models.signals import pre_delete, post_delete
+from django.dispatch import Signal, receiver
+from .models import ChatRoom, Message, ArchivedMessage
+
+
+# bulk_create skips post_save, anything that keeps derived data in sync with messages
+# should listen to this too. Sent with messages=[Message, ...] after the rows are written
+messages_bulk_created = Signal()
+
+
+# A room delete cascades to its messages with one post_delete each, so every receiver would run its queries once
+# per row. This is sent once instead, after the room and its messages are gone, with room=ChatRoom,
+# message_ids=[...] and senders={user_id: count}, hot and archived messages both. The post_delete receivers on
+# Message skip anything room_deleting() says is part of it
+room_messages_deleted = Signal()
+
+# room id -> (message_ids, senders), read in the room's pre_delete which is sent before any row goes
+deleting_rooms = {}
+
+
+def room_deleting(room_id):
+    return room_id in deleting_rooms
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def room_delete_started(sender, instance, **kwargs):
+    message_ids = []
+    senders = {}
+    for model in (Message, ArchivedMessage):
+        rows = model.objects.filter(chatroom_id=instance.pk).order_by().values_list('id', 'sender_id')
+        for message_id, sender_id in rows:
+            message_ids.append(message_id)
+            senders[sender_id] = senders.get(sender_id, 0) + 1
+    deleting_rooms[instance.pk] = (message_ids, senders)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_delete_finished(sender, instance, **kwargs):
+    deleted = deleting_rooms.pop(instance.pk, None)
+    if deleted and deleted[0]:
+        room_messages_deleted.send(sender=ChatRoom, room=instance, message_ids=deleted[0], senders=deleted[1])
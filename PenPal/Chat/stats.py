@@ -0,0 +1,142 @@
+from django.db.models import F, Count, Min, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from .models import ChatRoom, Message, ArchivedMessage, UserStats
+from .signals import messages_bulk_created, room_messages_deleted, room_deleting
+
+
+# UserStats upkeep
+# Every counter is moved with an UPDATE on the user's row, if the row isn't there yet it gets built from scratch
+# by rebuild_user_stats, which is also what manage.py rebuild_user_stats runs to fix drift
+
+
+def rebuild_user_stats(user_ids=None):
+    memberships = ChatRoom.people.through.objects.order_by().values('user')
+    if user_ids is not None:
+        memberships = memberships.filter(user__in=user_ids)
+
+    rows = {}
+    # archived messages were still sent
+    for model in (Message, ArchivedMessage):
+        messages = model.objects.order_by().values('sender')
+        if user_ids is not None:
+            messages = messages.filter(sender__in=user_ids)
+        for row in messages.annotate(total=Count('id'), first=Min('timestamp'), last=Max('timestamp')):
+            stats = rows.get(row['sender'])
+            if stats is None:
+                rows[row['sender']] = UserStats(
+                    user_id=row['sender'],
+                    messages_sent=row['total'],
+                    first_message_at=row['first'],
+                    last_active=row['last'],
+                )
+            else:
+                stats.messages_sent += row['total']
+                stats.first_message_at = min(stats.first_message_at, row['first'])
+                stats.last_active = max(stats.last_active, row['last'])
+    for row in memberships.annotate(total=Count('id')):
+        stats = rows.setdefault(row['user'], UserStats(user_id=row['user']))
+        stats.chats_joined = row['total']
+    for user_id in user_ids or []:
+        rows.setdefault(user_id, UserStats(user_id=user_id))
+
+    UserStats.objects.bulk_create(
+        rows.values(),
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['messages_sent', 'chats_joined', 'first_message_at', 'last_active'],
+    )
+    return len(rows)
+
+
+def get_user_stats(user):
+    user_id = getattr(user, 'id', user)
+    stats = UserStats.objects.filter(user_id=user_id).first()
+    if stats is None:
+        rebuild_user_stats([user_id])
+        stats = UserStats.objects.get(user_id=user_id)
+    return stats
+
+
+def add_messages(user_id, count, first, last):
+    updated = UserStats.objects.filter(user_id=user_id).update(
+        messages_sent=F('messages_sent') + count,
+        first_message_at=Coalesce('first_message_at', first),
+        last_active=Greatest(Coalesce('last_active', last), last),
+    )
+    if not updated:
+        rebuild_user_stats([user_id])
+
+
+def recount_chats(user_ids):
+    # counted again from the membership rows rather than +1/-1, removing someone who wasn't in the room or adding
+    # them twice can't throw it off. One UPDATE with a subquery for all of them
+    user_ids = list(user_ids)
+    joined = ChatRoom.people.through.objects.filter(user=OuterRef('user_id')).order_by().values('user').annotate(
+        total=Count('id')
+    ).values('total')
+    updated = UserStats.objects.filter(user_id__in=user_ids).update(chats_joined=Coalesce(Subquery(joined), 0))
+    if updated < len(user_ids):
+        missing = set(user_ids) - set(UserStats.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        rebuild_user_stats(list(missing))
+
+
+# Signals
+
+@receiver(post_save, sender=Message)
+def stats_message_sent(sender, instance, created, **kwargs):
+    if created:
+        add_messages(instance.sender_id, 1, instance.timestamp, instance.timestamp)
+
+
+@receiver(messages_bulk_created)
+def stats_messages_bulk_sent(sender, messages, **kwargs):
+    per_sender = {}
+    for message in messages:
+        count, first, last = per_sender.get(message.sender_id, (0, message.timestamp, message.timestamp))
+        per_sender[message.sender_id] = (count + 1, min(first, message.timestamp), max(last, message.timestamp))
+    for user_id, (count, first, last) in per_sender.items():
+        add_messages(user_id, count, first, last)
+
+
+@receiver(post_delete, sender=Message)
+def stats_message_deleted(sender, instance, **kwargs):
+    # first/last times are left alone, the rebuild command puts them right if it matters
+    if room_deleting(instance.chatroom_id):
+        return
+    UserStats.objects.filter(user_id=instance.sender_id, messages_sent__gt=0).update(
+        messages_sent=F('messages_sent') - 1
+    )
+
+
+@receiver(room_messages_deleted)
+def stats_room_messages_deleted(sender, senders, **kwargs):
+    for user_id, count in senders.items():
+        UserStats.objects.filter(user_id=user_id).update(messages_sent=Greatest(F('messages_sent') - count, 0))
+
+
+@receiver(m2m_changed, sender=ChatRoom.people.through)
+def stats_people_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is None for clear, remember who was there before the rows go
+        instance._stats_cleared = [instance.pk] if reverse else list(instance.people.values_list('id', flat=True))
+        return
+
+    if action == 'post_clear':
+        user_ids = getattr(instance, '_stats_cleared', None)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        # user.chat_rooms.add(room, ...) is one user, room.people.add(user, ...) is everyone in pk_set
+        user_ids = [instance.pk] if reverse else pk_set
+    else:
+        return
+    if user_ids:
+        recount_chats(user_ids)
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def stats_room_deleted(sender, instance, **kwargs):
+    # the people rows get deleted without m2m_changed
+    people = list(instance.people.values_list('id', flat=True))
+    UserStats.objects.filter(user_id__in=people, chats_joined__gt=0).update(chats_joined=F('chats_joined') - 1)
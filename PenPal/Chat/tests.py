@@ -1,3 +1,1354 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import re
+import threading
+from datetime import timedelta
+from unittest import skipUnless
+from functools import wraps
+from unittest.mock import AsyncMock, patch
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, DatabaseError
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, override_settings, modify_settings
+from django.urls import reverse
+from django.utils import timezone
+from Chat.models import (Language, UserProfile, ChatRoom, Message, ArchivedMessage, PartnerIndex, PartnerRecommendation,
+                         ReadMark, UserStats, Counter)
+from Chat.utils import (get_user_chatrooms, get_message_page, get_messages_after, mark_message_as_read,
+                        get_or_create_chatroom, serialize_message, find_lang_partners, match_score)
+from Chat.matching import rank_partners, rebuild_index, score_matches
+from Chat.scoring import CandidateSet, rank_cohort
+from Chat.stats import get_user_stats, rebuild_user_stats
+from Chat.counters import get_site_counters, reconcile_counters, flush_counters
+from Chat.cache import is_room_member, membership_cache, room_buffers, RoomBuffers
+from Chat.layers import LocalFanoutChannelLayer, LocalTransport, ChannelLayerTransport
+from Chat.search import search_messages, get_search_backend
+from Chat.profiling import profile_stats, QueryBudgetExceeded, Sample, count_queries, profile_connection
+from Chat import catalog
+from Chat.catalog import get_languages, invalidate_catalog
+from Chat.asyncdb import DatabaseLimiter
+from Chat.consumers import ChatConsumer
+from Chat.routing import websockets_urlpatterns
+from Chat.presence import typing_tracker, presence, online_user_ids, room_online_user_ids
+from Chat.persistence import MessageWriter, WriteFailed, write_batch, get_writer
+from Chat.wire import COMPACT_PROTOCOL, frame, compact, batch
+from Chat.ratelimit import RateLimiter, LocalBackend, CacheBackend, rate_limiter
+from Chat.archive import archive_messages
+from Chat.recommendations import get_recommendations, refresh_recommendations
 
 # Create your tests here.
+
+
+# Hot path regression suite
+# Seeds a big synthetic dataset, runs every view/utility on the hot path and checks it against a query budget,
+# then runs EXPLAIN QUERY PLAN on each statement it made and fails if any of the big tables gets a full scan
+
+BIG_TABLES = {
+    Message._meta.db_table,
+    ChatRoom._meta.db_table,
+    ChatRoom.people.through._meta.db_table,
+    UserProfile._meta.db_table,
+    UserProfile.learn_lang.through._meta.db_table,
+    PartnerIndex._meta.db_table,
+    ReadMark._meta.db_table,
+    UserStats._meta.db_table,
+}
+
+FULL_SCAN = re.compile(r'^SCAN (\w+)')
+
+# indexes Django makes for foreign keys and unique_together, named by a hash of the table and columns.
+# SQLite answers room + id lookups from the chatroom_id one, it has the rowid at the end
+MESSAGE_ROOM_INDEX = 'Chat_message_chatroom_id_7bce5c4d'
+PEOPLE_USER_INDEX = 'Chat_chatroom_people_user_id_f972d4ee'
+PEOPLE_ROOM_INDEX = 'Chat_chatroom_people_chatroom_id_user_id_f356fb33_uniq'
+PARTNER_NATIVE_INDEX = 'Chat_partnerindex_native_lang_id_76596cd1'
+PARTNER_LEARN_INDEX = 'Chat_partnerindex_learn_lang_id_962de039'
+
+INBOX_PLAN = [
+    f'SEARCH Chat_chatroom_people USING INDEX {PEOPLE_USER_INDEX} (user_id=?)',
+    'USING INDEX sqlite_autoindex_Chat_readmark_1 (chatroom_id=? AND user_id=?)',
+    'USING COVERING INDEX message_room_history (chatroom_id=?)',
+    f'USING INDEX {MESSAGE_ROOM_INDEX} (chatroom_id=? AND rowid>?)',
+]
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked with SQLite EXPLAIN QUERY PLAN')
+class HotPathQueryPlanTests(TestCase):
+    USERS = 400
+    LANGUAGES = 8
+    ROOMS = 600
+    MESSAGES = 20000
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(42)
+
+        cls.languages = Language.objects.bulk_create(
+            [Language(name=f'Language {i}', code=f'l{i}') for i in range(cls.LANGUAGES)]
+        )
+        cls.users = User.objects.bulk_create([User(username=f'user{i}') for i in range(cls.USERS)])
+        profiles = UserProfile.objects.bulk_create([
+            UserProfile(
+                user=user,
+                native_lang=rng.choice(cls.languages),
+                pro_level=rng.choice(['beginner', 'intermediate', 'advanced']),
+                bio=rng.choice(['', 'Hi!']),
+            )
+            for user in cls.users
+        ])
+        Learning = UserProfile.learn_lang.through
+        Learning.objects.bulk_create([
+            Learning(userprofile=profile, language=language)
+            for profile in profiles
+            for language in rng.sample(cls.languages, 2)
+        ])
+
+        rooms = ChatRoom.objects.bulk_create(
+            [ChatRoom(name=f'room{i}', language=rng.choice(cls.languages)) for i in range(cls.ROOMS)]
+        )
+        People = ChatRoom.people.through
+        people = []
+        for room in rooms:
+            first, second = rng.sample(cls.users, 2)
+            people += [People(chatroom=room, user=first), People(chatroom=room, user=second)]
+        People.objects.bulk_create(people)
+
+        Message.objects.bulk_create(
+            [Message(chatroom_id=person.chatroom_id, sender_id=person.user_id, content='Hola')
+             for person in rng.choices(people, k=cls.MESSAGES)],
+            batch_size=1000,
+        )
+
+        # bulk_create skips the signals, build the derived tables the way the commands do
+        rebuild_index()
+        rebuild_user_stats()
+        reconcile_counters()
+        get_search_backend().rebuild()
+        refresh_recommendations(full=True)
+
+        cls.user = people[0].user
+        cls.room = people[0].chatroom
+        cls.language = cls.room.language
+        cls.learning = cls.user.userprofile.learn_lang.first()
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        cache.clear()
+        membership_cache.clear()
+        room_buffers.clear()
+        invalidate_catalog()
+
+    def capture(self, func):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            result = func()
+        return result, statements
+
+    def plan(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[3] for row in cursor.fetchall()]
+
+    def assertIndexed(self, statements, uses=()):
+        # no full scans of the big tables, and every step in uses (index + the columns it's bound on, as
+        # EXPLAIN QUERY PLAN prints them) shows up in one of the plans
+        steps = []
+        for sql, params in statements:
+            if not sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+                continue
+            plan = self.plan(sql, params)
+            for step in plan:
+                match = FULL_SCAN.match(step)
+                if match and match.group(1) in BIG_TABLES:
+                    self.fail(f'Full scan of {match.group(1)}:\n{sql}\n' + '\n'.join(plan))
+            steps += plan
+        for expected in uses:
+            if not any(expected in step for step in steps):
+                self.fail(f'No {expected} in the plans:\n' + '\n'.join(steps))
+
+    def assertHotPath(self, func, budget, uses=()):
+        result, statements = self.capture(func)
+        self.assertLessEqual(
+            len(statements), budget,
+            f'{len(statements)} queries, budget is {budget}:\n' + '\n'.join(sql for sql, params in statements)
+        )
+        self.assertIndexed(statements, uses)
+        return result
+
+    # Utilities
+
+    def test_inbox(self):
+        rooms = self.assertHotPath(lambda: get_user_chatrooms(self.user), 1, uses=INBOX_PLAN)
+        self.assertTrue(rooms)
+
+    def test_inbox_limit(self):
+        rooms = self.assertHotPath(lambda: get_user_chatrooms(self.user, limit=1), 1, uses=INBOX_PLAN)
+        self.assertEqual(len(rooms), 1)
+
+    def test_rank_partners(self):
+        partners = self.assertHotPath(lambda: rank_partners(self.user, self.language), 2, uses=[
+            f'INDEX {PARTNER_NATIVE_INDEX} (native_lang_id=?)',
+            f'INDEX {PARTNER_LEARN_INDEX} (learn_lang_id=?)',
+        ])
+        self.assertTrue(partners)
+
+    def test_rank_partners_matches_match_score(self):
+        for user in self.users[:10]:
+            profile = user.userprofile
+            for language in profile.learn_lang.all():
+                partners = {partner.id: partner for partner in find_lang_partners(user, language)}
+                expected = sorted(((match_score(profile, partner), partner.id) for partner in partners.values()),
+                                  key=lambda row: (-row[0], row[1]))[:20]
+                ranked = [(partner['score'], partner['profile'].id) for partner in rank_partners(user, language)]
+                self.assertEqual(ranked, expected)
+
+    def test_profile_saves_only_reindex_on_changes(self):
+        # logins re-save the profile
+        result, statements = self.capture(self.user.save)
+        self.assertFalse([sql for sql, params in statements if PartnerIndex._meta.db_table in sql])
+
+        profile = self.user.userprofile
+        profile.pro_level = 'native'
+        profile.save()
+        self.assertEqual(set(PartnerIndex.objects.filter(profile=profile).values_list('pro_level', flat=True)),
+                         {'native'})
+
+    def test_partly_loaded_profiles(self):
+        # a deferred scored field is never read on load, and the save reindexes since it can't tell what changed
+        with self.assertNumQueries(1):
+            profile = UserProfile.objects.only('id').get(user=self.user)
+        with self.assertNumQueries(1):
+            profile = UserProfile.objects.defer('bio').get(user=self.user)
+        profile.pro_level = 'advanced'
+        result, statements = self.capture(profile.save)
+        self.assertTrue([sql for sql, params in statements if PartnerIndex._meta.db_table in sql])
+        self.assertEqual(set(PartnerIndex.objects.filter(profile=profile).values_list('pro_level', flat=True)),
+                         {'advanced'})
+
+    def test_stored_recommendations(self):
+        partners = self.assertHotPath(lambda: get_recommendations(self.user, self.learning), 1, uses=[
+            'SEARCH Chat_partnerrecommendation USING INDEX sqlite_autoindex_Chat_partnerrecommendation_1 '
+            '(user_id=? AND language_id=?)',
+        ])
+        self.assertEqual(partners, rank_partners(self.user, self.learning))
+
+    def test_score_matches(self):
+        cohort = list(User.objects.filter(userprofile__learn_lang=self.learning).order_by('id'))
+        with self.assertNumQueries(2):
+            ranked = score_matches(cohort, self.learning, workers=1)
+        self.assertEqual(len(ranked), len(cohort))
+        for user in cohort[:25]:
+            expected = [(p['score'], p['profile'].id) for p in rank_partners(user, self.learning)]
+            self.assertEqual(ranked[user.id], expected)
+
+    @override_settings(CHAT_SCORING_POOL_MIN=0)
+    def test_score_matches_pool(self):
+        cohort = list(User.objects.filter(userprofile__learn_lang=self.learning))
+        self.assertEqual(score_matches(cohort, self.learning, workers=2), score_matches(cohort, self.learning, workers=1))
+
+    def test_history_pages(self):
+        page, cursor = self.assertHotPath(lambda: get_message_page(self.room, limit=5), 1, uses=[
+            'SEARCH Chat_message USING INDEX message_room_history (chatroom_id=?)',
+        ])
+        self.assertIsNotNone(cursor)
+        self.assertHotPath(lambda: get_message_page(self.room, before=cursor, limit=5), 1, uses=[
+            'SEARCH Chat_message USING INDEX message_room_history (chatroom_id=? AND timestamp<?)',
+        ])
+
+    def test_deep_history_page_is_a_range(self):
+        # the cursor has to bound the timestamp in the index, not just pick the room and walk it
+        page, cursor = get_message_page(self.room, limit=1)
+        page, statements = self.capture(lambda: get_message_page(self.room, before=cursor, limit=1))
+        plan = self.plan(*statements[0])
+        self.assertIn('SEARCH Chat_message USING INDEX message_room_history (chatroom_id=? AND timestamp<?)', plan)
+        # an OR over two index lookups finds the rows too, but then sorts every older message in the room
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+    def test_resume(self):
+        page, cursor = get_message_page(self.room, limit=5)
+        missed = self.assertHotPath(lambda: get_messages_after(self.room, page[0].id), 1, uses=[
+            f'SEARCH Chat_message USING INDEX {MESSAGE_ROOM_INDEX} (chatroom_id=? AND rowid>?)',
+        ])
+        self.assertEqual([m.id for m in missed], [m.id for m in page[1:]])
+
+    def test_member_room(self):
+        self.assertTrue(self.assertHotPath(lambda: is_room_member(self.room.id, self.user.id), 1, uses=[
+            f'SEARCH Chat_chatroom_people USING COVERING INDEX {PEOPLE_ROOM_INDEX} (chatroom_id=? AND user_id=?)',
+        ]))
+        self.assertTrue(self.assertHotPath(lambda: is_room_member(self.room.id, self.user.id), 0))
+
+    def test_mark_read(self):
+        for _ in range(2):
+            self.assertHotPath(lambda: mark_message_as_read(self.room, self.user), 1, uses=[
+                f'SEARCH Chat_message USING COVERING INDEX {MESSAGE_ROOM_INDEX} (chatroom_id=? AND rowid<?)',
+            ])
+
+    def test_get_or_create_chatroom(self):
+        first, second = self.users[-2], self.users[-1]
+        room = get_or_create_chatroom(first, second, self.language)
+        same = self.assertHotPath(lambda: get_or_create_chatroom(second, first, self.language), 1, uses=[
+            'SEARCH Chat_chatroom USING INDEX sqlite_autoindex_Chat_chatroom_1 (pair_low=? AND pair_high=? AND language_id=?)',
+        ])
+        self.assertEqual(room, same)
+
+    def test_user_stats(self):
+        self.assertHotPath(lambda: get_user_stats(self.user), 1, uses=[
+            'SEARCH Chat_userstats USING INTEGER PRIMARY KEY (rowid=?)',
+        ])
+
+    def test_site_counters(self):
+        self.assertHotPath(get_site_counters, 1)
+        self.assertHotPath(get_site_counters, 0)
+
+    def test_search(self):
+        results, cursor = self.assertHotPath(lambda: search_messages(self.user, 'hol'), 2, uses=[
+            f'SEARCH Chat_chatroom_people USING INDEX {PEOPLE_USER_INDEX} (user_id=?)',
+            'SEARCH Chat_message USING INTEGER PRIMARY KEY (rowid=?)',
+        ])
+        self.assertTrue(results)
+
+    def test_language_catalog(self):
+        languages = get_languages()
+        self.assertEqual(sum(language.learner_count for language in languages), self.USERS * 2)
+        self.assertHotPath(get_languages, 0)
+
+        profile = self.user.userprofile
+        profile.learn_lang.remove(*profile.learn_lang.all())
+        languages = get_languages()
+        self.assertEqual(sum(language.learner_count for language in languages), self.USERS * 2 - 2)
+
+    # Views, budgets include the session + user lookups
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_views(self):
+        self.client.force_login(self.user)
+        get_languages() # counting learners reads the whole learn_lang table, that's what the catalog cache is for
+        views = [
+            (reverse('dashboard'), 6),
+            (reverse('my_chats'), 3),
+            (reverse('partner_list', args=[self.learning.id]), 4),
+            (reverse('chat_room', args=[self.room.id]), 9),
+            (reverse('chat_history', args=[self.room.id]), 5),
+            (reverse('search') + '?q=hola', 4),
+            (reverse('language_select'), 3),
+        ]
+        for url, budget in views:
+            with self.subTest(url=url):
+                self.assertHotPath(lambda: self.get(url), budget)
+
+
+class ScoringTests(SimpleTestCase):
+    def test_no_candidates(self):
+        # me is (user_id, profile_id, native, learning, pro_level, is_available)
+        cohort = [(1, 1, 10, [20], 'beginner', True), (2, 2, None, [], 'native', False)]
+        self.assertEqual(rank_cohort(CandidateSet([]), cohort, 20, 3, workers=1), {1: [], 2: []})
+
+
+# Local fan-out channel layer, two layers on one LocalTransport play two workers
+
+class LocalFanoutLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.transport = LocalTransport()
+        self.first = LocalFanoutChannelLayer(transport=self.transport)
+        self.second = LocalFanoutChannelLayer(transport=self.transport)
+
+    async def join(self, layer, group='chat_1'):
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        return channel
+
+    async def test_local_members_skip_the_transport(self):
+        one, two = await self.join(self.first), await self.join(self.first)
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+
+        self.assertEqual((await self.first.receive(one))['message'], 'hi')
+        self.assertEqual((await self.first.receive(two))['message'], 'hi')
+        self.assertEqual(self.transport.sent, 0)
+        self.assertEqual(self.first.stats['encoded'], 0)
+
+    async def test_remote_members_get_one_copy_per_worker(self):
+        local = await self.join(self.first)
+        remote = [await self.join(self.second) for i in range(3)]
+        await self.join(self.second, 'chat_2')
+
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+
+        self.assertEqual((await self.first.receive(local))['message'], 'hi')
+        for channel in remote:
+            self.assertEqual((await self.second.receive(channel))['message'], 'hi')
+        self.assertEqual(self.transport.sent, 1)
+        self.assertEqual(self.first.stats['encoded'], 1)
+
+    async def test_last_member_leaving_stops_forwarding(self):
+        remote = await self.join(self.second)
+        await self.second.group_discard('chat_1', remote)
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual(self.transport.sent, 0)
+
+    async def test_direct_send_to_other_worker(self):
+        remote = await self.second.new_channel()
+        await self.first.send(remote, {'type': 'user_joined', 'username': 'ana'})
+        self.assertEqual((await self.second.receive(remote))['username'], 'ana')
+
+
+# Same again over a real channel layer, what runs in production with channels_redis underneath
+
+class ChannelLayerTransportTests(SimpleTestCase):
+    def setUp(self):
+        self.transport = ChannelLayerTransport(InMemoryChannelLayer())
+        self.first = LocalFanoutChannelLayer(transport=self.transport)
+        self.second = LocalFanoutChannelLayer(transport=self.transport)
+
+    async def join(self, layer, group='chat_1'):
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        return channel
+
+    async def test_members(self):
+        await self.join(self.first)
+        await self.join(self.second)
+        await self.join(self.second)
+        self.assertEqual(await self.transport.members('chat_1'), {self.first.worker_id, self.second.worker_id})
+        self.assertEqual(await self.transport.members('chat_2'), set())
+
+    async def test_local_members_skip_the_transport(self):
+        local = await self.join(self.first)
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual((await self.first.receive(local))['message'], 'hi')
+        self.assertEqual(self.first.stats['forwarded'], 0)
+        self.assertEqual(self.first.stats['encoded'], 0)
+
+    async def test_remote_members(self):
+        local = await self.join(self.first)
+        remote = await self.join(self.second)
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual((await self.first.receive(local))['message'], 'hi')
+        self.assertEqual((await self.second.receive(remote))['message'], 'hi')
+        self.assertEqual(self.first.stats['forwarded'], 1)
+
+        await self.second.group_discard('chat_1', remote)
+        await self.first.group_send('chat_1', {'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual(self.first.stats['forwarded'], 1)
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben, cls.eve = [User.objects.create(username=name) for name in ('ana', 'ben', 'eve')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+        cls.other = ChatRoom.objects.create(name='ben-eve', language=language)
+        cls.other.people.add(cls.ben, cls.eve)
+
+    def found(self, user, query):
+        results, cursor = search_messages(user, query)
+        return [result['message'].content for result in results]
+
+    def test_index_follows_saves_and_deletes(self):
+        message = Message.objects.create(chatroom=self.room, sender=self.ana, content='Vamos a la playa mañana')
+        self.assertEqual(self.found(self.ben, 'playa'), [message.content])
+        self.assertEqual(self.found(self.ben, 'mañ'), [message.content])
+
+        message.content = 'Vamos al cine'
+        message.save()
+        self.assertEqual(self.found(self.ben, 'playa'), [])
+        self.assertEqual(self.found(self.ben, 'cine'), [message.content])
+
+        message.delete()
+        self.assertEqual(self.found(self.ben, 'cine'), [])
+
+    def test_only_the_users_rooms(self):
+        Message.objects.create(chatroom=self.other, sender=self.eve, content='secreto')
+        self.assertEqual(self.found(self.ana, 'secreto'), [])
+        self.assertEqual(self.found(self.ben, 'secreto'), ['secreto'])
+
+    def test_users_in_lots_of_rooms(self):
+        # the rooms are joined in SQL, the MATCH string doesn't grow with them
+        rooms = ChatRoom.objects.bulk_create(
+            [ChatRoom(name=f'room {i}', language=self.room.language) for i in range(2000)]
+        )
+        ChatRoom.people.through.objects.bulk_create(
+            [ChatRoom.people.through(chatroom=room, user=self.ana) for room in rooms]
+        )
+        Message.objects.create(chatroom=rooms[-1], sender=self.ana, content='secreto')
+        Message.objects.create(chatroom=self.other, sender=self.eve, content='secreto')
+        self.assertEqual(self.found(self.ana, 'secreto'), ['secreto'])
+
+    def test_pages_and_snippets(self):
+        for i in range(25):
+            Message.objects.create(chatroom=self.room, sender=self.ana, content=f'<b>hola</b> {i}')
+        results, cursor = search_messages(self.ana, 'hola')
+        self.assertEqual(len(results), 20)
+        self.assertIn('&lt;b&gt;<mark>hola</mark>&lt;/b&gt;', results[0]['snippet'])
+        more, cursor = search_messages(self.ana, 'hola', before=cursor)
+        self.assertEqual(len(more), 5)
+        self.assertIsNone(cursor)
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+        now = timezone.now()
+        for i in range(30):
+            # 20 old ones, 10 from this week
+            age = timedelta(days=400 - i) if i < 20 else timedelta(days=30 - i)
+            message = Message.objects.create(chatroom=cls.room, sender=cls.ana, content=f'mensaje {i}')
+            Message.objects.filter(id=message.id).update(timestamp=now - age)
+
+    def test_old_messages_move(self):
+        report = archive_messages(older_than_days=180, keep=5)
+        self.assertEqual(report['messages'], 20)
+        self.assertEqual(Message.objects.count(), 10)
+        self.assertEqual(ArchivedMessage.objects.count(), 20)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.archived_count, 20)
+        # second run has nothing left to do
+        self.assertEqual(archive_messages(older_than_days=180, keep=5)['messages'], 0)
+
+    def test_keeps_the_newest(self):
+        archive_messages(older_than_days=0, keep=5)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)),
+                         [f'mensaje {i}' for i in range(25, 30)])
+
+    def test_inactive_rooms_go_whole(self):
+        ChatRoom.objects.filter(id=self.room.id).update(is_active=False)
+        archive_messages(older_than_days=180, keep=5)
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_dry_run(self):
+        report = archive_messages(older_than_days=180, keep=5, dry_run=True)
+        self.assertEqual(report['messages'], 20)
+        self.assertEqual(Message.objects.count(), 30)
+
+    def test_reads_carry_on_into_the_archive(self):
+        archive_messages(older_than_days=180, keep=5, batch_size=7)
+        self.room.refresh_from_db()
+        contents, before = [], None
+        while True:
+            page, before = get_message_page(self.room, before=before, limit=8)
+            contents = [message.content for message in page] + contents
+            if before is None:
+                break
+        self.assertEqual(contents, [f'mensaje {i}' for i in range(30)])
+
+        results, cursor = search_messages(self.ben, 'mensaje', limit=30)
+        self.assertEqual(len(results), 30)
+        self.assertEqual(reconcile_counters()['total_messages'], 30)
+        rebuild_user_stats([self.ana.id])
+        self.assertEqual(get_user_stats(self.ana).messages_sent, 30)
+
+    def test_keeps_by_time_not_id(self):
+        # an imported message, newest id but the oldest timestamp
+        imported = Message.objects.create(chatroom=self.room, sender=self.ben, content='mensaje importado')
+        Message.objects.filter(id=imported.id).update(timestamp=timezone.now() - timedelta(days=500))
+        archive_messages(older_than_days=0, keep=5)
+        self.assertTrue(ArchivedMessage.objects.filter(id=imported.id).exists())
+
+        self.room.refresh_from_db()
+        contents, before = [], None
+        while True:
+            page, before = get_message_page(self.room, before=before, limit=4)
+            contents = [message.content for message in page] + contents
+            if before is None:
+                break
+        self.assertEqual(contents, ['mensaje importado'] + [f'mensaje {i}' for i in range(30)])
+
+    def test_search_backends_read_the_archive(self):
+        archive_messages(older_than_days=180, keep=5)
+        backend = get_search_backend()
+        self.assertEqual(backend.rebuild(), 30)
+        expected = [f'mensaje {i}' for i in reversed(range(30))]
+        for path in ('Chat.search.SqliteFtsBackend', 'Chat.search.BasicSearchBackend'):
+            with self.subTest(backend=path), override_settings(CHAT_SEARCH_BACKEND=path):
+                found, before = [], None
+                while True:
+                    results, before = search_messages(self.ben, 'mensaje', before=before, limit=7)
+                    found += [result['message'].content for result in results]
+                    if before is None:
+                        break
+                self.assertEqual(found, expected)
+
+
+class DerivedDataTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+        Message.objects.create(chatroom=cls.room, sender=cls.ben, content='hola')
+
+    def setUp(self):
+        reconcile_counters()
+
+    def stored_total(self):
+        return Counter.objects.get(name='site:total_messages').value
+
+    @override_settings(CHAT_COUNTERS_FLUSH_SECONDS=60)
+    def test_counter_bumps_are_batched(self):
+        for i in range(5):
+            Message.objects.create(chatroom=self.room, sender=self.ana, content=f'hola {i}')
+        self.assertEqual(self.stored_total(), 1)
+        # this process sees its own bumps, the flush is one UPDATE
+        with self.assertNumQueries(2):
+            self.assertEqual(get_site_counters()['total_messages'], 6)
+        self.assertEqual(self.stored_total(), 6)
+        with self.assertNumQueries(0):
+            flush_counters()
+
+    def test_room_delete_is_one_update_per_sender(self):
+        for i in range(20):
+            Message.objects.create(chatroom=self.room, sender=self.ana, content=f'mensaje {i}')
+        archive_messages(older_than_days=0, keep=15)
+        self.assertEqual(get_user_stats(self.ana).messages_sent, 20)
+        flush_counters()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.room.delete()
+        # nothing left that runs once per message
+        self.assertLess(len(queries), 30)
+
+        self.assertEqual(get_site_counters()['total_messages'], 0)
+        self.assertEqual(reconcile_counters()['total_messages'], 0)
+        self.assertEqual(get_user_stats(self.ana).messages_sent, 0)
+        self.assertEqual(get_user_stats(self.ben).messages_sent, 0)
+        self.assertEqual(search_messages(self.ana, 'mensaje')[0], [])
+        self.assertFalse(PartnerIndex.objects.filter(profile__user=self.ana, has_messaged=True).exists())
+
+
+    def test_chats_joined_follows_add_remove_and_clear(self):
+        eve = User.objects.create(username='eve')
+        other = ChatRoom.objects.create(name='ben-eve', language=self.room.language)
+
+        def joined():
+            return [get_user_stats(user).chats_joined for user in (self.ana, self.ben, eve)]
+
+        self.assertEqual(joined(), [1, 1, 0])
+        other.people.add(self.ben, eve)
+        other.people.add(eve)
+        self.assertEqual(joined(), [1, 2, 1])
+        # ana was never in it
+        other.people.remove(self.ana, eve)
+        self.assertEqual(joined(), [1, 2, 0])
+        other.people.remove(eve)
+        self.assertEqual(joined(), [1, 2, 0])
+
+        self.ben.chat_rooms.clear()
+        self.assertEqual(joined(), [1, 0, 0])
+        eve.chat_rooms.add(self.room, other)
+        self.room.people.clear()
+        self.assertEqual(joined(), [0, 0, 1])
+
+
+class RecommendationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.spanish = Language.objects.create(name='Spanish', code='es')
+        cls.english = Language.objects.create(name='English', code='en')
+        cls.ana, cls.ben, cls.eve = [User.objects.create(username=name) for name in ('ana', 'ben', 'eve')]
+        cls.profiles = {}
+        for user, native, learning in ((cls.ana, cls.english, cls.spanish), (cls.ben, cls.spanish, cls.english),
+                                       (cls.eve, cls.spanish, None)):
+            # the profile comes from the post_save on User
+            profile = UserProfile.objects.get(user=user)
+            profile.native_lang = native
+            profile.pro_level = 'beginner'
+            profile.save()
+            if learning:
+                profile.learn_lang.add(learning)
+            cls.profiles[user.username] = profile
+
+    def stored(self, user, language):
+        return list(PartnerRecommendation.objects.filter(user=user, language=language, stale=False)
+                    .order_by('rank').values_list('partner__user__username', flat=True))
+
+    def test_pending_lists_get_built(self):
+        report = refresh_recommendations()
+        # ana learns Spanish, ben English, eve nothing
+        self.assertEqual(report['refreshed'], 2)
+        # ben is the exchange partner, eve only speaks Spanish so she'd only come up without one
+        self.assertEqual(self.stored(self.ana, self.spanish), ['ben'])
+        self.assertEqual(self.stored(self.ben, self.english), ['ana'])
+        self.assertEqual(refresh_recommendations()['refreshed'], 0)
+
+    def test_reads_the_stored_list(self):
+        refresh_recommendations()
+        with self.assertNumQueries(1):
+            partners = get_recommendations(self.ana, self.spanish)
+        self.assertEqual(partners, rank_partners(self.ana, self.spanish))
+
+    def test_changes_mark_lists_stale(self):
+        refresh_recommendations()
+        ben = self.profiles['ben']
+        ben.is_available = False
+        ben.save()
+        # ben was on ana's list, the view scores live until the worker catches up
+        self.assertEqual(self.stored(self.ana, self.spanish), [])
+        self.assertEqual([p['profile'].user.username for p in get_recommendations(self.ana, self.spanish)], ['eve'])
+        refresh_recommendations()
+        self.assertEqual(self.stored(self.ana, self.spanish), ['eve'])
+
+    def test_saves_that_dont_change_scores(self):
+        refresh_recommendations()
+        self.client.force_login(self.ana)
+        ana = UserProfile.objects.get(user=self.ana)
+        ana.first_name = 'Ana'
+        ana.save()
+        self.assertEqual(self.stored(self.ana, self.spanish), ['ben'])
+
+    def test_new_and_dropped_languages(self):
+        refresh_recommendations()
+        self.profiles['eve'].learn_lang.add(self.english)
+        self.assertEqual(refresh_recommendations()['refreshed'], 1)
+        self.assertEqual(self.stored(self.eve, self.english), ['ana'])
+
+        self.profiles['ana'].learn_lang.remove(self.spanish)
+        self.assertEqual(refresh_recommendations()['pruned'], 1)
+        self.assertFalse(PartnerRecommendation.objects.filter(user=self.ana, language=self.spanish).exists())
+
+    @override_settings(CHAT_RECOMMENDATION_TTL=0)
+    def test_old_lists_are_scored_live(self):
+        refresh_recommendations()
+        with self.assertNumQueries(3):
+            get_recommendations(self.ana, self.spanish)
+
+
+class RoomBufferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+        cls.quiet = ChatRoom.objects.create(name='quiet', language=language)
+        cls.quiet.people.add(cls.ana, cls.ben)
+        for i in range(60):
+            Message.objects.create(chatroom=cls.room, sender=cls.ana if i % 2 else cls.ben, content=f'hola {i}')
+        Message.objects.create(chatroom=cls.quiet, sender=cls.ben, content='nada')
+
+    def setUp(self):
+        room_buffers.clear()
+        self.addCleanup(room_buffers.clear)
+
+    def test_first_page_from_the_buffer(self):
+        expected, cursor = get_message_page(self.room)
+        room_buffers.subscribe(self.room.id)
+        get_message_page(self.room)  # fills it
+        with self.assertNumQueries(0):
+            page, buffered_cursor = get_message_page(self.room)
+        self.assertEqual([(m.id, m.content, m.sender_id, m.timestamp) for m in page],
+                         [(m.id, m.content, m.sender_id, m.timestamp) for m in expected])
+        self.assertEqual(page[-1].sender.username, expected[-1].sender.username)
+        self.assertEqual(buffered_cursor, cursor)
+        # and the DB carries on from its cursor
+        older, cursor = get_message_page(self.room, before=buffered_cursor)
+        self.assertEqual([m.content for m in older], [f'hola {i}' for i in range(10)])
+
+    def test_only_while_a_socket_is_open(self):
+        room_buffers.subscribe(self.room.id)
+        get_message_page(self.room)
+        room_buffers.unsubscribe(self.room.id)
+        with self.assertNumQueries(1):
+            get_message_page(self.room)
+
+    def test_new_messages_and_edits(self):
+        room_buffers.subscribe(self.room.id)
+        get_message_page(self.room)
+        message = Message.objects.create(chatroom=self.room, sender=self.ana, content='nuevo')
+        with self.assertNumQueries(0):
+            page, cursor = get_message_page(self.room)
+        self.assertEqual(page[-1].content, 'nuevo')
+        self.assertEqual(len(page), 50)
+
+        message.content = 'editado'
+        message.save()
+        page, cursor = get_message_page(self.room)
+        self.assertEqual(page[-1].content, 'editado')
+
+    def test_inbox_previews(self):
+        room_buffers.subscribe(self.room.id)
+        room_buffers.subscribe(self.quiet.id)
+        get_message_page(self.room)
+        get_message_page(self.quiet)
+        with self.assertNumQueries(1):
+            rooms = get_user_chatrooms(self.ana)
+        self.assertEqual([r['last_message'].content for r in rooms], ['nada', 'hola 59'])
+
+        # a buffer that missed the latest message isn't used for it
+        room_buffers.unsubscribe(self.quiet.id)
+        room_buffers.drop(self.quiet.id)
+        Message.objects.create(chatroom=self.quiet, sender=self.ana, content='hola?')
+        with self.assertNumQueries(2):
+            rooms = get_user_chatrooms(self.ana)
+        self.assertEqual([r['last_message'].content for r in rooms], ['hola?', 'hola 59'])
+
+    def test_lru_under_the_memory_budget(self):
+        def entry(message_id, seconds):
+            return {'message_id': message_id, 'username': 'ana', 'message': 'x' * 100,
+                    'timestamp': f'2026-01-01T00:00:{seconds:02d}+00:00', 'sender_id': 1}
+
+        buffers = RoomBuffers(capacity=3, max_bytes=3 * 1000)
+        for room_id in (1, 2, 3):
+            buffers.subscribe(room_id)
+            buffers.fill(room_id, [entry(room_id * 10 + i, i) for i in range(3)], has_older=False)
+        self.assertEqual(len(buffers), 3)
+        buffers.page(1, 3)  # room 2 is now the coldest
+        buffers.subscribe(4)
+        buffers.fill(4, [entry(40, 0), entry(41, 1)], has_older=False)
+        self.assertEqual(list(buffers.rooms), [3, 1, 4])
+        self.assertLessEqual(buffers.bytes, buffers.max_bytes)
+
+        # out of order, the newest 3 stay in time order
+        buffers.append(1, entry(19, 1))
+        entries, has_older = buffers.page(1, 3)
+        self.assertEqual([e['message_id'] for e in entries], [11, 19, 12])
+        self.assertTrue(has_older)
+
+
+class ConsumerDatabaseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+
+    def setUp(self):
+        membership_cache.clear()
+
+    def consumer(self, user):
+        consumer = ChatConsumer()
+        consumer.room_id, consumer.user = str(self.room.id), user
+        return consumer
+
+    async def test_async_orm_path(self):
+        consumer = self.consumer(self.ana)
+        consumer.room = await consumer.check_room_participant()
+        self.assertEqual(consumer.room, self.room)
+
+        message = await consumer.save_message('hola')
+        await consumer.mark_messages_in_read(message.id)
+        self.assertEqual(await ReadMark.objects.filter(user=self.ana).values_list('last_read_id', flat=True).aget(),
+                         message.id)
+        self.assertEqual(await consumer.load_missed(0), [serialize_message(message)])
+
+        stranger = await User.objects.acreate(username='eve')
+        self.assertIsNone(await self.consumer(stranger).check_room_participant())
+        # only the answers are cached, never a room
+        self.assertEqual(sorted(value for value, expires in membership_cache.data.values()), [False, True])
+
+    async def test_history_after_archiving_with_the_socket_open(self):
+        consumer = self.consumer(self.ana)
+        consumer.room = await consumer.check_room_participant()
+        for i in range(6):
+            await Message.objects.acreate(chatroom=self.room, sender=self.ana, content=f'mensaje {i}')
+        await sync_to_async(archive_messages)(older_than_days=0, keep=2)
+
+        contents, before = [], None
+        while True:
+            page, before = await consumer.load_history(before)
+            contents = [message['message'] for message in page] + contents
+            if before is None:
+                break
+            self.assertTrue(page)
+        self.assertEqual(contents, [f'mensaje {i}' for i in range(6)])
+
+    async def test_limiter(self):
+        limiter = DatabaseLimiter(limit=2, recycle=0)
+
+        async def work():
+            async with limiter.slot():
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(work() for i in range(6)))
+        stats = limiter.stats()
+        self.assertEqual(stats['peak'], 2)
+        self.assertGreaterEqual(stats['wait_ms_p99'], 10)
+        self.assertGreaterEqual(stats['hold_ms_p50'], 10)
+
+    async def test_chat_messages_rate_limited(self):
+        consumer = self.consumer(self.ana)
+        consumer.room = self.room
+        consumer.room_group_name = f'chat_{self.room.id}'
+        consumer.channel_layer = InMemoryChannelLayer()
+        consumer.rate_buckets = {}
+        sent = []
+
+        async def send(text_data):
+            sent.append(json.loads(text_data))
+        consumer.send = send
+
+        with patch.dict(rate_limiter.limits, {'chat_message': {'connection': (0.001, 3)}}):
+            for i in range(5):
+                await consumer.receive(json.dumps({'type': 'chat_message', 'message': f'hola {i}'}))
+        self.assertEqual(await Message.objects.filter(chatroom=self.room).acount(), 3)
+        self.assertEqual(sent, [{'type': 'rate_limited', 'frame': 'chat_message'}] * 2)
+
+    async def test_history_frames_always_get_an_answer(self):
+        consumer = self.consumer(self.ana)
+        consumer.room = self.room
+        consumer.rate_buckets = {}
+        sent = []
+
+        async def send(text_data):
+            sent.append(json.loads(text_data))
+        consumer.send = send
+
+        limits = {'history': {'connection': (0.001, 1)}, 'typing': {'connection': (0.001, 1)}}
+        with patch.dict(rate_limiter.limits, limits):
+            await consumer.receive(json.dumps({'type': 'history', 'before': 'not a cursor'}))
+            await consumer.receive(json.dumps({'type': 'history'}))
+            consumer.handle_typing = AsyncMock()
+            await consumer.receive(json.dumps({'type': 'typing', 'is_typing': True}))
+            await consumer.receive(json.dumps({'type': 'typing', 'is_typing': True}))
+        # typing is dropped without a word
+        self.assertEqual(sent, [{'type': 'error', 'frame': 'history'}, {'type': 'rate_limited', 'frame': 'history'}])
+
+    async def test_malformed_frames_are_dropped(self):
+        consumer = self.consumer(self.ana)
+        consumer.room = self.room
+        consumer.rate_buckets = {}
+        consumer.send = AsyncMock()
+        for frame in ({'type': {}}, {'type': []}, {'type': 1}, ['chat_message'], 'hola'):
+            await consumer.receive(json.dumps(frame))
+        consumer.send.assert_not_called()
+        self.assertEqual(consumer.rate_buckets, {})
+
+
+class ReadMarkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room, cls.other = [ChatRoom.objects.create(name=name, language=language) for name in ('ana-ben', 'ben')]
+        cls.messages = [Message.objects.create(chatroom=cls.room, sender=cls.ben, content=f'hola {i}') for i in range(3)]
+        cls.elsewhere = Message.objects.create(chatroom=cls.other, sender=cls.ben, content='hola')
+
+    def mark(self):
+        return ReadMark.objects.filter(chatroom=self.room, user=self.ana).values_list('last_read_id', flat=True).first()
+
+    def test_only_moves_forward(self):
+        mark_message_as_read(self.room, self.ana, self.messages[1].id)
+        self.assertEqual(self.mark(), self.messages[1].id)
+        mark_message_as_read(self.room, self.ana, self.messages[0].id)
+        self.assertEqual(self.mark(), self.messages[1].id)
+        mark_message_as_read(self.room, self.ana)
+        self.assertEqual(self.mark(), self.messages[2].id)
+
+    def test_ids_from_the_future_or_other_rooms(self):
+        mark_message_as_read(self.room, self.ana, 10 ** 12)
+        self.assertEqual(self.mark(), self.messages[2].id)
+        # the next message is still unread
+        newer = Message.objects.create(chatroom=self.room, sender=self.ben, content='nuevo')
+        self.assertEqual(list(Message.objects.filter(chatroom=self.room, id__gt=self.mark())), [newer])
+
+        mark_message_as_read(self.other, self.ana, newer.id)
+        self.assertEqual(ReadMark.objects.get(chatroom=self.other, user=self.ana).last_read_id, self.elsewhere.id)
+
+    def test_empty_room(self):
+        empty = ChatRoom.objects.create(name='empty', language=self.room.language)
+        mark_message_as_read(empty, self.ana)
+        self.assertFalse(ReadMark.objects.filter(chatroom=empty).exists())
+
+
+class MessageWriterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana = User.objects.create(username='ana')
+        cls.room = ChatRoom.objects.create(name='ana', language=language)
+
+    async def test_ids_come_from_the_database(self):
+        writer = MessageWriter(batch_size=10, flush_ms=10)
+        messages = await asyncio.gather(*(writer.submit(self.room.id, self.ana, f'hola {i}') for i in range(5)))
+        await writer.close()
+        ids = [message.id for message in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(writer.batches, 1)
+
+        # a plain save afterwards carries on from the same sequence
+        direct = await Message.objects.acreate(chatroom=self.room, sender=self.ana, content='hola')
+        self.assertGreater(direct.id, max(ids))
+        self.assertEqual(await Message.objects.filter(chatroom=self.room).acount(), 6)
+
+    async def test_failed_batches_go_back_to_the_senders(self):
+        writer = MessageWriter(flush_ms=1, retries=1)
+        attempts = []
+
+        def flaky(messages):
+            attempts.append(len(messages))
+            if len(attempts) == 1:
+                raise DatabaseError('database is locked')
+            write_batch(messages)
+
+        with patch('Chat.persistence.write_batch', flaky), self.assertLogs('Chat.persistence', 'WARNING'):
+            message = await writer.submit(self.room.id, self.ana, 'hola')
+        self.assertEqual(attempts, [1, 1])
+        self.assertTrue(await Message.objects.filter(id=message.id).aexists())
+
+        with patch('Chat.persistence.write_batch', side_effect=DatabaseError('disk full')), \
+                self.assertLogs('Chat.persistence', 'ERROR'):
+            with self.assertRaises(WriteFailed):
+                await writer.submit(self.room.id, self.ana, 'adios')
+        await writer.close()
+        self.assertEqual((writer.written, writer.failed), (1, 1))
+
+
+# Sockets end to end, the real consumer on the in-memory channel layer
+
+def closes_sockets(test):
+    # TestCase has no async tearDown, the sockets have to go before the test's event loop does
+    @wraps(test)
+    async def wrapper(self):
+        try:
+            await test(self)
+        finally:
+            for socket in self.sockets:
+                await socket.disconnect()
+    return wrapper
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class SocketTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        language = Language.objects.create(name='Spanish', code='es')
+        cls.ana, cls.ben = [User.objects.create(username=name) for name in ('ana', 'ben')]
+        cls.room = ChatRoom.objects.create(name='ana-ben', language=language)
+        cls.room.people.add(cls.ana, cls.ben)
+
+    def setUp(self):
+        cache.clear()
+        membership_cache.clear()
+        self.sockets = []
+
+    async def connect(self, user, subprotocols=None, query=''):
+        socket = WebsocketCommunicator(URLRouter(websockets_urlpatterns), f'/ws/chat/{self.room.id}/{query}',
+                                       subprotocols=subprotocols)
+        socket.scope['user'] = user
+        connected, socket.subprotocol = await socket.connect()
+        self.assertTrue(connected)
+        self.sockets.append(socket)
+        return socket
+
+    async def disconnect(self, socket):
+        self.sockets.remove(socket)
+        await socket.disconnect()
+
+    async def receive(self, socket, event_type):
+        event = await socket.receive_json_from(timeout=2)
+        self.assertEqual(event['type'], event_type, event)
+        return event
+
+
+class WireTests(SimpleTestCase):
+    def event(self):
+        return {'type': 'chat_message', 'username': 'ana', 'message': 'hola ñ', 'timestamp': '2026-10-18T12:00:00',
+                'message_id': 7, 'sender_id': 1}
+
+    def test_formats(self):
+        event = self.event()
+        self.assertEqual(json.loads(frame(event)), {'type': 'chat_message', 'username': 'ana', 'message': 'hola ñ',
+                                                    'timestamp': '2026-10-18T12:00:00', 'message_id': 7})
+        self.assertEqual(compact(event), '["m","ana","hola ñ","2026-10-18T12:00:00",7]')
+        self.assertEqual(compact({'type': 'typing_indicator', 'username': 'ana', 'is_typing': False}), '["t","ana",0]')
+        self.assertEqual(json.loads(batch([compact(event), compact({'type': 'user_left', 'username': 'ben'})])),
+                         [['m', 'ana', 'hola ñ', '2026-10-18T12:00:00', 7], ['l', 'ben']])
+
+    def test_encoded_once_and_only_when_asked(self):
+        event = self.event()
+        self.assertNotIn('_compact', event)
+        first = frame(event)
+        self.assertIs(frame(event), first)
+        self.assertNotIn('_compact', event)
+        # the cached strings never go to other workers
+        layer = LocalFanoutChannelLayer()
+        compact(event)
+        self.assertEqual(json.loads(layer.encode(event)), self.event())
+
+
+@override_settings(CHAT_WIRE_BATCH_WINDOW=0.3)
+class WireSocketTests(SocketTestCase):
+    @closes_sockets
+    async def test_compact_subprotocol(self):
+        ana = await self.connect(self.ana, subprotocols=[COMPACT_PROTOCOL])
+        self.assertEqual(ana.subprotocol, COMPACT_PROTOCOL)
+        self.assertEqual(await ana.receive_json_from(timeout=2), [['j', 'ana']])
+
+        ben = await self.connect(self.ben, subprotocols=['something.else'])
+        self.assertIsNone(ben.subprotocol)
+        await self.receive(ben, 'user_join')
+        self.assertEqual(await ana.receive_json_from(timeout=2), [['j', 'ben']])
+
+        await ben.send_json_to({'type': 'chat_message', 'message': 'hola'})
+        sent = await self.receive(ben, 'chat_message')
+        await ben.send_json_to({'type': 'typing', 'is_typing': True})
+        # both land inside one batch window
+        self.assertEqual(await ana.receive_json_from(timeout=2), [
+            ['m', 'ben', 'hola', sent['timestamp'], sent['message_id']],
+            ['t', 'ben', 1],
+        ])
+
+
+@override_settings(CHAT_WRITE_BEHIND=True)
+class WriteBehindSocketTests(SocketTestCase):
+    @closes_sockets
+    async def test_sockets_never_wait_on_the_whole_queue(self):
+        # flush() waits for every socket's messages, connect / reconnect / disconnect must not need it
+        with patch.object(MessageWriter, 'flush', side_effect=AssertionError('waited on the writer queue')):
+            ana = await self.connect(self.ana)
+            await self.receive(ana, 'user_join')
+            await ana.send_json_to({'type': 'chat_message', 'message': 'hola'})
+            sent = await self.receive(ana, 'chat_message')
+            await self.disconnect(ana)
+
+            ben = await self.connect(self.ben, query=f"?last_message_id={sent['message_id'] - 1}")
+            self.assertEqual((await self.receive(ben, 'chat_message'))['message_id'], sent['message_id'])
+            await self.disconnect(ben)
+        await get_writer().close()
+
+
+class TypingSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings_patch = patch.multiple(typing_tracker, interval=0.1, timeout=0.3)
+        self.settings_patch.start()
+        self.addCleanup(self.settings_patch.stop)
+
+    async def connect_both(self):
+        ben = await self.connect(self.ben)
+        await self.receive(ben, 'user_join')
+        ana = await self.connect(self.ana)
+        self.assertEqual((await self.receive(ben, 'user_join'))['username'], 'ana')
+        await self.receive(ana, 'user_join')
+        return ana, ben
+
+    @closes_sockets
+    async def test_keystrokes_coalesce(self):
+        ana, ben = await self.connect_both()
+        for i in range(5):
+            await ana.send_json_to({'type': 'typing', 'is_typing': True})
+        self.assertEqual(await self.receive(ben, 'typing'), {'type': 'typing', 'username': 'ana', 'is_typing': True})
+        self.assertTrue(await ben.receive_nothing(0.05))
+        # the typer never sees their own indicator
+        self.assertTrue(await ana.receive_nothing(0.05))
+
+    @closes_sockets
+    async def test_stop_inside_the_interval_goes_out_at_its_end(self):
+        ana, ben = await self.connect_both()
+        await ana.send_json_to({'type': 'typing', 'is_typing': True})
+        await self.receive(ben, 'typing')
+        await ana.send_json_to({'type': 'typing', 'is_typing': False})
+        await ana.send_json_to({'type': 'typing', 'is_typing': True})
+        await ana.send_json_to({'type': 'typing', 'is_typing': False})
+        self.assertTrue(await ben.receive_nothing(0.05))
+        self.assertFalse((await self.receive(ben, 'typing'))['is_typing'])
+        self.assertTrue(await ben.receive_nothing(0.15))
+
+    @closes_sockets
+    async def test_stops_after_going_quiet(self):
+        ana, ben = await self.connect_both()
+        await ana.send_json_to({'type': 'typing', 'is_typing': True})
+        await self.receive(ben, 'typing')
+        self.assertTrue(await ben.receive_nothing(0.2))
+        self.assertFalse((await self.receive(ben, 'typing'))['is_typing'])
+
+    @closes_sockets
+    async def test_leaving_while_typing(self):
+        ana, ben = await self.connect_both()
+        await ana.send_json_to({'type': 'typing', 'is_typing': True})
+        await self.receive(ben, 'typing')
+        await self.disconnect(ana)
+        self.assertFalse((await self.receive(ben, 'typing'))['is_typing'])
+        self.assertEqual(typing_tracker.stats()['tracked'], 0)
+
+
+class PresenceSocketTests(SocketTestCase):
+    @closes_sockets
+    async def test_tabs_only_announce_real_changes(self):
+        everyone = [self.ana.id, self.ben.id]
+        ben = await self.connect(self.ben)
+        await self.receive(ben, 'user_join')
+        first_tab = await self.connect(self.ana)
+        self.assertEqual((await self.receive(ben, 'user_join'))['username'], 'ana')
+        second_tab = await self.connect(self.ana)
+        self.assertTrue(await ben.receive_nothing(0.1))
+        self.assertEqual(online_user_ids(everyone), set(everyone))
+
+        await self.disconnect(first_tab)
+        self.assertTrue(await ben.receive_nothing(0.1))
+        self.assertEqual(room_online_user_ids(self.room.id, everyone), set(everyone))
+
+        await self.disconnect(second_tab)
+        self.assertEqual((await self.receive(ben, 'user_leave'))['username'], 'ana')
+        self.assertEqual(online_user_ids(everyone), {self.ben.id})
+
+    @closes_sockets
+    async def test_counts_run_out_when_a_worker_dies(self):
+        with patch.multiple(presence, ttl=1, heartbeat=0.2):
+            await self.connect(self.ana)
+            await asyncio.sleep(1.3)
+            # the heartbeat kept it past the TTL
+            self.assertEqual(online_user_ids([self.ana.id]), {self.ana.id})
+
+            # a dead worker stops touching its keys without ever disconnecting
+            connections = dict(presence.local)
+            presence.local.clear()
+            await asyncio.sleep(1.3)
+            self.assertEqual(online_user_ids([self.ana.id]), set())
+            self.assertEqual(room_online_user_ids(self.room.id, [self.ana.id]), set())
+            presence.local.update(connections)
+
+
+class RateLimitTests(SimpleTestCase):
+    async def test_connection_bucket(self):
+        limiter = RateLimiter({'typing': {'connection': (1, 3)}}, LocalBackend())
+        buckets = {}
+        self.assertEqual([await limiter.allow('typing', buckets, 1) for i in range(5)], [True] * 3 + [False] * 2)
+        # another connection has its own, unknown frame types aren't limited
+        self.assertTrue(await limiter.allow('typing', {}, 1))
+        self.assertTrue(await limiter.allow('something_else', buckets, 1))
+
+        # a second later one token is back
+        buckets['typing'].updated -= 1
+        self.assertEqual([await limiter.allow('typing', buckets, 1) for i in range(2)], [True, False])
+        self.assertEqual(limiter.stats(), {'typing': {'allowed': 5, 'dropped_connection': 3, 'dropped_room': 0}})
+
+    async def test_room_bucket(self):
+        limiter = RateLimiter({'chat_message': {'connection': None, 'room': (0.001, 3)}}, LocalBackend())
+        allowed = [await limiter.allow('chat_message', {}, 1) for i in range(4)]
+        self.assertEqual(allowed, [True, True, True, False])
+        self.assertTrue(await limiter.allow('chat_message', {}, 2))
+        self.assertEqual(limiter.stats()['chat_message']['dropped_room'], 1)
+
+    async def test_local_backend_forgets_idle(self):
+        backend = LocalBackend(sweep=60)
+        await backend.take('typing:1', 1, 3)
+        backend.buckets['typing:1'].updated -= 61
+        backend.swept -= 61
+        await backend.take('typing:2', 1, 3)
+        self.assertEqual(list(backend.buckets), ['typing:2'])
+
+    async def test_cache_backend(self):
+        cache.clear()
+        backend = CacheBackend()
+        self.assertEqual([await backend.take('chat_message:1', 0.001, 3) for i in range(4)], [True] * 3 + [False])
+        self.assertTrue(await backend.take('chat_message:2', 0.001, 3))
+
+    def test_follows_the_setting(self):
+        with override_settings(CHAT_RATE_LIMITS={'typing': {'connection': None}}):
+            self.assertEqual(rate_limiter.limits['typing'], {'connection': None, 'room': (30, 90)})
+        self.assertEqual(rate_limiter.limits['typing'], {'connection': (10, 30), 'room': (30, 90)})
+
+    async def test_publishing_stays_off_the_event_loop(self):
+        limiter = RateLimiter({'typing': {'connection': (1, 3)}}, LocalBackend())
+        threads = []
+        with patch('Chat.ratelimit.cache') as shared:
+            shared.get.return_value = {}
+            shared.set.side_effect = lambda *args, **kwargs: threads.append(threading.get_ident())
+            await limiter.allow('typing', {}, 1)
+            for _ in range(100):
+                if len(threads) == 2:
+                    break
+                await asyncio.sleep(0.01)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(shared.set.call_args_list[0][0][1], {'typing': {'allowed': 1, 'dropped_connection': 0,
+                                                                         'dropped_room': 0}})
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_catalog()
+
+    def test_other_processes_see_a_bump_straight_away(self):
+        Language.objects.create(name='Spanish', code='es')
+        self.assertEqual([language.name for language in get_languages()], ['Spanish'])
+        # another process adds a language, all this one has in common with it is the cache
+        with patch('Chat.catalog.invalidate_catalog'):
+            Language.objects.create(name='English', code='en')
+        cache.incr(catalog.VERSION_KEY)
+        self.assertEqual([language.name for language in get_languages()], ['English', 'Spanish'])
+        with self.assertNumQueries(0):
+            get_languages()
+
+
+@override_settings(CHAT_PROFILING=True, CHAT_QUERY_BUDGET_RAISE=True)
+@modify_settings(MIDDLEWARE={'append': 'Chat.profiling.ProfilingMiddleware'})
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='ana', is_staff=True)
+
+    def setUp(self):
+        profile_stats.reset()
+        self.client.force_login(self.user)
+
+    def test_views_are_recorded(self):
+        self.client.get(reverse('my_chats'))
+        stats = self.client.get(reverse('profiling_stats')).json()['workers'][profile_stats.worker]
+        self.assertEqual(stats['my_chats']['count'], 1)
+        self.assertGreater(stats['my_chats']['queries_max'], 0)
+
+    def test_budget(self):
+        with override_settings(CHAT_QUERY_BUDGETS={'my_chats': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse('my_chats'))
+        with override_settings(CHAT_QUERY_BUDGETS={'my_chats': 1}, CHAT_QUERY_BUDGET_RAISE=False):
+            with self.assertLogs('Chat.profiling', 'WARNING'):
+                self.client.get(reverse('my_chats'))
+
+    async def test_publishing_stays_off_the_event_loop(self):
+        threads = []
+        with patch('Chat.profiling.cache') as shared:
+            shared.get.return_value = {}
+            shared.set.side_effect = lambda *args, **kwargs: threads.append(threading.get_ident())
+            profile_stats.published = 0
+            profile_stats.record('ws:chat_message', Sample())
+            for _ in range(100):
+                if len(threads) == 2:
+                    break
+                await asyncio.sleep(0.01)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_query_counter_only_while_profiling(self):
+        connection.ensure_connection()
+        with override_settings(CHAT_PROFILING=False):
+            self.assertNotIn(count_queries, connection.execute_wrappers)
+            profile_connection(sender=connection.__class__, connection=connection)
+            self.assertNotIn(count_queries, connection.execute_wrappers)
+        self.assertIn(count_queries, connection.execute_wrappers)
+
+        # reconnecting inside someone's execute_wrapper block leaves their wrapper on top for them to pop
+        connection.execute_wrappers.remove(count_queries)
+        with connection.execute_wrapper(lambda execute, *args: execute(*args)):
+            profile_connection(sender=connection.__class__, connection=connection)
+        self.assertEqual(connection.execute_wrappers, [count_queries])
+
+    def test_stats_are_staff_only(self):
+        self.client.force_login(User.objects.create(username='ben'))
+        self.assertEqual(self.client.get(reverse('profiling_stats')).status_code, 302)
@@ -13,7 +13,9 @@ urlpatterns = [
 
     # Chat Room
     path('chat/<int:room_id>/', views.chat_room, name='chat_room'),
+    path('chat/<int:room_id>/history/', views.chat_history, name='chat_history'),
     path('my-chats/', views.my_chats, name='my_chats'),
+    path('search/', views.search, name='search'),
 
     #User Profile
     path('profile/', views.profile, name='profile'),
@@ -23,6 +25,9 @@ urlpatterns = [
     #Settings
     path('settings/', views.settings_view, name='settings'),
 
+    #Staff
+    path('stats/profile/', views.profiling_stats, name='profiling_stats'),
+
     #Authentication
     path('signup/', views.signup, name='signup'),
     path('login/', views.login_view, name='login'),
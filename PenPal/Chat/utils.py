@@ -1,5 +1,14 @@
-from django.db.models import Q
-from .models import UserProfile, ChatRoom, Message
+from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.db.models import Q, Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import base64
+from .models import UserProfile, ChatRoom, Message, ArchivedMessage, ReadMark
+from .stats import get_user_stats
+from .cache import room_buffers, message_entry
 
 
 #ABV native_lang = native_language, Learn_lang = Learning_language
@@ -16,14 +25,14 @@ def find_lang_partners(user, language):
     ideal_matches = UserProfile.objects.filter(
         native_lang=language,
         learn_lang=user_profile.native_lang,
-        is_availble=True
-    ).exclude(user=user).select_related('user', ' native_lang')
+        is_available=True
+    ).exclude(user=user).select_related('user', 'native_lang')
 
     if not ideal_matches.exists():
         broader_matches = UserProfile.objects.filter(
             Q(native_lang=language) | Q(learn_lang=language),
-            is_availble=True
-        ).exclude(user=user).select_related('user', ' native_lang')
+            is_available=True
+        ).exclude(user=user).select_related('user', 'native_lang')
         return broader_matches
 
     return ideal_matches
@@ -38,66 +47,269 @@ def match_score(user_profile, partner_profile):
     if user_profile.pro_level == partner_profile.pro_level:
         score += 20
 
-    if user_profile.is_availble and partner_profile.is_availble:
+    if user_profile.is_available and partner_profile.is_available:
         score += 15
 
     if partner_profile.bio:
         score += 10
 
-    message_count = Message.objects.filter(sender=partner_profile.user).count()
-    if message_count > 0:
+    if get_user_stats(partner_profile.user_id).messages_sent > 0:
         score += 5
 
     return min(score, 100)
 
 
 def get_or_create_chatroom(user1, user2, language):
-    existing_room = ChatRoom.objects.filter(
-        people = user1,
-        language = language,
-    ).filter(
-        people=user2,
-    ).first()
-    if existing_room:
-        return existing_room
-
-    room_name = f'{language.name}: {user1.username} & {user2.username}'
-    new_room = ChatRoom.objects.create(
-        name=room_name,
-        language=language
-    )
-    new_room.people.add(user1, user2)
-
-    return new_room
-
-def get_user_chatrooms(user):
+    # rooms are keyed by (lower user id, higher user id, language) with a unique index, so the lookup is one
+    # indexed read and two start_chat clicks at once can't make two rooms, the loser of the insert just gets the room
+    pair_low, pair_high = sorted([user1.id, user2.id])
+
+    try:
+        return ChatRoom.objects.get(pair_low=pair_low, pair_high=pair_high, language=language)
+    except ChatRoom.DoesNotExist:
+        pass
+
+    with transaction.atomic():
+        room, created = ChatRoom.objects.get_or_create(
+            pair_low=pair_low,
+            pair_high=pair_high,
+            language=language,
+            defaults={'name': f'{language.name}: {user1.username} & {user2.username}'},
+        )
+        if created:
+            room.people.add(user1, user2)
+
+    return room
+
+MESSAGE_FIELDS = ['id', 'chatroom_id', 'sender_id', 'content', 'timestamp']
+
+
+def buffered_message(entry, room_id):
+    # a Message + sender from a room_buffers entry, no queries
+    db = Message.objects.db
+    message = Message.from_db(db, MESSAGE_FIELDS, [
+        entry['message_id'], room_id, entry['sender_id'], entry['message'], parse_datetime(entry['timestamp']),
+    ])
+    message.sender = User.from_db(db, ['id', 'username'], [entry['sender_id'], entry['username']])
+    return message
+
+
+def get_user_chatrooms(user, limit=None):
+    # Inbox in one query, the other person, latest message and unread count are correlated subqueries
+    # instead of 2 queries per room. limit lets the dashboard only pull what it shows.
+    # When this process is keeping room buffers only the latest message's id + time are selected (straight off the
+    # message_room_history index), the preview comes from room_buffers if it has that exact message and one more
+    # query by id gets the rest
+    use_buffers = len(room_buffers) > 0
+    other_people = ChatRoom.people.through.objects.filter(
+        chatroom=OuterRef('pk')
+    ).exclude(user=user.id).order_by('user_id')
+
+    latest = Message.objects.filter(chatroom=OuterRef('pk')).order_by('-timestamp', '-id')
+
+    # unread = messages from the other person after this user's read mark
+    last_read = ReadMark.objects.filter(chatroom=OuterRef('pk'), user=user.id).values('last_read_id')[:1]
+
+    unread = Message.objects.filter(
+        chatroom=OuterRef('pk'),
+        id__gt=OuterRef('last_read_id')
+    ).exclude(sender=user).order_by().values('chatroom').annotate(total=Count('id')).values('total')
+
+    annotations = {
+        'other_user_id': Subquery(other_people.values('user_id')[:1]),
+        'other_username': Subquery(other_people.values('user__username')[:1]),
+        'unread_count': Coalesce(Subquery(unread), 0),
+    }
+    for field in ('id', 'timestamp') if use_buffers else MESSAGE_FIELDS:
+        annotations[f'last_message_{field}'] = Subquery(latest.values(field)[:1])
+
     rooms = ChatRoom.objects.filter(
         people = user,
         is_active = True
-    ).prefetch_related('people', ' messages').select_related('language')
+    ).select_related('language').annotate(
+        last_read_id=Coalesce(Subquery(last_read), 0)
+    ).annotate(**annotations).annotate(
+        last_activity=Coalesce('last_message_timestamp', 'created_at')
+    ).order_by('-last_activity', '-id')
+
+    if limit:
+        rooms = rooms[:limit]
 
     enriched_rooms = []
+    missing = {}
     for room in rooms:
-        other_user = room.get_other_people(user)
-        last_message = room.messages.last()
-        unread_count = room.messages.filter(
-            is_read=False
-        ).exclude(sender=user).count()
+        other_user = None
+        if room.other_user_id is not None:
+            # only id + username are loaded, anything else is fetched lazily
+            other_user = User.from_db(room._state.db, ['id', 'username'], [room.other_user_id, room.other_username])
+
+        last_message = None
+        if room.last_message_id is not None and not use_buffers:
+            values = [getattr(room, f'last_message_{field}') for field in MESSAGE_FIELDS]
+            last_message = Message.from_db(room._state.db, MESSAGE_FIELDS, values)
+        elif room.last_message_id is not None:
+            entry = room_buffers.find(room.id, room.last_message_id)
+            if entry is not None:
+                last_message = buffered_message(entry, room.id)
+            else:
+                missing[room.last_message_id] = len(enriched_rooms)
 
         enriched_rooms.append({
             'room': room,
             'other_user': other_user,
             'last_message': last_message,
-            'unread_count': unread_count,
-            'last_activity': last_message.timestamp if last_message else room.created_at
+            'unread_count': room.unread_count,
+            'last_activity': room.last_activity,
         })
 
-    enriched_rooms.sort(key=lambda x: x['last_activity'].timestamp, reverse=True)
+    if missing:
+        for values in Message.objects.filter(id__in=list(missing)).order_by().values_list(*MESSAGE_FIELDS):
+            enriched_rooms[missing[values[0]]]['last_message'] = Message.from_db(Message.objects.db, MESSAGE_FIELDS, values)
 
     return enriched_rooms
 
 
-def mark_message_as_read(chatroom, user):
-    chatroom.messages.filter(
-        is_read=False
-    ).exclude(sender=user).update(is_read=True)
+# Read marks move forward only, in one upsert. The id the client sent is clamped to the newest message of the room at
+# or below it (message_room_id index), so a made up id can't mark messages that don't exist yet as read
+
+NEWEST = 2 ** 63 - 1
+
+MARK_READ_SQL = """
+    INSERT INTO {marks} (chatroom_id, user_id, last_read_id, updated_at)
+    SELECT %s, %s, MAX(id), %s FROM {messages} WHERE chatroom_id = %s AND id <= %s HAVING MAX(id) IS NOT NULL
+    ON CONFLICT (chatroom_id, user_id) DO UPDATE
+    SET last_read_id = excluded.last_read_id, updated_at = excluded.updated_at
+    WHERE excluded.last_read_id > {marks}.last_read_id
+"""
+
+
+def mark_read_up_to(chatroom, user, message_id):
+    chatroom_id = getattr(chatroom, 'id', chatroom)
+    user_id = getattr(user, 'id', user)
+
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return mark_read_up_to_slow(chatroom_id, user_id, message_id)
+
+    sql = MARK_READ_SQL.format(marks=connection.ops.quote_name(ReadMark._meta.db_table),
+                               messages=connection.ops.quote_name(Message._meta.db_table))
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [chatroom_id, user_id, now, chatroom_id, min(int(message_id), NEWEST)])
+
+
+def mark_read_up_to_slow(chatroom_id, user_id, message_id):
+    # databases without INSERT ... ON CONFLICT DO UPDATE ... WHERE
+    message_id = Message.objects.filter(chatroom_id=chatroom_id, id__lte=message_id).aggregate(top=Max('id'))['top']
+    if message_id is None:
+        return
+    updated = ReadMark.objects.filter(
+        chatroom_id=chatroom_id,
+        user_id=user_id,
+        last_read_id__lt=message_id
+    ).update(last_read_id=message_id)
+
+    if not updated:
+        ReadMark.objects.bulk_create(
+            [ReadMark(chatroom_id=chatroom_id, user_id=user_id, last_read_id=message_id)],
+            ignore_conflicts=True
+        )
+
+
+async def amark_read_up_to(chatroom, user, message_id):
+    # for ChatConsumer, raw SQL has no async cursor
+    await sync_to_async(mark_read_up_to)(chatroom, user, message_id)
+
+
+def mark_message_as_read(chatroom, user, message_id=None):
+    # everything up to message_id (or the newest message in the room) counts as read
+    mark_read_up_to(chatroom, user, NEWEST if message_id is None else message_id)
+
+
+# Chat history pagination
+# Keyset pagination on (timestamp, id) so a page costs the same no matter how long the room history is,
+# the cursor is opaque to the client and points at the oldest message it already has
+
+HISTORY_PAGE_SIZE = 50
+
+
+def encode_cursor(message):
+    raw = f'{message.timestamp.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        timestamp = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if timestamp is None:
+        raise ValueError('Invalid cursor')
+    return timestamp, message_id
+
+
+def get_message_page(room, before=None, limit=HISTORY_PAGE_SIZE):
+    # the newest page of a room with a socket open in this process comes from room_buffers
+    if not before:
+        buffered = room_buffers.page(room.id, limit)
+        if buffered is not None:
+            entries, has_more = buffered
+            page = [buffered_message(entry, room.id) for entry in entries]
+            return page, encode_cursor(page[0]) if has_more else None
+
+    older = None
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        # (timestamp, id) < cursor, written with the timestamp <= bound on its own so it reaches the history index
+        # as a range, the OR alone makes SQLite walk the whole room
+        older = Q(timestamp__lte=timestamp) & (Q(timestamp__lt=timestamp) | Q(id__lt=message_id))
+
+    # one extra row tells us if there is an older page
+    page = []
+    # archived messages are all older than the room's hot ones, so once those run out the page carries on there
+    sources = [Message, ArchivedMessage] if room.archived_count else [Message]
+    for model in sources:
+        messages = model.objects.filter(chatroom=room).select_related('sender').order_by('-timestamp', '-id')
+        if older is not None:
+            messages = messages.filter(older)
+        page += messages[:limit + 1 - len(page)]
+        if len(page) > limit:
+            break
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    if not before and limit >= room_buffers.capacity and room_buffers.wants_fill(room.id):
+        room_buffers.fill(room.id, [message_entry(message) for message in page[-room_buffers.capacity:]],
+                          has_more or len(page) > room_buffers.capacity)
+
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
+
+
+# Reconnect resume, everything after the last id the client saw (message_room_id index), oldest first.
+# Gives back limit + 1 rows at most so the caller can tell the gap was too big to replay
+RESUME_LIMIT = 200
+
+
+def messages_after(room, message_id, limit):
+    return Message.objects.filter(chatroom=room, id__gt=message_id).select_related('sender').order_by('id')[:limit + 1]
+
+
+def get_messages_after(room, message_id, limit=RESUME_LIMIT):
+    return list(messages_after(room, message_id, limit))
+
+
+async def aget_messages_after(room, message_id, limit=RESUME_LIMIT):
+    return [message async for message in messages_after(room, message_id, limit)]
+
+
+def serialize_message(message):
+    return {
+        'message_id': message.id,
+        'username': message.sender.username,
+        'message': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
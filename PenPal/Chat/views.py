@@ -1,13 +1,24 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.http import JsonResponse
 from django.db.models import Count, Q
 from django.utils import timezone
 from datetime import timedelta
 from .models import Language, UserProfile, ChatRoom, Message
-from .utils  import (find_lang_partners, match_score, get_or_create_chatroom, get_user_chatrooms, mark_message_as_read)
+from .utils  import (get_or_create_chatroom, get_user_chatrooms, mark_message_as_read, get_message_page,
+                     serialize_message)
+from .recommendations import get_recommendations
+from .counters import get_site_counters
+from .stats import get_user_stats
+from .presence import online_user_ids
+from .search import search_messages
+from .profiling import all_workers_summary
+from .ratelimit import all_workers_rate_limits
+from .catalog import get_languages, get_catalog_version
 
 # Create your views here.
 
@@ -18,15 +29,8 @@ def home(request):
     if request.user.is_authenticated:
         return redirect('dashboard')
 
-    total_users = User.objects.count()
-    total_languages = Language.objects.count()
-    total_messages = Message.objects.count()
-
-    context = {
-        'total_users': total_users,
-        'total_languages': total_languages,
-        'total_messages': total_messages,
-    }
+    # total_users, total_languages, total_messages, kept up to date by Chat/counters.py
+    context = get_site_counters()
     return render(request,'chat/home.html', context)
 
 
@@ -34,17 +38,17 @@ def home(request):
 def dashboard(request):
     user_profile = request.user.userprofile
 
-    chat_rooms = get_user_chatrooms(request.user),
+    chat_rooms = get_user_chatrooms(request.user, limit=5)
 
     learning_languages = user_profile.learn_lang.all()
 
     days_active = (timezone.now().date() - request.user.date_joined.date()).days
 
-    message_count = Message.objects.filter(sender=request.user).count()
+    message_count = get_user_stats(request.user).messages_sent
 
     context = {
         'user_profile': user_profile,
-        'chat_rooms': chat_rooms[:5],
+        'chat_rooms': chat_rooms,
         'learning_languages': learning_languages,
         'days_active': days_active,
         'message_count': message_count,
@@ -55,13 +59,13 @@ def dashboard(request):
 
 @login_required
 def language_select(request):
-    languages = Language.objects.annotate(learner_count=Count('learners')).all()
-
     user_profile = request.user.userprofile
     user_learning = user_profile.learn_lang.all()
 
+    # the grid is fragment cached on the catalog version, the template only calls get_languages when it's stale
     context = {
-        'languages': languages,
+        'languages': get_languages,
+        'catalog_version': get_catalog_version(),
         'user_learning': user_learning,
     }
     return render(request,'chat/language_select.html', context)
@@ -70,28 +74,23 @@ def language_select(request):
 def partner_list(request, language_id):
     language = get_object_or_404(Language, id=language_id)
 
-    # to find potential match
-    partners = find_lang_partners(request.user, language)
+    # the stored list from refresh_recommendations, scored live from the index if it's missing or stale
+    partners_with_scores = get_recommendations(request.user, language)
 
-    partners_with_scores = []
-    for partner in partners:
-        score = match_score(request.user.userprofile, partner)
-        partners_with_scores.append({
-            'profile': partner,
-            'score':score,})
+    online = online_user_ids(partner['profile'].user_id for partner in partners_with_scores)
+    for partner in partners_with_scores:
+        partner['is_online'] = partner['profile'].user_id in online
 
-    # Sort by score
-    partners_with_scores.sort(key=lambda x: x['score'], reverse=True)
     context = {
         'language': language,
-        'partners_with_scores': partners_with_scores[:20],
+        'partners_with_scores': partners_with_scores,
     }
     return render(request,'chat/partner_list.html', context)
 
 @login_required
 def start_chat(request, partner_id, language_id):
     language = get_object_or_404(Language, id=language_id)
-    partner = get_object_or_404(Language, id=partner_id)
+    partner = get_object_or_404(User, id=partner_id)
 
     # prevent just one person messaging them selves
     if partner == request.user:
@@ -110,27 +109,69 @@ def chat_room(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id)
 
     # Verify user
-    if request.user not in room.people.all():
+    if not room.people.filter(id=request.user.id).exists():
         messages.error(request,'Wrong room try another one!')
         return redirect('my_chats')
 
-    chat_messages = room.messages.select_related('sender').all()
+    # only the newest page, older ones get loaded by chat_history as the user scrolls up
+    chat_messages, next_cursor = get_message_page(room)
 
-    mark_message_as_read(room, request.user)
+    if chat_messages:
+        mark_message_as_read(room, request.user, chat_messages[-1].id)
 
-    other_user = room.get_other_people(request.user)
+    other_user = room.find_other_people(request.user)
 
     context = {
         'room': room,
         'other_user': other_user,
         'messages': chat_messages,
+        'next_cursor': next_cursor,
     }
     return render(request,'chat/chat_room.html', context)
 
+@login_required
+def chat_history(request, room_id):
+    room = get_object_or_404(ChatRoom, id=room_id)
+
+    if not room.people.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Not a participant'}, status=403)
+
+    try:
+        page, next_cursor = get_message_page(room, before=request.GET.get('before'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    return JsonResponse({
+        'messages': [serialize_message(message) for message in page],
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+def search(request):
+    query = request.GET.get('q', '').strip()[:200]
+
+    try:
+        before = int(request.GET.get('before') or 0) or None
+    except ValueError:
+        before = None
+
+    results, next_cursor = search_messages(request.user, query, before=before) if query else ([], None)
+
+    context = {
+        'query': query,
+        'results': results,
+        'next_cursor': next_cursor,
+    }
+    return render(request, 'chat/search.html', context)
+
 @login_required
 def my_chats(request):
     chat_rooms = get_user_chatrooms(request.user)
 
+    online = online_user_ids(room['other_user'].id for room in chat_rooms if room['other_user'])
+    for room in chat_rooms:
+        room['is_online'] = room['other_user'] is not None and room['other_user'].id in online
+
     total_unread = sum(room['unread_count'] for room in chat_rooms)
 
     context = {
@@ -147,16 +188,17 @@ def profile(request):
     return render('user_profile', username=request.user.username)
 
 @login_required
-def user_profile(request, username):
-    profile_user = get_object_or_404(User, username=username)
-    user_profile = profile.user.userprofile
+def user_profile(request, user_id):
+    profile_user = get_object_or_404(User, id=user_id)
+    user_profile = profile_user.userprofile
 
     #check if viewing own profile
     is_own_profile = (request.user == profile_user)
 
     #Stats
-    chat_count = ChatRoom.objects.filter(people=profile_user).count()
-    messages_count = Message.objects.filter(sender=profile_user).count()
+    stats = get_user_stats(profile_user)
+    chat_count = stats.chats_joined
+    messages_count = stats.messages_sent
     days_active = (timezone.now().date() - profile_user.date_joined.date()).days
 
     # Get Learning languages
@@ -206,7 +248,7 @@ def edit_profile(request):
         messages.success(request, 'Profile Updated')
         return redirect('profile')
 
-    all_languages = Language.objects.all()
+    all_languages = get_languages()
     context = {
         'all_languages': all_languages,
         'user_profile': user_profile,
@@ -280,7 +322,7 @@ def signup(request):
         messages.success(request, f'Welcome to PenPal, {username}')
         return redirect('language_select')
 
-    langauges = Language.objects.all()
+    langauges = get_languages()
     context = {
         'langauges': langauges,
     }
@@ -313,3 +355,10 @@ def logout_view(request):
     logout(request)
     messages.success(request, f'See ya Pal')
     return redirect('home')
+
+
+# Profiling numbers and rate limit drops per worker, see profiling.py and ratelimit.py
+
+@staff_member_required
+def profiling_stats(request):
+    return JsonResponse({'workers': all_workers_summary(), 'rate_limits': all_workers_rate_limits()})
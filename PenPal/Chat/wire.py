@@ -0,0 +1,57 @@
+import json
+
+
+# What goes down the socket
+# Group events only carry their fields. A format is encoded the first time a socket in this process needs it and
+# kept on the event, the local fan-out layer hands every socket in the process the same dict, so each format is
+# encoded at most once per process and only when somebody wants it:
+#   frame    the normal JSON object, {"type": "chat_message", "username": ..., ...}
+#   compact  a short JSON array, ["m", username, message, timestamp, message_id]
+# The cached strings are under _ keys, which layers.py doesn't send to other workers.
+# Clients that open the socket with the COMPACT_PROTOCOL subprotocol get compact events batched into one array
+# per frame, [["m", ...], ["t", ...]], everyone else gets the normal frames one by one
+
+COMPACT_PROTOCOL = 'penpal.compact.v1'
+
+# group event type -> (client type, compact code, fields in order)
+EVENTS = {
+    'chat_message': ('chat_message', 'm', ('username', 'message', 'timestamp', 'message_id')),
+    'typing_indicator': ('typing', 't', ('username', 'is_typing')),
+    'user_joined': ('user_join', 'j', ('username',)),
+    'user_left': ('user_leave', 'l', ('username',)),
+}
+
+
+def verbose_frame(event):
+    client_type, code, fields = EVENTS[event['type']]
+    data = {'type': client_type}
+    for field in fields:
+        data[field] = event[field]
+    return json.dumps(data)
+
+
+def compact_frame(event):
+    client_type, code, fields = EVENTS[event['type']]
+    values = [code]
+    for field in fields:
+        value = event[field]
+        values.append(int(value) if isinstance(value, bool) else value)
+    return json.dumps(values, separators=(',', ':'), ensure_ascii=False)
+
+
+def frame(event):
+    encoded = event.get('_frame')
+    if encoded is None:
+        encoded = event['_frame'] = verbose_frame(event)
+    return encoded
+
+
+def compact(event):
+    encoded = event.get('_compact')
+    if encoded is None:
+        encoded = event['_compact'] = compact_frame(event)
+    return encoded
+
+
+def batch(fragments):
+    return '[' + ','.join(fragments) + ']'